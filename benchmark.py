@@ -4,6 +4,15 @@ import blowfish
 from time import perf_counter
 from os import urandom
 import operator
+import tempfile
+import io
+import tracemalloc
+import sys
+import os
+import pickle
+import asyncio
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 class Timer(object):
   def __init__(self, clock):
@@ -219,3 +228,442 @@ if __name__ == "__main__":
     total += timer.elapsed
   print("{} random bytes in {:.5f} sec (average)".format(num_bytes, total / n))
       
+  
+  mac_cipher = blowfish.Cipher(b"this ist a mac key")
+  
+  print("\nBenchmarking 'encrypt_cbc' + 'CMAC' (two passes)...")
+  total = 0
+  for n in range(1, times):
+    timer = Timer(perf_counter)
+    with timer:
+      mac = blowfish.CMAC(mac_cipher)
+      mac.update(b"".join(test_cipher.encrypt_cbc(rand_bytes, iv)))
+      mac.digest()
+    print("{} random bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    total += timer.elapsed
+  print("{} random bytes in {:.5f} sec (average)".format(num_bytes, total / n))
+  
+  print("\nBenchmarking 'encrypt_cbc_cmac' (one pass)...")
+  total = 0
+  for n in range(1, times):
+    timer = Timer(perf_counter)
+    with timer:
+      mac = blowfish.CMAC(mac_cipher)
+      b"".join(test_cipher.encrypt_cbc_cmac(rand_bytes, iv, mac))
+      mac.digest()
+    print("{} random bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    total += timer.elapsed
+  print("{} random bytes in {:.5f} sec (average)".format(num_bytes, total / n))
+  
+  print("\nBenchmarking 'encrypt_ctr' + 'CMAC' (two passes)...")
+  total = 0
+  for n in range(1, times):
+    timer = Timer(perf_counter)
+    counter = blowfish.ctr_counter(nonce, operator.xor)
+    with timer:
+      mac = blowfish.CMAC(mac_cipher)
+      mac.update(b"".join(test_cipher.encrypt_ctr(rand_bytes, counter)))
+      mac.digest()
+    print("{} random bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    total += timer.elapsed
+  print("{} random bytes in {:.5f} sec (average)".format(num_bytes, total / n))
+  
+  print("\nBenchmarking 'encrypt_ctr_cmac' (one pass)...")
+  total = 0
+  for n in range(1, times):
+    timer = Timer(perf_counter)
+    counter = blowfish.ctr_counter(nonce, operator.xor)
+    with timer:
+      mac = blowfish.CMAC(mac_cipher)
+      b"".join(test_cipher.encrypt_ctr_cmac(rand_bytes, counter, mac))
+      mac.digest()
+    print("{} random bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    total += timer.elapsed
+  print("{} random bytes in {:.5f} sec (average)".format(num_bytes, total / n))
+  
+  num_messages = 20000
+  message_bytes = 32
+  messages = [urandom(message_bytes) for i in range(num_messages)]
+  
+  for mode in ("ecb", "cbc", "pcbc", "cfb", "ofb", "ctr"):
+    method = getattr(test_cipher, "encrypt_" + mode)
+    prepared = test_cipher.prepare(mode, "encrypt")
+    
+    if mode == "ecb":
+      args = ()
+    elif mode == "ctr":
+      args = (range(4),)
+    else:
+      args = (iv,)
+    
+    print(
+      "\nBenchmarking {}-byte messages with 'encrypt_{}'...".format(
+        message_bytes, mode
+      )
+    )
+    timer = Timer(perf_counter)
+    with timer:
+      for message in messages:
+        b"".join(method(message, *args))
+    print(
+      "{:.2f} usec per message".format(timer.elapsed / num_messages * 1e6)
+    )
+    
+    print(
+      "Benchmarking {}-byte messages with 'prepare({!r}, \"encrypt\")'..."
+      .format(message_bytes, mode)
+    )
+    timer = Timer(perf_counter)
+    with timer:
+      for message in messages:
+        prepared(message, *args)
+    print(
+      "{:.2f} usec per message".format(timer.elapsed / num_messages * 1e6)
+    )
+  
+  print("\nBenchmarking 'Cipher' instantiation...")
+  for fuse_S_boxes in (False, True):
+    timer = Timer(perf_counter)
+    with timer:
+      for i in range(20):
+        blowfish.Cipher(b"this ist a key", fuse_S_boxes = fuse_S_boxes)
+    print(
+      "fuse_S_boxes = {}: {:.5f} sec per cipher".format(
+        fuse_S_boxes, timer.elapsed / 20
+      )
+    )
+  
+  for mode in ("ecb", "ctr"):
+    print(
+      "\nBenchmarking 'encrypt_{}' with and without fused S-boxes "
+      "(including instantiation)...".format(mode)
+    )
+    for size in (1000, 10000, 100000):
+      for fuse_S_boxes in (False, True):
+        timer = Timer(perf_counter)
+        with timer:
+          cipher = blowfish.Cipher(
+            b"this ist a key",
+            fuse_S_boxes = fuse_S_boxes
+          )
+          if mode == "ecb":
+            b"".join(cipher.encrypt_ecb(rand_bytes[:size]))
+          else:
+            b"".join(
+              cipher.encrypt_ctr(
+                rand_bytes[:size],
+                blowfish.ctr_counter(nonce, operator.xor)
+              )
+            )
+        print(
+          "fuse_S_boxes = {}: {} random bytes in {:.5f} sec".format(
+            fuse_S_boxes, size, timer.elapsed
+          )
+        )
+  
+  print("\nBenchmarking 'Cipher' instantiation with a 'ScheduleCache'...")
+  keys = [urandom(16) for i in range(100)]
+  with tempfile.TemporaryDirectory() as cache_dir:
+    schedule_cache = blowfish.ScheduleCache(cache_dir)
+    for state in ("cold", "warm"):
+      timer = Timer(perf_counter)
+      with timer:
+        for key in keys:
+          blowfish.Cipher(key, schedule_cache = schedule_cache)
+      print(
+        "{} cache: {:.0f} keys per sec".format(state, len(keys) / timer.elapsed)
+      )
+  
+  print("\nBenchmarking 64-bit integer encryption...")
+  num_ids = 10 ** 7
+  ids = array("Q", range(num_ids))
+  byte_order = test_cipher.byte_order
+  
+  timer = Timer(perf_counter)
+  with timer:
+    for n in ids:
+      int.from_bytes(
+        test_cipher.encrypt_block(n.to_bytes(8, byte_order)),
+        byte_order
+      )
+  print("'encrypt_block' round-trip: {} ids in {:.5f} sec".format(
+    num_ids, timer.elapsed
+  ))
+  
+  timer = Timer(perf_counter)
+  with timer:
+    for n in ids:
+      test_cipher.encrypt_u64(n)
+  print("'encrypt_u64': {} ids in {:.5f} sec".format(num_ids, timer.elapsed))
+  
+  for operation in ("encrypt", "decrypt"):
+    timer = Timer(perf_counter)
+    with timer:
+      getattr(test_cipher, "{}_u64_array".format(operation))(ids)
+    print("'{}_u64_array': {} ids in {:.5f} sec".format(
+      operation, num_ids, timer.elapsed
+    ))
+  
+  print("\nBenchmarking memory allocated while encrypting and decrypting...")
+  mode_args = {
+    "ecb": (),
+    "ecb_cts": (),
+    "cbc": (iv,),
+    "cbc_cts": (iv,),
+    "pcbc": (iv,),
+    "cfb": (iv,),
+    "ofb": (iv,),
+    "ctr": (blowfish.ctr_counter(nonce, operator.xor),),
+  }
+  data = rand_bytes[:10000]
+  for mode in blowfish.MODES:
+    for operation in ("encrypt", "decrypt"):
+      method = getattr(test_cipher, "{}_{}".format(operation, mode))
+      
+      # Consume the iterator without keeping the blocks it returns, so that
+      # only memory held on to by the loop itself is counted.
+      blocks_before = sys.getallocatedblocks()
+      tracemalloc.start()
+      for block in method(data, *mode_args[mode]):
+        pass
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      del block
+      blocks_after = sys.getallocatedblocks()
+      
+      print(
+        "'{}_{}': peak {} bytes traced, {} blocks still allocated".format(
+          operation, mode, peak, blocks_after - blocks_before
+        )
+      )
+  
+  print("\nBenchmarking 'Cipher' instantiation (key expansion)...")
+  for key_len in (4, 16, 56):
+    keys = [urandom(key_len) for i in range(200)]
+    timer = Timer(perf_counter)
+    with timer:
+      for key in keys:
+        blowfish.Cipher(key)
+    print("{}-byte keys: {:.0f} keys per sec".format(
+      key_len, len(keys) / timer.elapsed
+    ))
+  
+  print("\nBenchmarking 'Random'...")
+  random = blowfish.Random(b"this ist a key", nonce)
+  timer = Timer(perf_counter)
+  with timer:
+    random.randbytes(num_bytes)
+  print("'randbytes': {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+  
+  timer = Timer(perf_counter)
+  with timer:
+    b"".join(
+      test_cipher.encrypt_ctr(
+        bytes(num_bytes),
+        blowfish.ctr_counter(nonce, operator.xor)
+      )
+    )
+  print("'encrypt_ctr' over zeros: {} bytes in {:.5f} sec".format(
+    num_bytes, timer.elapsed
+  ))
+  
+  print("\nBenchmarking 'SectorCipher'...")
+  sector_cipher = blowfish.SectorCipher(b"this ist a key", 4096)
+  image = bytearray(rand_bytes[:num_bytes - num_bytes % 4096])
+  for workers in (0, 2):
+    executor = ProcessPoolExecutor(workers) if workers else None
+    timer = Timer(perf_counter)
+    with timer:
+      sector_cipher.encrypt_in_place(image, executor = executor)
+    if executor is not None:
+      executor.shutdown()
+    print("'encrypt_in_place' ({} workers): {} bytes in {:.5f} sec".format(
+      workers, len(image), timer.elapsed
+    ))
+  
+  print("\nBenchmarking 'reencrypt' (CBC to CTR)...")
+  new_cipher = blowfish.Cipher(b"this ist another key")
+  old_data = b"".join(test_cipher.encrypt_cbc(rand_bytes, iv))
+  
+  timer = Timer(perf_counter)
+  with timer:
+    b"".join(
+      new_cipher.encrypt_ctr(
+        b"".join(test_cipher.decrypt_cbc(old_data, iv)),
+        blowfish.ctr_counter(nonce, operator.xor)
+      )
+    )
+  print("decrypt, then encrypt: {} bytes in {:.5f} sec".format(
+    len(old_data), timer.elapsed
+  ))
+  
+  for workers in (0, 2):
+    executor = ProcessPoolExecutor(workers) if workers else None
+    timer = Timer(perf_counter)
+    with timer:
+      b"".join(
+        blowfish.reencrypt(
+          old_data,
+          test_cipher, "cbc",
+          new_cipher, "ctr",
+          (iv,), (blowfish.ctr_counter(nonce, operator.xor),),
+          chunk_size = 16 * 1024,
+          executor = executor
+        )
+      )
+    if executor is not None:
+      executor.shutdown()
+    print("'reencrypt' ({} workers): {} bytes in {:.5f} sec".format(
+      workers, len(old_data), timer.elapsed
+    ))
+  
+  print("\nBenchmarking 'pipeline' (CTR)...")
+  for workers in (0, 2):
+    executor = ProcessPoolExecutor(workers) if workers else None
+    stats = blowfish.pipeline(
+      io.BytesIO(rand_bytes),
+      io.BytesIO(),
+      test_cipher,
+      "ctr",
+      blowfish.ctr_counter(nonce, operator.xor),
+      chunk_size = 16 * 1024,
+      executor = executor
+    )
+    if executor is not None:
+      executor.shutdown()
+    print("{} workers: {}".format(workers, stats))
+  
+  print("\nBenchmarking 'Autotuner' calibration (CTR)...")
+  tuner = blowfish.Autotuner(calibrate_on_first_use = False)
+  timer = Timer(perf_counter)
+  with timer:
+    decision = tuner.calibrate("ctr", "encrypt", 10 ** 7)
+  print("calibrated in {:.5f} sec: {}".format(timer.elapsed, decision))
+  
+  print("\nBenchmarking 'encrypt_vectored' (CTR, 1500 byte fragments)...")
+  fragments = [
+    memoryview(rand_bytes)[i:i + 1500] for i in range(0, num_bytes, 1500)
+  ]
+  timer = Timer(perf_counter)
+  with timer:
+    b"".join(
+      test_cipher.encrypt_ctr(
+        b"".join(fragments), blowfish.ctr_counter(nonce, operator.xor)
+      )
+    )
+  print("concatenated: {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+  timer = Timer(perf_counter)
+  with timer:
+    test_cipher.encrypt_vectored(
+      "ctr", fragments, blowfish.ctr_counter(nonce, operator.xor)
+    )
+  print("vectored: {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+  
+  print("\nBenchmarking 'encrypt_records' (10000 records of 9-40 bytes)...")
+  record_offsets = array("q", [0])
+  for i in range(10000):
+    record_offsets.append(record_offsets[-1] + 9 + i % 32)
+  record_data = urandom(record_offsets[-1])
+  record_ivs = urandom(8 * 10000)
+  record_nonces = list(range(10000))
+  for mode, column, method_args in (
+    ("cbc_cts", record_ivs, lambda i: (record_ivs[8 * i:8 * i + 8],)),
+    ("ctr", record_nonces, lambda i: (
+      blowfish.ctr_counter(record_nonces[i], operator.xor),
+    )),
+  ):
+    method = getattr(test_cipher, "encrypt_" + mode)
+    timer = Timer(perf_counter)
+    with timer:
+      for i in range(10000):
+        b"".join(
+          method(
+            record_data[record_offsets[i]:record_offsets[i + 1]],
+            *method_args(i)
+          )
+        )
+    print("'encrypt_{}' per record: {:.5f} sec".format(mode, timer.elapsed))
+    timer = Timer(perf_counter)
+    with timer:
+      test_cipher.encrypt_records(mode, record_data, record_offsets, column)
+    print("'encrypt_records' ({}): {:.5f} sec".format(mode, timer.elapsed))
+  
+  print("\nBenchmarking 'encrypt_ecb' with a block cache...")
+  for entropy, data in (
+    ("low", bytes(num_bytes // 2) + urandom(64) * (num_bytes // 128)),
+    ("high", rand_bytes),
+  ):
+    for max_blocks in (None, 4096):
+      cipher = blowfish.Cipher(b"this ist a key")
+      if max_blocks is not None:
+        block_cache = cipher.enable_block_cache(max_blocks)
+      timer = Timer(perf_counter)
+      with timer:
+        b"".join(cipher.encrypt_ecb(data))
+      print("{} entropy, {}: {} bytes in {:.5f} sec{}".format(
+        entropy,
+        "cache" if max_blocks else "no cache",
+        len(data),
+        timer.elapsed,
+        " (hit rate {:.3f})".format(block_cache.hit_rate) if max_blocks else ""
+      ))
+  
+  print("\nBenchmarking 'dumps' & 'loads' (one out-of-band buffer)...")
+  if hasattr(pickle, "PickleBuffer"):
+    payload = {"data": pickle.PickleBuffer(bytearray(rand_bytes))}
+    timer = Timer(perf_counter)
+    with timer:
+      b"".join(
+        test_cipher.encrypt_ctr(
+          pickle.dumps(payload, 5),
+          blowfish.ctr_counter(nonce, operator.xor)
+        )
+      )
+    print("in-band: {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    timer = Timer(perf_counter)
+    with timer:
+      data, buffers = blowfish.dumps(payload, test_cipher)
+    print("'dumps': {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+    timer = Timer(perf_counter)
+    with timer:
+      blowfish.loads(data, test_cipher, buffers)
+    print("'loads': {} bytes in {:.5f} sec".format(num_bytes, timer.elapsed))
+  
+  print("\nBenchmarking 'aencrypt' (CTR)...")
+  loop = asyncio.new_event_loop()
+  for time_slice in (0.001, 0.005, 0.02):
+    awaitable = test_cipher.aencrypt(
+      "ctr",
+      rand_bytes,
+      blowfish.ctr_counter(nonce, operator.xor),
+      time_slice = time_slice
+    )
+    timer = Timer(perf_counter)
+    with timer:
+      loop.run_until_complete(awaitable)
+    print(
+      "{:.3f} sec slices: {} bytes in {:.5f} sec, {} yields, "
+      "longest slice {:.5f} sec".format(
+        time_slice,
+        num_bytes,
+        timer.elapsed,
+        awaitable.yields,
+        awaitable.longest_slice
+      )
+    )
+  loop.close()
+  
+  print("\nBenchmarking 'encrypt_file_inplace' (CTR)...")
+  with tempfile.TemporaryDirectory() as temp_dir:
+    path = os.path.join(temp_dir, "data")
+    with open(path, "wb") as f:
+      f.write(rand_bytes)
+    for window_size in (64 * 1024, 1024 * 1024):
+      timer = Timer(perf_counter)
+      with timer:
+        blowfish.encrypt_file_inplace(
+          path, test_cipher, "ctr", nonce, window_size = window_size
+        )
+      print("{} byte windows: {} bytes in {:.5f} sec".format(
+        window_size, num_bytes, timer.elapsed
+      ))
@@ -27,10 +27,30 @@ Schneier and more details about it can be found at
 """
 
 from struct import Struct, error as struct_error
-from itertools import cycle as iter_cycle
+from hmac import compare_digest
+from binascii import hexlify
+import os
+import sys
+from os import urandom
+from array import array
+from hashlib import sha256
+from itertools import chain, islice
+from mmap import mmap, ALLOCATIONGRANULARITY
+import gc
+from operator import xor
+from collections import deque, OrderedDict, namedtuple
+from io import BytesIO
+from time import perf_counter
+
+# asyncio, concurrent.futures, json, pickle, queue & threading are imported by
+# the functions that need them, since importing them all up front takes
+# several times longer than importing the rest of this module.
 
 __version__ = "0.7.1"
 
+# Type code of 32-bit unsigned integer arrays.
+_U4_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
 # PI_P_ARRAY & PI_S_BOXES are the hexadecimal digits of π (the irrational)
 # taken from <https://www.schneier.com/code/constants.txt>.
 
@@ -225,6 +245,145 @@ PI_S_BOXES = (
   ),
 )
 
+# Padding schemes understood by the `padding` argument of the ECB, CBC & PCBC
+# modes of operation.
+PADDING_SCHEMES = ("pkcs7", "iso10126", "x923", "zero")
+
+def _pad_block(data, padding):
+  """
+  Return `data` (less than 8 bytes) padded to a full block using the `padding`
+  scheme, or ``None`` if the scheme does not add a block.
+  """
+  pad_len = 8 - len(data)
+  
+  if padding == "pkcs7":
+    return bytes(data) + bytes((pad_len,)) * pad_len
+  elif padding == "iso10126":
+    return bytes(data) + urandom(pad_len - 1) + bytes((pad_len,))
+  elif padding == "x923":
+    return bytes(data) + bytes(pad_len - 1) + bytes((pad_len,))
+  elif padding == "zero":
+    return bytes(data) + bytes(pad_len) if pad_len != 8 else None
+  else:
+    raise ValueError("unknown padding scheme {!r}".format(padding))
+
+# Modes of operation, as named by :meth:`Cipher.prepare`.
+MODES = ("ecb", "ecb_cts", "cbc", "cbc_cts", "pcbc", "cfb", "ofb", "ctr")
+
+def _round_functions(P, S1, S2, S3, S4):
+  """
+  Return a pair of functions that encrypt & decrypt a block, given as a pair of
+  32-bit integers, with subkeys `P` and S-boxes `S1`, `S2`, `S3` & `S4` bound
+  to them.
+  """
+  P_forward = P[:-1]
+  p_penultimate, p_last = P[-1]
+  P_reverse = tuple((p1, p2) for p2, p1 in P[:0:-1])
+  p_first, p_second = P[0]
+  
+  def encrypt(L, R):
+    for p1, p2 in P_forward:
+      L ^= p1
+      R ^= (S1[L >> 24] + S2[L >> 16 & 0xff] ^ S3[L >> 8 & 0xff]) \
+        + S4[L & 0xff] & 0xffffffff
+      R ^= p2
+      L ^= (S1[R >> 24] + S2[R >> 16 & 0xff] ^ S3[R >> 8 & 0xff]) \
+        + S4[R & 0xff] & 0xffffffff
+    return R ^ p_last, L ^ p_penultimate
+  
+  def decrypt(L, R):
+    for p1, p2 in P_reverse:
+      L ^= p1
+      R ^= (S1[L >> 24] + S2[L >> 16 & 0xff] ^ S3[L >> 8 & 0xff]) \
+        + S4[L & 0xff] & 0xffffffff
+      R ^= p2
+      L ^= (S1[R >> 24] + S2[R >> 16 & 0xff] ^ S3[R >> 8 & 0xff]) \
+        + S4[R & 0xff] & 0xffffffff
+    return R ^ p_first, L ^ p_second
+  
+  return encrypt, decrypt
+
+def _fused_round_functions(P, S12, S3, S4):
+  """
+  Same as :func:`_round_functions`, but with the first two S-boxes fused into
+  table `S12` (see :func:`_fuse_S_boxes`).
+  """
+  P_forward = P[:-1]
+  p_penultimate, p_last = P[-1]
+  P_reverse = tuple((p1, p2) for p2, p1 in P[:0:-1])
+  p_first, p_second = P[0]
+  
+  def encrypt(L, R):
+    for p1, p2 in P_forward:
+      L ^= p1
+      R ^= (S12[L >> 16] ^ S3[L >> 8 & 0xff]) + S4[L & 0xff] & 0xffffffff
+      R ^= p2
+      L ^= (S12[R >> 16] ^ S3[R >> 8 & 0xff]) + S4[R & 0xff] & 0xffffffff
+    return R ^ p_last, L ^ p_penultimate
+  
+  def decrypt(L, R):
+    for p1, p2 in P_reverse:
+      L ^= p1
+      R ^= (S12[L >> 16] ^ S3[L >> 8 & 0xff]) + S4[L & 0xff] & 0xffffffff
+      R ^= p2
+      L ^= (S12[R >> 16] ^ S3[R >> 8 & 0xff]) + S4[R & 0xff] & 0xffffffff
+    return R ^ p_first, L ^ p_second
+  
+  return encrypt, decrypt
+
+def _fuse_S_boxes(S1, S2):
+  """
+  Return a 65,536 entry table of 32-bit integers that maps the upper 16 bits
+  ``x`` of a half-block to ``S1[x >> 8] + S2[x & 0xff]`` (modulo 2^32).
+  
+  The carry of the addition is always masked off after the rest of the round
+  function is computed, so masking it off early gives the same result.
+  """
+  S12 = array(_U4_TYPECODE)
+  for s1 in S1:
+    S12.extend([s1 + s2 & 0xffffffff for s2 in S2])
+  return S12
+
+def _block_range(data_len, start_block, stop_block):
+  """
+  Return the start & stop byte indexes of the range of blocks `start_block`
+  to `stop_block` of data `data_len` bytes long, clamped to its end.
+  """
+  if start_block < 0 or (stop_block is not None and stop_block < 0):
+    raise ValueError("block indexes can not be negative")
+  
+  start_i = min(start_block * 8, data_len)
+  if stop_block is None:
+    stop_i = data_len
+  else:
+    stop_i = max(start_i, min(stop_block * 8, data_len))
+  
+  return start_i, stop_i
+
+def _unpad_block(block, padding):
+  """
+  Return the last `block` with its `padding` removed.
+  If the padding is invalid, a :exc:`ValueError` exception is raised.
+  """
+  if padding == "zero":
+    return block.rstrip(b"\x00")
+  
+  pad_len = block[-1]
+  if not 1 <= pad_len <= 8:
+    raise ValueError("invalid padding")
+  
+  if padding == "pkcs7":
+    valid = block[8 - pad_len:] == bytes((pad_len,)) * pad_len
+  elif padding == "x923":
+    valid = block[8 - pad_len:-1] == bytes(pad_len - 1)
+  else:
+    valid = True
+  
+  if not valid:
+    raise ValueError("invalid padding")
+  
+  return block[:8 - pad_len]
+
 class Cipher(object):
   """
   Blowfish block cipher.
@@ -250,6 +409,26 @@ class Cipher(object):
   The length of `P_array` also determines how many "rounds" are done per block.
   For a `P_array` with length n, n - 2 rounds are done on every block.
   
+  If `fuse_S_boxes` is true, the first two S-boxes are fused into a single
+  65,536 entry table, indexed by the upper 16 bits of a half-block, that holds
+  the sum of their entries. This replaces two look-ups and an addition per
+  round with a single look-up, at the cost of about 256 KB of memory per
+  cipher and a slower instantiation. It only pays off when encrypting or
+  decrypting more than a few tens of KB of data with the same key.
+  
+  `schedule_cache` can be a :class:`ScheduleCache` object, in which case the
+  subkey P array and S-boxes derived from `key` are loaded from it, if they
+  were previously saved to it, instead of being derived again (which takes
+  521 block encryptions). Otherwise, they are derived and saved to it.
+  
+  If `buffer_S_boxes` is true, the S-boxes are stored in contiguous
+  :class:`array.array` buffers instead of tuples of integer objects. Looking
+  up an entry then creates a new integer instead of touching the reference
+  count of a shared one, so the memory pages holding the S-boxes stay shared
+  with the parent when the process forks (see :func:`freeze_schedules`).
+  It also uses about a tenth of the memory, but encryption and decryption are
+  about a third slower.
+  
   Encryption & Decryption
   -----------------------
   Blowfish is a block cipher with a 64-bits (i.e. 8 bytes) block-size. As
@@ -289,6 +468,19 @@ class Cipher(object):
   Counter (CTR)
     :meth:`encrypt_ctr` & :meth:`decrypt_ctr`
   
+  A range of blocks can be decrypted on its own (without decrypting all the
+  blocks before it) with :meth:`decrypt_cbc_range` & :meth:`decrypt_cfb_range`.
+  PCBC mode does not allow it.
+  
+  The CBC and CTR modes can also compute a :class:`CMAC` tag over the
+  ciphertext in the same pass that encrypts or decrypts it:
+  
+  Cipher-Block Chaining with CMAC (CBC + CMAC)
+    :meth:`encrypt_cbc_cmac` & :meth:`decrypt_cbc_cmac`
+  
+  Counter with CMAC (CTR + CMAC)
+    :meth:`encrypt_ctr_cmac` & :meth:`decrypt_ctr_cmac`
+  
   ECB, CBC & PCBC modes can only operate on data that is a multiple of the
   block-size in length (i.e. 8, 16, 32, etc. bytes).
   ECB-CTS and CBC-CTS modes can only operate on data that is greater than 8
@@ -297,8 +489,23 @@ class Cipher(object):
   
   Data that is not a multiple of the block-size in length can still be used
   with modes that expect otherwise (i.e. ECB, CBC, PCBC), if it is padded
-  properly. Padding functionality is not implemented in this module, as there
-  are countless schemes and it's relatively easy to roll out your own.
+  properly. These modes take an optional `padding` argument naming one of the
+  schemes in :data:`PADDING_SCHEMES`:
+  
+  ``"pkcs7"``
+    Pad with n bytes each of value n (PKCS#7).
+  
+  ``"iso10126"``
+    Pad with n - 1 random bytes followed by a byte of value n (ISO 10126).
+  
+  ``"x923"``
+    Pad with n - 1 zero bytes followed by a byte of value n (ANSI X9.23).
+  
+  ``"zero"``
+    Pad with zero bytes, only if needed. Trailing zero bytes of the data
+    itself can not be told apart from padding and are removed as well.
+  
+  The data is padded (or unpadded) a block at a time, without it being copied.
   
   .. warning::
       
@@ -306,12 +513,18 @@ class Cipher(object):
       using them. If you can't be bothered, stick with CTR.
   """
   
+  # The BlockCache used by the ECB & ECB-CTS modes (see enable_block_cache).
+  block_cache = None
+  
   def __init__(
     self, 
     key,
     byte_order = "big",
     P_array = PI_P_ARRAY,
-    S_boxes = PI_S_BOXES
+    S_boxes = PI_S_BOXES,
+    fuse_S_boxes = False,
+    schedule_cache = None,
+    buffer_S_boxes = False
   ):
     if not 4 <= len(key) <= 56:
       raise ValueError("key is not between 4 and 56 bytes")
@@ -322,6 +535,27 @@ class Cipher(object):
     if len(S_boxes) != 4 or any(len(box) != 256 for box in S_boxes):
       raise ValueError("S-boxes is not a 4 x 256 sequence")
       
+    self._init_byte_order(byte_order)
+    
+    schedule = None
+    if schedule_cache is not None:
+      schedule = schedule_cache.load(key, P_array, S_boxes)
+    
+    if schedule is None:
+      schedule = self._expand_key(key, P_array, S_boxes)
+      if schedule_cache is not None:
+        schedule_cache.store(key, P_array, S_boxes, *schedule)
+    
+    self._init_schedule(
+      *schedule,
+      fuse_S_boxes = fuse_S_boxes,
+      buffer_S_boxes = buffer_S_boxes
+    )
+  
+  def _init_byte_order(self, byte_order):
+    """
+    Create the structs used to interpret bytes in `byte_order`.
+    """
     if byte_order == "big":
       byte_order_fmt = ">"
     elif byte_order == "little":
@@ -332,9 +566,7 @@ class Cipher(object):
     
     # Create structs
     u4_2_struct = Struct("{}2I".format(byte_order_fmt))
-    u4_1_struct = Struct(">I".format(byte_order_fmt))
     u8_1_struct = Struct("{}Q".format(byte_order_fmt))
-    u1_4_struct = Struct("=4B")
       
     # Save refs locally to the needed pack/unpack funcs of the structs to speed
     # up look-ups a little.
@@ -342,87 +574,150 @@ class Cipher(object):
     self._u4_2_unpack = u4_2_struct.unpack
     self._u4_2_iter_unpack = u4_2_struct.iter_unpack
     
-    self._u4_1_pack = u4_1_pack = u4_1_struct.pack
-    
-    self._u1_4_unpack = u1_4_unpack = u1_4_struct.unpack
-    
     self._u8_1_pack = u8_1_struct.pack
+  
+  def _init_schedule(self, P, S, fuse_S_boxes = False, buffer_S_boxes = False):
+    """
+    Set the subkey P array `P` and S-boxes `S` (as returned by
+    :meth:`_expand_key`).
+    """
+    if buffer_S_boxes:
+      S = tuple(array(_U4_TYPECODE, box) for box in S)
     
-    # Cyclic key iterator
-    cyclic_key_iter = iter_cycle(iter(key))
-    
-    # Cyclic 32-bit integer iterator over key bytes
-    cyclic_key_u4_iter = (
-      x for (x,) in map(
-        u4_1_struct.unpack,
-        map(
-          bytes,
-          zip(
-            cyclic_key_iter,
-            cyclic_key_iter,
-            cyclic_key_iter,
-            cyclic_key_iter
-          )
-        )
+    self.P = P
+    self.S = S
+    
+    if fuse_S_boxes:
+      self.S12 = S12 = _fuse_S_boxes(S[0], S[1])
+      self._encrypt, self._decrypt = _fused_round_functions(
+        P, S12, S[2], S[3]
       )
+    else:
+      self.S12 = None
+      self._encrypt, self._decrypt = _round_functions(P, *S)
+    
+  def enable_block_cache(self, max_blocks = 4096):
+    """
+    Cache the results of encrypting & decrypting up to `max_blocks` blocks
+    (for each direction) in ECB & ECB-CTS mode, so that repeated blocks skip
+    the rounds, and return the :class:`BlockCache` object (also available as
+    :attr:`block_cache`), which reports the hit rate.
+    
+    Only worth it for data with many repeated blocks (e.g. disk images). To
+    stop caching, set :attr:`block_cache` to ``None``. The cache is not
+    pickled along with the cipher.
+    """
+    self.block_cache = BlockCache(max_blocks)
+    return self.block_cache
+  
+  def __reduce__(self):
+    # Pickle the derived key schedule rather than the key (which is not kept),
+    # so that unpickling does not have to derive it again.
+    return _restore_cipher, (
+      self.byte_order,
+      self.P,
+      self.S,
+      self.S12 is not None,
+      isinstance(self.S[0], array)
     )
-        
-    # Create and initialize subkey P array and S-boxes
-    
-    # XOR each element in P_array with key and save as pairs.
-    P = [
-      (p1 ^ k1, p2 ^ k2) for p1, p2, k1, k2 in zip(
-        P_array[0::2],
-        P_array[1::2],
-        cyclic_key_u4_iter,
-        cyclic_key_u4_iter
-      )
-    ]
+  
+  def _expand_key(self, key, P_array, S_boxes):
+    """
+    Return the subkey P array (as a tuple of pairs of 32-bit integers) and
+    S-boxes (as a tuple of 4 tuples of 256 32-bit integers) derived from
+    `key`, `P_array` and `S_boxes`.
+    """
+    P_len = len(P_array)
+    
+    # XOR each element in P_array with the next 32 bits of the (cyclic) key.
+    key_u4s = Struct(">{}I".format(P_len)).unpack_from(
+      bytes(key) * (4 * P_len // len(key) + 1)
+    )
+    P = [p ^ k for p, k in zip(P_array, key_u4s)]
     
-    S1, S2, S3, S4 = S = [[x for x in box] for box in S_boxes]
+    S1, S2, S3, S4 = S = [list(box) for box in S_boxes]
     
-    encrypt = self._encrypt
+    # The encryptions below are the same as the ones done by the functions
+    # returned by _round_functions, inlined to avoid the cost of calling one
+    # 521 times (with the default P array).
     L = 0x00000000
     R = 0x00000000
     
-    for i in range(len(P)):
-      P[i] = L, R = encrypt(L, R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+    # The P array changes with every encryption here, so index it directly.
+    P_rounds = range(0, P_len - 2, 2)
+    p_penultimate_i = P_len - 2
+    p_last_i = P_len - 1
+    
+    for i in range(0, P_len, 2):
+      for j in P_rounds:
+        L ^= P[j]
+        R ^= (S1[L >> 24] + S2[L >> 16 & 0xff] ^ S3[L >> 8 & 0xff]) \
+          + S4[L & 0xff] & 0xffffffff
+        R ^= P[j + 1]
+        L ^= (S1[R >> 24] + S2[R >> 16 & 0xff] ^ S3[R >> 8 & 0xff]) \
+          + S4[R & 0xff] & 0xffffffff
+      L, R = R ^ P[p_last_i], L ^ P[p_penultimate_i]
+      P[i] = L
+      P[i + 1] = R
+    
+    # Save P as pairs in a tuple since working with tuples is slightly faster
+    P = tuple(zip(P[0::2], P[1::2]))
+    P_forward = P[:-1]
+    p_penultimate, p_last = P[-1]
     
-    # Save P as a tuple since working with tuples is slightly faster
-    self.P = P = tuple(P)
-        
     for box in S:
       for i in range(0, 256, 2):
-        L, R = encrypt(L, R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+        for p1, p2 in P_forward:
+          L ^= p1
+          R ^= (S1[L >> 24] + S2[L >> 16 & 0xff] ^ S3[L >> 8 & 0xff]) \
+            + S4[L & 0xff] & 0xffffffff
+          R ^= p2
+          L ^= (S1[R >> 24] + S2[R >> 16 & 0xff] ^ S3[R >> 8 & 0xff]) \
+            + S4[R & 0xff] & 0xffffffff
+        L, R = R ^ p_last, L ^ p_penultimate
         box[i] = L
         box[i + 1] = R
     
-    # Save S
-    self.S = tuple(tuple(box) for box in S)
+    return P, tuple(tuple(box) for box in S)
     
-  @staticmethod
-  def _encrypt(L, R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack):
-    for p1, p2 in P[:-1]:
-      L ^= p1
-      a, b, c, d = u1_4_unpack(u4_1_pack(L))
-      R ^= (S1[a] + S2[b] ^ S3[c]) + S4[d] & 0xffffffff
-      R ^= p2
-      a, b, c, d = u1_4_unpack(u4_1_pack(R))
-      L ^= (S1[a] + S2[b] ^ S3[c]) + S4[d] & 0xffffffff
-    p_penultimate, p_last = P[-1]
-    return R ^ p_last, L ^ p_penultimate
+  def _iter_unpack_padded(self, data, padding):
+    """
+    Return an iterator over the pairs of 32-bit integers of the blocks of
+    `data` that need no padding, and the padded last block as a pair of 32-bit
+    integers (or ``None`` if the scheme does not need one).
+    """
+    data = memoryview(data).cast("B")
+    last_block_start_i = len(data) - len(data) % 8
+    
+    last_block = _pad_block(data[last_block_start_i:], padding)
+    if last_block is not None:
+      last_block = self._u4_2_unpack(last_block)
+    
+    return self._u4_2_iter_unpack(data[0:last_block_start_i]), last_block
   
-  @staticmethod
-  def _decrypt(L, R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack):
-    for p2, p1 in P[:0:-1]:
-      L ^= p1
-      a, b, c, d = u1_4_unpack(u4_1_pack(L))
-      R ^= (S1[a] + S2[b] ^ S3[c]) + S4[d] & 0xffffffff
-      R ^= p2
-      a, b, c, d = u1_4_unpack(u4_1_pack(R))
-      L ^= (S1[a] + S2[b] ^ S3[c]) + S4[d] & 0xffffffff
-    p_first, p_second = P[0]
-    return R ^ p_first, L ^ p_second
+  def _iter_unpack_padded_last(self, data, padding):
+    """
+    Return an iterator over the pairs of 32-bit integers of all the blocks of
+    padded `data` except the last, and the last block as a pair of 32-bit
+    integers (or ``None`` if `data` is empty and the scheme allows it).
+    """
+    if padding not in PADDING_SCHEMES:
+      raise ValueError("unknown padding scheme {!r}".format(padding))
+    
+    data = memoryview(data).cast("B")
+    data_len = len(data)
+    if data_len % 8:
+      raise ValueError("data is not a multiple of the block-size in length")
+    
+    if not data_len:
+      if padding != "zero":
+        raise ValueError("invalid padding")
+      return iter(()), None
+    
+    return (
+      self._u4_2_iter_unpack(data[0:data_len - 8]),
+      self._u4_2_unpack(data[data_len - 8:])
+    )
   
   def encrypt_block(self, block):
     """
@@ -431,26 +726,12 @@ class Cipher(object):
     `block` should be a :obj:`bytes`-like object with exactly 8 bytes.
     If it is not, a :exc:`ValueError` exception is raised.
     """
-    S0, S1, S2, S3 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
-    
     try:
       L, R = self._u4_2_unpack(block)
     except struct_error:
       raise ValueError("block is not 8 bytes in length")
     
-    for p1, p2 in P[:-1]:
-      L ^= p1
-      a, b, c, d = u1_4_unpack(u4_1_pack(L))
-      R ^= (S0[a] + S1[b] ^ S2[c]) + S3[d] & 0xffffffff
-      R ^= p2
-      a, b, c, d = u1_4_unpack(u4_1_pack(R))
-      L ^= (S0[a] + S1[b] ^ S2[c]) + S3[d] & 0xffffffff
-    p_penultimate, p_last = P[-1]
-    return self._u4_2_pack(R ^ p_last, L ^ p_penultimate)
+    return self._u4_2_pack(*self._encrypt(L, R))
   
   def decrypt_block(self, block):
     """
@@ -459,34 +740,113 @@ class Cipher(object):
     `block` should be a :obj:`bytes`-like object with exactly 8 bytes.
     If it is not, a :exc:`ValueError` exception is raised.
     """
-    S0, S1, S2, S3 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
-    
     try:
       L, R = self._u4_2_unpack(block)
     except struct_error:
       raise ValueError("block is not 8 bytes in length")
     
-    for p2, p1 in P[:0:-1]:
-      L ^= p1
-      a, b, c, d = u1_4_unpack(u4_1_pack(L))
-      R ^= (S0[a] + S1[b] ^ S2[c]) + S3[d] & 0xffffffff
-      R ^= p2
-      a, b, c, d = u1_4_unpack(u4_1_pack(R))
-      L ^= (S0[a] + S1[b] ^ S2[c]) + S3[d] & 0xffffffff
-    p_first, p_second = P[0]
-    return self._u4_2_pack(R ^ p_first, L ^ p_second)
+    return self._u4_2_pack(*self._decrypt(L, R))
+  
+  def encrypt_u64(self, n):
+    """
+    Return the encryption of a 64-bit unsigned integer `n` as an integer.
+    
+    This is the same as encrypting ``n.to_bytes(8, byte_order)`` with
+    :meth:`encrypt_block` and converting the result back to an integer with
+    the same byte order, but without going through :obj:`bytes` objects.
+    It's handy for turning sequential IDs into opaque ones.
+    
+    If `n` is not between 0 and 2^64 - 1, a :exc:`ValueError` exception is
+    raised.
+    """
+    if not 0 <= n <= 0xffffffffffffffff:
+      raise ValueError("n is not a 64-bit unsigned integer")
+    if self.byte_order == "big":
+      L, R = self._encrypt(n >> 32, n & 0xffffffff)
+      return L << 32 | R
+    L, R = self._encrypt(n & 0xffffffff, n >> 32)
+    return L | R << 32
+  
+  def decrypt_u64(self, n):
+    """
+    Return the decryption of a 64-bit unsigned integer `n` as an integer.
+    
+    This is the inverse of :meth:`encrypt_u64`.
+    
+    If `n` is not between 0 and 2^64 - 1, a :exc:`ValueError` exception is
+    raised.
+    """
+    if not 0 <= n <= 0xffffffffffffffff:
+      raise ValueError("n is not a 64-bit unsigned integer")
+    if self.byte_order == "big":
+      L, R = self._decrypt(n >> 32, n & 0xffffffff)
+      return L << 32 | R
+    L, R = self._decrypt(n & 0xffffffff, n >> 32)
+    return L | R << 32
+  
+  def _crypt_u64s(self, crypt_pair, values):
+    """
+    Return an iterator over 64-bit unsigned integers `values` encrypted or
+    decrypted (depending on `crypt_pair`) as in :meth:`encrypt_u64`.
+    """
+    if self.byte_order == "big":
+      for n in values:
+        L, R = crypt_pair(n >> 32, n & 0xffffffff)
+        yield L << 32 | R
+    else:
+      for n in values:
+        L, R = crypt_pair(n & 0xffffffff, n >> 32)
+        yield L | R << 32
+  
+  def _crypt_u64_array(self, crypt_pair, values):
+    """
+    Return `values` encrypted or decrypted (depending on `crypt_pair`) as in
+    :meth:`encrypt_u64_array`.
+    """
+    if isinstance(values, array):
+      if values.typecode not in "QL" or values.itemsize != 8:
+        raise ValueError("array is not of 64-bit unsigned integers")
+      return array(values.typecode, self._crypt_u64s(crypt_pair, values))
+    
+    if hasattr(values, "dtype"):
+      # NumPy arrays (or look-alikes), without having to import NumPy.
+      if values.dtype.kind != "u" or values.dtype.itemsize != 8:
+        raise ValueError("array dtype is not uint64")
+      if values.ndim != 1:
+        raise ValueError("array is not one-dimensional")
+      result = values.copy()
+      result[:] = list(self._crypt_u64s(crypt_pair, values.tolist()))
+      return result
+    
+    return list(self._crypt_u64s(crypt_pair, values))
+  
+  def encrypt_u64_array(self, values):
+    """
+    Return a sequence of 64-bit unsigned integers `values` each encrypted with
+    :meth:`encrypt_u64`, of the same type as `values`.
+    
+    `values` can be an :class:`array.array` object of unsigned 64-bit integers
+    (typecode ``"Q"``), a one-dimensional NumPy ``uint64`` array or any other
+    iterable of integers (in which case a :obj:`list` is returned).
+    """
+    return self._crypt_u64_array(self._encrypt, values)
+  
+  def decrypt_u64_array(self, values):
+    """
+    Return a sequence of 64-bit unsigned integers `values` each decrypted with
+    :meth:`decrypt_u64`, of the same type as `values`.
     
-  def encrypt_ecb(self, data):
+    `values` is the same as in :meth:`encrypt_u64_array`.
+    """
+    return self._crypt_u64_array(self._decrypt, values)
+  
+  def encrypt_ecb(self, data, padding = None):
     """
     Return an iterator that encrypts `data` using the Electronic Codebook (ECB)
     mode of operation.
     
     ECB mode can only operate on `data` that is a multiple of the block-size
-    in length.
+    in length, unless a `padding` scheme is used.
     
     Each iteration returns a block-sized :obj:`bytes` object (i.e. 8 bytes)
     containing the encrypted bytes of the corresponding block in `data`.
@@ -494,27 +854,38 @@ class Cipher(object):
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or one of the schemes in
+    :data:`blowfish.PADDING_SCHEMES`, in which case `data` can be of any length
+    and is padded internally, without being copied.
+    """
     encrypt = self._encrypt
+    if self.block_cache is not None:
+      encrypt = self.block_cache.encrypt_function(encrypt)
     
     u4_2_pack = self._u4_2_pack
     
-    try:
-      LR_iter = self._u4_2_iter_unpack(data)
-    except struct_error:
-      raise ValueError("data is not a multiple of the block-size in length")
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded(data, padding)
     
     for plain_L, plain_R in LR_iter:
       yield u4_2_pack(
-        *encrypt(plain_L, plain_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+        *encrypt(plain_L, plain_R)
       )
     
-  def decrypt_ecb(self, data):
+    if last_block is not None:
+      plain_L, plain_R = last_block
+      yield u4_2_pack(
+        *encrypt(plain_L, plain_R)
+      )
+    
+  def decrypt_ecb(self, data, padding = None):
     """
     Return an iterator that decrypts `data` using the Electronic Codebook (ECB)
     mode of operation.
@@ -524,28 +895,45 @@ class Cipher(object):
     
     Each iteration returns a block-sized :obj:`bytes` object (i.e. 8 bytes)
     containing the decrypted bytes of the corresponding block in `data`.
+    If `padding` is used, the last iteration returns the last block with the
+    padding removed instead.
     
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or the scheme in
+    :data:`blowfish.PADDING_SCHEMES` that `data` was padded with.
+    If the padding turns out to be invalid, a :exc:`ValueError` exception is
+    raised once the last block is reached.
+    """
     decrypt = self._decrypt
+    if self.block_cache is not None:
+      decrypt = self.block_cache.decrypt_function(decrypt)
     
     u4_2_pack = self._u4_2_pack
     
-    try:
-      LR_iter = self._u4_2_iter_unpack(data)
-    except struct_error:
-      raise ValueError("data is not a multiple of the block-size in length")
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded_last(data, padding)
     
     for cipher_L, cipher_R in LR_iter:
       yield u4_2_pack(
-        *decrypt(cipher_L, cipher_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+        *decrypt(cipher_L, cipher_R)
+      )
+    
+    if last_block is not None:
+      cipher_L, cipher_R = last_block
+      yield _unpad_block(
+        u4_2_pack(
+          *decrypt(cipher_L, cipher_R)
+        ),
+        padding
       )
       
   def encrypt_ecb_cts(self, data):
@@ -569,27 +957,24 @@ class Cipher(object):
     if data_len <= 8:
       raise ValueError("data is not greater than 8 bytes in length")
       
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     u4_2_pack = self._u4_2_pack
     u4_2_unpack = self._u4_2_unpack
     encrypt = self._encrypt
+    if self.block_cache is not None:
+      encrypt = self.block_cache.encrypt_function(encrypt)
     
     extra_bytes = data_len % 8
     last_block_stop_i = data_len - extra_bytes
     
     plain_L, plain_R = u4_2_unpack(data[0:8])
     cipher_block = u4_2_pack(
-      *encrypt(plain_L, plain_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+      *encrypt(plain_L, plain_R)
     )
     
     for plain_L, plain_R in self._u4_2_iter_unpack(data[8:last_block_stop_i]):
       yield cipher_block
       cipher_block = u4_2_pack(
-        *encrypt(plain_L, plain_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+        *encrypt(plain_L, plain_R)
       )
     
     plain_L, plain_R = u4_2_unpack(
@@ -597,7 +982,7 @@ class Cipher(object):
     )
     
     yield u4_2_pack(
-      *encrypt(plain_L, plain_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+      *encrypt(plain_L, plain_R)
     )
     yield cipher_block[:extra_bytes]
     
@@ -622,27 +1007,24 @@ class Cipher(object):
     if data_len <= 8:
       raise ValueError("data is not greater than 8 bytes in length")
       
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     u4_2_pack = self._u4_2_pack
     u4_2_unpack = self._u4_2_unpack
     decrypt = self._decrypt
+    if self.block_cache is not None:
+      decrypt = self.block_cache.decrypt_function(decrypt)
     
     extra_bytes = data_len % 8
     last_block_stop_i = data_len - extra_bytes
         
     cipher_L, cipher_R = u4_2_unpack(data[0:8])
     plain_block = u4_2_pack(
-      *decrypt(cipher_L, cipher_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+      *decrypt(cipher_L, cipher_R)
     )
     
     for cipher_L, cipher_R in self._u4_2_iter_unpack(data[8:last_block_stop_i]):
       yield plain_block
       plain_block = u4_2_pack(
-        *decrypt(cipher_L, cipher_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+        *decrypt(cipher_L, cipher_R)
       )
     
     cipher_L, cipher_R = u4_2_unpack(
@@ -650,17 +1032,17 @@ class Cipher(object):
     )
     
     yield u4_2_pack(
-      *decrypt(cipher_L, cipher_R, P, S1, S2, S3, S4, u4_1_pack, u1_4_unpack)
+      *decrypt(cipher_L, cipher_R)
     )
     yield plain_block[:extra_bytes]
     
-  def encrypt_cbc(self, data, init_vector):
+  def encrypt_cbc(self, data, init_vector, padding = None):
     """
     Return an iterator that encrypts `data` using the Cipher-Block Chaining
     (CBC) mode of operation.
     
     CBC mode can only operate on `data` that is a multiple of the block-size
-    in length.
+    in length, unless a `padding` scheme is used.
     
     Each iteration returns a block-sized :obj:`bytes` object (i.e. 8 bytes)
     containing the encrypted bytes of the corresponding block in `data`.
@@ -672,12 +1054,11 @@ class Cipher(object):
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or one of the schemes in
+    :data:`blowfish.PADDING_SCHEMES`, in which case `data` can be of any length
+    and is padded internally, without being copied.
+    """
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -687,21 +1068,29 @@ class Cipher(object):
     except struct_error:
       raise ValueError("initialization vector is not 8 bytes in length")
     
-    try:
-      LR_iter = self._u4_2_iter_unpack(data)
-    except struct_error:
-      raise ValueError("data is not a multiple of the block-size in length")
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded(data, padding)
     
     for plain_L, plain_R in LR_iter:
       prev_cipher_L, prev_cipher_R = encrypt(
         prev_cipher_L ^ plain_L,
-        prev_cipher_R ^ plain_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
+        prev_cipher_R ^ plain_R
       )
       yield u4_2_pack(prev_cipher_L, prev_cipher_R)
+    
+    if last_block is not None:
+      plain_L, plain_R = last_block
+      yield u4_2_pack(
+        *encrypt(prev_cipher_L ^ plain_L, prev_cipher_R ^ plain_R)
+      )
   
-  def decrypt_cbc(self, data, init_vector):
+  def decrypt_cbc(self, data, init_vector, padding = None):
     """
     Return an iterator that decrypts `data` using the Cipher-Block Chaining
     (CBC) mode of operation.
@@ -719,12 +1108,13 @@ class Cipher(object):
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or the scheme in
+    :data:`blowfish.PADDING_SCHEMES` that `data` was padded with, in which
+    case the last iteration returns the last block with the padding removed.
+    If the padding turns out to be invalid, a :exc:`ValueError` exception is
+    raised once the last block is reached.
+    """
     decrypt = self._decrypt
     
     u4_2_pack = self._u4_2_pack
@@ -734,17 +1124,77 @@ class Cipher(object):
     except struct_error:
       raise ValueError("initialization vector is not 8 bytes in length")
     
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded_last(data, padding)
+    
+    for cipher_L, cipher_R in LR_iter:
+      L, R = decrypt(cipher_L, cipher_R)
+      yield u4_2_pack(prev_cipher_L ^ L, prev_cipher_R ^ R)
+      prev_cipher_L = cipher_L
+      prev_cipher_R = cipher_R
+    
+    if last_block is not None:
+      cipher_L, cipher_R = last_block
+      L, R = decrypt(cipher_L, cipher_R)
+      yield _unpad_block(
+        u4_2_pack(prev_cipher_L ^ L, prev_cipher_R ^ R),
+        padding
+      )
+      
+  def decrypt_cbc_range(self, data, init_vector, start_block, stop_block):
+    """
+    Return an iterator that decrypts only blocks `start_block` (inclusive) to
+    `stop_block` (exclusive) of `data` using the Cipher-Block Chaining (CBC)
+    mode of operation.
+    
+    In CBC mode, decrypting a block only requires the ciphertext block before
+    it, so the time taken is proportional to the number of blocks decrypted,
+    not to where they are in `data`. This makes it suitable to serve ranges of
+    large ciphertexts (e.g. :class:`mmap.mmap` objects), since only the
+    requested blocks (plus the one before them) are read.
+    
+    Each iteration returns a block-sized :obj:`bytes` object (i.e. 8 bytes)
+    containing the decrypted bytes of the corresponding block in the range.
+    
+    `init_vector` and `data` are the same as in :meth:`decrypt_cbc`.
+    
+    `start_block` and `stop_block` are block (not byte) indexes and should
+    not be negative. Like a slice, `stop_block` can be ``None`` or past the
+    end of `data`, in which case it is taken to be the end of `data`.
+    """
+    decrypt = self._decrypt
+    
+    u4_2_pack = self._u4_2_pack
+    
     try:
-      LR_iter = self._u4_2_iter_unpack(data)
+      prev_cipher_L, prev_cipher_R = self._u4_2_unpack(init_vector)
     except struct_error:
+      raise ValueError("initialization vector is not 8 bytes in length")
+    
+    data = memoryview(data).cast("B")
+    data_len = len(data)
+    if data_len % 8:
       raise ValueError("data is not a multiple of the block-size in length")
     
-    for cipher_L, cipher_R in LR_iter:
-      L, R = decrypt(
-        cipher_L, cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+    start_i, stop_i = _block_range(data_len, start_block, stop_block)
+    
+    if start_i:
+      # The ciphertext block before the range takes the place of the IV.
+      try:
+        prev_cipher_L, prev_cipher_R = self._u4_2_unpack(
+          data[start_i - 8:start_i]
+        )
+      except struct_error:
+        raise ValueError("block before the range is not 8 bytes in length")
+    
+    for cipher_L, cipher_R in self._u4_2_iter_unpack(data[start_i:stop_i]):
+      L, R = decrypt(cipher_L, cipher_R)
       yield u4_2_pack(prev_cipher_L ^ L, prev_cipher_R ^ R)
       prev_cipher_L = cipher_L
       prev_cipher_R = cipher_R
@@ -774,11 +1224,6 @@ class Cipher(object):
     if data_len <= 8:
       raise ValueError("data is not greater than 8 bytes in length")
     
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     u4_2_pack = self._u4_2_pack
     u4_2_unpack = self._u4_2_unpack
     encrypt = self._encrypt
@@ -794,9 +1239,7 @@ class Cipher(object):
     plain_L, plain_R = u4_2_unpack(data[0:8])
     prev_cipher_L, prev_cipher_R = encrypt(
       plain_L ^ prev_cipher_L,
-      plain_R ^ prev_cipher_R,
-      P, S1, S2, S3, S4,
-      u4_1_pack, u1_4_unpack
+      plain_R ^ prev_cipher_R
     )
     cipher_block = u4_2_pack(prev_cipher_L, prev_cipher_R)
     
@@ -804,21 +1247,14 @@ class Cipher(object):
       yield cipher_block
       prev_cipher_L, prev_cipher_R = encrypt(
         plain_L ^ prev_cipher_L,
-        plain_R ^ prev_cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
+        plain_R ^ prev_cipher_R
       )
       cipher_block = u4_2_pack(prev_cipher_L, prev_cipher_R)
     
     P_L, P_R = u4_2_unpack(data[last_block_stop_i:] + bytes(8 - extra_bytes))
     
     yield u4_2_pack(
-      *encrypt(
-        prev_cipher_L ^ P_L,
-        prev_cipher_R ^ P_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      *encrypt(prev_cipher_L ^ P_L, prev_cipher_R ^ P_R)
     )
     
     yield cipher_block[:extra_bytes]
@@ -848,11 +1284,6 @@ class Cipher(object):
     if data_len <= 8:
       raise ValueError("data is not greater than 8 bytes in length")
     
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     u4_2_pack = self._u4_2_pack
     u4_2_unpack = self._u4_2_unpack
     decrypt = self._decrypt
@@ -869,43 +1300,31 @@ class Cipher(object):
     for cipher_L, cipher_R in self._u4_2_iter_unpack(
       data[0:last_block_start_i]
     ):
-      L, R = decrypt(
-        cipher_L, cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      L, R = decrypt(cipher_L, cipher_R)
       yield u4_2_pack(L ^ prev_cipher_L, R ^ prev_cipher_R)
       prev_cipher_L = cipher_L
       prev_cipher_R = cipher_R
     
     cipher_L, cipher_R = u4_2_unpack(data[last_block_start_i:last_block_stop_i])
-    L, R = decrypt(
-      cipher_L, cipher_R,
-      P, S1, S2, S3, S4,
-      u4_1_pack, u1_4_unpack
-    )
+    L, R = decrypt(cipher_L, cipher_R)
     
     C_L, C_R = u4_2_unpack(data[last_block_stop_i:] + bytes(8 - extra_bytes))
     
     Xn = u4_2_pack(L ^ C_L, R ^ C_R)
     
     E_L, E_R = u4_2_unpack(data[last_block_stop_i:] + Xn[extra_bytes:])
-    L, R = decrypt(
-      E_L, E_R,
-      P, S1, S2, S3, S4,
-      u4_1_pack, u1_4_unpack
-    )
+    L, R = decrypt(E_L, E_R)
     yield u4_2_pack(L ^ prev_cipher_L, R ^ prev_cipher_R)
      
     yield Xn[:extra_bytes]
     
-  def encrypt_pcbc(self, data, init_vector):
+  def encrypt_pcbc(self, data, init_vector, padding = None):
     """
     Return an iterator that encrypts `data` using the Propagating Cipher-Block
     Chaining (PCBC) mode of operation.
     
     PCBC mode can only operate on `data` that is a multiple of the block-size
-    in length.
+    in length, unless a `padding` scheme is used.
     
     Each iteration returns a block-sized :obj:`bytes` object (i.e. 8 bytes)
     containing the encrypted bytes of the corresponding block in `data`.
@@ -917,12 +1336,11 @@ class Cipher(object):
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or one of the schemes in
+    :data:`blowfish.PADDING_SCHEMES`, in which case `data` can be of any length
+    and is padded internally, without being copied.
+    """
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -932,22 +1350,28 @@ class Cipher(object):
     except struct_error:
       raise ValueError("initialization vector is not 8 bytes in length")
     
-    try:
-      LR_iter = self._u4_2_iter_unpack(data)
-    except struct_error:
-      raise ValueError("data is not a multiple of the block-size in length")
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded(data, padding)
     
     for plain_L, plain_R in LR_iter:
-      cipher_L, cipher_R = encrypt(
-        init_L ^ plain_L, init_R ^ plain_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      cipher_L, cipher_R = encrypt(init_L ^ plain_L, init_R ^ plain_R)
       yield u4_2_pack(cipher_L, cipher_R)
       init_L = plain_L ^ cipher_L
       init_R = plain_R ^ cipher_R
     
-  def decrypt_pcbc(self, data, init_vector):
+    if last_block is not None:
+      plain_L, plain_R = last_block
+      yield u4_2_pack(
+        *encrypt(init_L ^ plain_L, init_R ^ plain_R)
+      )
+    
+  def decrypt_pcbc(self, data, init_vector, padding = None):
     """
     Return an iterator that decrypts `data` using the Propagating Cipher-Block
     Chaining (PCBC) mode of operation.
@@ -965,12 +1389,13 @@ class Cipher(object):
     `data` should be a :obj:`bytes`-like object that is a multiple of the
     block-size in length (i.e. 8, 16, 32, etc.).
     If it is not, a :exc:`ValueError` exception is raised.
-    """
-    S1, S2, S3, S4 = self.S
-    P = self.P
     
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
+    `padding` should be ``None`` or the scheme in
+    :data:`blowfish.PADDING_SCHEMES` that `data` was padded with, in which
+    case the last iteration returns the last block with the padding removed.
+    If the padding turns out to be invalid, a :exc:`ValueError` exception is
+    raised once the last block is reached.
+    """
     decrypt = self._decrypt
     
     u4_2_pack = self._u4_2_pack
@@ -980,23 +1405,46 @@ class Cipher(object):
     except struct_error:
       raise ValueError("initialization vector is not 8 bytes in length")
     
-    try:
-      LR_iter = self._u4_2_iter_unpack(data)
-    except struct_error:
-      raise ValueError("data is not a multiple of the block-size in length")
+    if padding is None:
+      try:
+        LR_iter = self._u4_2_iter_unpack(data)
+      except struct_error:
+        raise ValueError("data is not a multiple of the block-size in length")
+      last_block = None
+    else:
+      LR_iter, last_block = self._iter_unpack_padded_last(data, padding)
     
     for cipher_L, cipher_R in LR_iter:
-      plain_L, plain_R = decrypt(
-        cipher_L, cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      plain_L, plain_R = decrypt(cipher_L, cipher_R)
       plain_L ^= init_L
       plain_R ^= init_R
       yield u4_2_pack(plain_L, plain_R)
       init_L = cipher_L ^ plain_L
       init_R = cipher_R ^ plain_R
     
+    if last_block is not None:
+      cipher_L, cipher_R = last_block
+      plain_L, plain_R = decrypt(cipher_L, cipher_R)
+      yield _unpad_block(u4_2_pack(plain_L ^ init_L, plain_R ^ init_R), padding)
+    
+  def decrypt_pcbc_range(self, data, init_vector, start_block, stop_block):
+    """
+    Random-access decryption is not supported by the Propagating Cipher-Block
+    Chaining (PCBC) mode of operation, since decrypting a block requires the
+    plaintext of the block before it, and hence of all blocks before it.
+    
+    A :exc:`ValueError` exception is always raised. Use
+    :meth:`decrypt_pcbc` and skip the blocks that are not needed instead.
+    
+    .. seealso::
+    
+        :meth:`decrypt_cbc_range` & :meth:`decrypt_cfb_range`
+    """
+    raise ValueError(
+      "PCBC mode does not support random-access decryption, since every block "
+      "depends on the plaintext of all the blocks before it"
+    )
+    
   def encrypt_cfb(self, data, init_vector):
     """
     Return an iterator that encrypts `data` using the Cipher Feedback (CFB)
@@ -1015,11 +1463,6 @@ class Cipher(object):
     
     `data` should be a :obj:`bytes`-like object (of any length).
     """
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -1036,11 +1479,7 @@ class Cipher(object):
     for plain_L, plain_R in self._u4_2_iter_unpack(
       data[0:last_block_stop_i]
     ):
-      prev_cipher_L, prev_cipher_R = encrypt(
-        prev_cipher_L, prev_cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )      
+      prev_cipher_L, prev_cipher_R = encrypt(prev_cipher_L, prev_cipher_R)
       prev_cipher_L ^= plain_L
       prev_cipher_R ^= plain_R
       yield u4_2_pack(prev_cipher_L, prev_cipher_R)
@@ -1050,11 +1489,7 @@ class Cipher(object):
         b ^ n for b, n in zip(
           data[last_block_stop_i:],
           u4_2_pack(
-            *encrypt(
-              prev_cipher_L, prev_cipher_R,
-              P, S1, S2, S3, S4,
-              u4_1_pack, u1_4_unpack
-            )
+            *encrypt(prev_cipher_L, prev_cipher_R)
           )
         )
       )
@@ -1077,11 +1512,6 @@ class Cipher(object):
     
     `data` should be a :obj:`bytes`-like object (of any length).
     """
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -1098,11 +1528,7 @@ class Cipher(object):
     for cipher_L, cipher_R in self._u4_2_iter_unpack(
       data[0:last_block_stop_i]
     ):
-      prev_cipher_L, prev_cipher_R = encrypt(
-        prev_cipher_L, prev_cipher_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )      
+      prev_cipher_L, prev_cipher_R = encrypt(prev_cipher_L, prev_cipher_R)
       yield u4_2_pack(prev_cipher_L ^ cipher_L, prev_cipher_R ^ cipher_R)
       prev_cipher_L = cipher_L
       prev_cipher_R = cipher_R
@@ -1112,11 +1538,72 @@ class Cipher(object):
         b ^ n for b, n in zip(
           data[last_block_stop_i:],
           u4_2_pack(
-            *encrypt(
-              prev_cipher_L, prev_cipher_R,
-              P, S1, S2, S3, S4,
-              u4_1_pack, u1_4_unpack
-            )
+            *encrypt(prev_cipher_L, prev_cipher_R)
+          )
+        )
+      )
+      
+  def decrypt_cfb_range(self, data, init_vector, start_block, stop_block):
+    """
+    Return an iterator that decrypts only blocks `start_block` (inclusive) to
+    `stop_block` (exclusive) of `data` using the Cipher Feedback (CFB) mode of
+    operation.
+    
+    In CFB mode, decrypting a block only requires the ciphertext block before
+    it, so the time taken is proportional to the number of blocks decrypted,
+    not to where they are in `data`. This makes it suitable to serve ranges of
+    large ciphertexts (e.g. :class:`mmap.mmap` objects), since only the
+    requested blocks (plus the one before them) are read.
+    
+    Each iteration, except the last, always returns a block-sized :obj:`bytes`
+    object (i.e. 8 bytes). The last iteration may return a :obj:`bytes` object
+    with a length less than the block-size, if the range includes the last
+    block of `data` and `data` is not a multiple of the block-size in length.
+    
+    `init_vector` and `data` are the same as in :meth:`decrypt_cfb`.
+    
+    `start_block` and `stop_block` are block (not byte) indexes and should
+    not be negative. Like a slice, `stop_block` can be ``None`` or past the
+    end of `data`, in which case it is taken to be the end of `data`. A
+    trailing partial block counts as a block.
+    """
+    encrypt = self._encrypt
+    
+    u4_2_pack = self._u4_2_pack
+    
+    try:
+      prev_cipher_L, prev_cipher_R = self._u4_2_unpack(init_vector)
+    except struct_error:
+      raise ValueError("initialization vector is not 8 bytes in length")
+    
+    data = memoryview(data).cast("B")
+    start_i, stop_i = _block_range(len(data), start_block, stop_block)
+    last_block_stop_i = stop_i - (stop_i - start_i) % 8
+    
+    # The ciphertext block before the range takes the place of the IV (when
+    # `start_block` is past the end of `data`, the range is empty).
+    if 0 < start_i < stop_i:
+      try:
+        prev_cipher_L, prev_cipher_R = self._u4_2_unpack(
+          data[start_i - 8:start_i]
+        )
+      except struct_error:
+        raise ValueError("block before the range is not 8 bytes in length")
+    
+    for cipher_L, cipher_R in self._u4_2_iter_unpack(
+      data[start_i:last_block_stop_i]
+    ):
+      prev_cipher_L, prev_cipher_R = encrypt(prev_cipher_L, prev_cipher_R)
+      yield u4_2_pack(prev_cipher_L ^ cipher_L, prev_cipher_R ^ cipher_R)
+      prev_cipher_L = cipher_L
+      prev_cipher_R = cipher_R
+      
+    if last_block_stop_i != stop_i:
+      yield bytes(
+        b ^ n for b, n in zip(
+          data[last_block_stop_i:stop_i],
+          u4_2_pack(
+            *encrypt(prev_cipher_L, prev_cipher_R)
           )
         )
       )
@@ -1139,11 +1626,6 @@ class Cipher(object):
     
     `data` should be a :obj:`bytes`-like object (of any length).
     """
-    S1, S2, S3, S4 = self.S
-    P = self.P
-
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -1160,11 +1642,7 @@ class Cipher(object):
     for plain_L, plain_R in self._u4_2_iter_unpack(
       data[0:last_block_stop_i]
     ):
-      prev_L, prev_R = encrypt(
-        prev_L, prev_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      prev_L, prev_R = encrypt(prev_L, prev_R)
       yield u4_2_pack(plain_L ^ prev_L, plain_R ^ prev_R)
     
     if extra_bytes:
@@ -1172,11 +1650,7 @@ class Cipher(object):
         b ^ n for b, n in zip(
           data[last_block_stop_i:],
           u4_2_pack(
-            *encrypt(
-              prev_L, prev_R,
-              P, S1, S2, S3, S4,
-              u4_1_pack, u1_4_unpack
-            )
+            *encrypt(prev_L, prev_R)
           )
         )
       )
@@ -1185,7 +1659,7 @@ class Cipher(object):
     """
     Return an iterator that decrypts `data` using the Output Feedback (OFB)
     mode of operation.
-
+    
     .. note::
         
         In OFB mode, decrypting is the same as encrypting.
@@ -1193,7 +1667,7 @@ class Cipher(object):
         :meth:`encrypt_ofb`.
         
     .. seealso::
-
+        
         :meth:`encrypt_ofb`
      """
     return self.encrypt_ofb(data, init_vector)
@@ -1221,11 +1695,6 @@ class Cipher(object):
     
     `data` should be a :obj:`bytes`-like object (of any length).
     """
-    S1, S2, S3, S4 = self.S
-    P = self.P
-    
-    u4_1_pack = self._u4_1_pack
-    u1_4_unpack = self._u1_4_unpack
     encrypt = self._encrypt
     
     u4_2_pack = self._u4_2_pack
@@ -1246,11 +1715,7 @@ class Cipher(object):
       except struct_error:
         raise ValueError("integer in counter is not less than 2^64")
       
-      counter_L, counter_R = encrypt(
-        counter_L, counter_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      counter_L, counter_R = encrypt(counter_L, counter_R)
       yield u4_2_pack(plain_L ^ counter_L, plain_R ^ counter_R)
       
     if extra_bytes:
@@ -1259,11 +1724,7 @@ class Cipher(object):
       except struct_error:
         raise ValueError("integer in counter is not less than 2^64")
       
-      counter_L, counter_R = encrypt(
-        counter_L, counter_R,
-        P, S1, S2, S3, S4,
-        u4_1_pack, u1_4_unpack
-      )
+      counter_L, counter_R = encrypt(counter_L, counter_R)
       yield bytes(
         b ^ n for b, n in zip(
           data[last_block_stop_i:],
@@ -1287,7 +1748,3753 @@ class Cipher(object):
         :meth:`encrypt_ctr`
     """
     return self.encrypt_ctr(data, counter)
+  
+  def encrypt_cbc_cmac(self, data, init_vector, mac):
+    """
+    Return an iterator that encrypts `data` using the Cipher-Block Chaining
+    (CBC) mode of operation and feeds the resulting ciphertext to `mac`.
+    
+    The ciphertext is exactly the same as that of :meth:`encrypt_cbc`.
+    Each block is authenticated as soon as it is encrypted, so `data` is only
+    traversed once. When the iterator is exhausted, ``mac.digest()`` returns
+    the tag of all the ciphertext fed to `mac` so far.
+    
+    `mac` should be a :class:`CMAC` object. It should not be keyed with the
+    same key as this cipher.
+    
+    `init_vector` and `data` are the same as in :meth:`encrypt_cbc`.
+    """
+    return self._mac_output(self.encrypt_cbc(data, init_vector), mac)
+  
+  def decrypt_cbc_cmac(self, data, init_vector, mac):
+    """
+    Return an iterator that decrypts `data` using the Cipher-Block Chaining
+    (CBC) mode of operation and feeds `data` (i.e. the ciphertext) to `mac`.
+    
+    The plaintext is exactly the same as that of :meth:`decrypt_cbc`.
+    Each block is authenticated as it is decrypted, so `data` is only
+    traversed once. When the iterator is exhausted, ``mac.verify(tag)`` can be
+    used to check the ciphertext against the expected `tag`.
+    
+    .. warning::
+        
+        The returned plaintext has not been authenticated until the iterator
+        is exhausted and the tag verified, so it should not be acted upon
+        before then.
+    
+    `mac` should be a :class:`CMAC` object. It should not be keyed with the
+    same key as this cipher.
+    
+    `init_vector` and `data` are the same as in :meth:`decrypt_cbc`.
+    """
+    return self._mac_input(
+      self.decrypt_cbc(data, init_vector), data, mac
+    )
+  
+  def encrypt_ctr_cmac(self, data, counter, mac):
+    """
+    Return an iterator that encrypts `data` using the Counter (CTR) mode of
+    operation and feeds the resulting ciphertext to `mac`.
+    
+    The ciphertext is exactly the same as that of :meth:`encrypt_ctr`.
+    Each block is authenticated as soon as it is encrypted, so `data` is only
+    traversed once. When the iterator is exhausted, ``mac.digest()`` returns
+    the tag of all the ciphertext fed to `mac` so far.
+    
+    `mac` should be a :class:`CMAC` object. It should not be keyed with the
+    same key as this cipher.
+    
+    `counter` and `data` are the same as in :meth:`encrypt_ctr`.
+    """
+    return self._mac_output(self.encrypt_ctr(data, counter), mac)
+  
+  def decrypt_ctr_cmac(self, data, counter, mac):
+    """
+    Return an iterator that decrypts `data` using the Counter (CTR) mode of
+    operation and feeds `data` (i.e. the ciphertext) to `mac`.
+    
+    The plaintext is exactly the same as that of :meth:`decrypt_ctr`.
+    Each block is authenticated as it is decrypted, so `data` is only
+    traversed once. When the iterator is exhausted, ``mac.verify(tag)`` can be
+    used to check the ciphertext against the expected `tag`.
+    
+    .. warning::
+        
+        The returned plaintext has not been authenticated until the iterator
+        is exhausted and the tag verified, so it should not be acted upon
+        before then.
+    
+    `mac` should be a :class:`CMAC` object. It should not be keyed with the
+    same key as this cipher.
+    
+    `counter` and `data` are the same as in :meth:`decrypt_ctr`.
+    """
+    return self._mac_input(self.decrypt_ctr(data, counter), data, mac)
+  
+  @staticmethod
+  def _mac_output(blocks, mac):
+    """
+    Yield each block of `blocks` (the output of a mode of operation) after
+    feeding it to `mac`.
+    """
+    update_block = mac._update_block
+    for block in blocks:
+      update_block(block)
+      yield block
+  
+  @staticmethod
+  def _mac_input(blocks, data, mac):
+    """
+    Yield each block of `blocks` (the output of a mode of operation) after
+    feeding the block of `data` (its input) it was made from to `mac`.
+    """
+    update_block = mac._update_block
+    data = memoryview(data).cast("B")
+    
+    block_start_i = 0
+    for block in blocks:
+      block_stop_i = block_start_i + len(block)
+      update_block(data[block_start_i:block_stop_i])
+      block_start_i = block_stop_i
+      yield block
+  
+  def prepare(self, mode, direction):
+    """
+    Return a function that encrypts or decrypts data in one go using a mode of
+    operation.
+    
+    The returned function takes the same arguments as the corresponding method
+    (e.g. ``(data, init_vector)`` for ``"cbc"``) and returns a single
+    :obj:`bytes` object instead of an iterator. Everything the method would
+    look up on every call (subkeys, S-boxes, structs, etc.) is looked up once,
+    here, making it well suited to encrypting or decrypting many small
+    messages.
+    
+    `mode` should be one of the modes in :data:`blowfish.MODES` (i.e. ``"ecb"``,
+    ``"ecb_cts"``, ``"cbc"``, ``"cbc_cts"``, ``"pcbc"``, ``"cfb"``, ``"ofb"``
+    or ``"ctr"``).
+    
+    `direction` should either be ``"encrypt"`` or ``"decrypt"``.
+    
+    Padding is not supported by the returned functions. The ``"ecb"`` function
+    uses the :attr:`block_cache` the cipher has when this is called.
+    """
+    if direction not in ("encrypt", "decrypt"):
+      raise ValueError("direction must either be 'encrypt' or 'decrypt'")
+    
+    if mode not in MODES:
+      raise ValueError("unknown mode of operation {!r}".format(mode))
+    
+    if self.S12 is not None:
+      encrypt, decrypt = _fused_round_functions(
+        self.P, self.S12, self.S[2], self.S[3]
+      )
+    else:
+      encrypt, decrypt = _round_functions(self.P, *self.S)
+    
+    u4_2_pack = self._u4_2_pack
+    u4_2_unpack = self._u4_2_unpack
+    u4_2_iter_unpack = self._u4_2_iter_unpack
+    u8_1_pack = self._u8_1_pack
+    
+    if mode == "ecb":
+      block_func = encrypt if direction == "encrypt" else decrypt
+      if self.block_cache is not None:
+        block_func = getattr(self.block_cache, direction + "_function")(
+          block_func
+        )
+      
+      def prepared(data):
+        try:
+          LR_iter = u4_2_iter_unpack(data)
+        except struct_error:
+          raise ValueError("data is not a multiple of the block-size in length")
+        return b"".join([u4_2_pack(*block_func(L, R)) for L, R in LR_iter])
+      
+    elif mode == "cbc" and direction == "encrypt":
+      def prepared(data, init_vector):
+        try:
+          prev_cipher_L, prev_cipher_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        try:
+          LR_iter = u4_2_iter_unpack(data)
+        except struct_error:
+          raise ValueError("data is not a multiple of the block-size in length")
+        
+        out = []
+        append = out.append
+        for plain_L, plain_R in LR_iter:
+          prev_cipher_L, prev_cipher_R = encrypt(
+            prev_cipher_L ^ plain_L,
+            prev_cipher_R ^ plain_R
+          )
+          append(u4_2_pack(prev_cipher_L, prev_cipher_R))
+        return b"".join(out)
+      
+    elif mode == "cbc":
+      def prepared(data, init_vector):
+        try:
+          prev_cipher_L, prev_cipher_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        try:
+          LR_iter = u4_2_iter_unpack(data)
+        except struct_error:
+          raise ValueError("data is not a multiple of the block-size in length")
+        
+        out = []
+        append = out.append
+        for cipher_L, cipher_R in LR_iter:
+          L, R = decrypt(cipher_L, cipher_R)
+          append(u4_2_pack(prev_cipher_L ^ L, prev_cipher_R ^ R))
+          prev_cipher_L = cipher_L
+          prev_cipher_R = cipher_R
+        return b"".join(out)
+      
+    elif mode == "pcbc" and direction == "encrypt":
+      def prepared(data, init_vector):
+        try:
+          init_L, init_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        try:
+          LR_iter = u4_2_iter_unpack(data)
+        except struct_error:
+          raise ValueError("data is not a multiple of the block-size in length")
+        
+        out = []
+        append = out.append
+        for plain_L, plain_R in LR_iter:
+          cipher_L, cipher_R = encrypt(init_L ^ plain_L, init_R ^ plain_R)
+          append(u4_2_pack(cipher_L, cipher_R))
+          init_L = plain_L ^ cipher_L
+          init_R = plain_R ^ cipher_R
+        return b"".join(out)
+      
+    elif mode == "pcbc":
+      def prepared(data, init_vector):
+        try:
+          init_L, init_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        try:
+          LR_iter = u4_2_iter_unpack(data)
+        except struct_error:
+          raise ValueError("data is not a multiple of the block-size in length")
+        
+        out = []
+        append = out.append
+        for cipher_L, cipher_R in LR_iter:
+          plain_L, plain_R = decrypt(cipher_L, cipher_R)
+          plain_L ^= init_L
+          plain_R ^= init_R
+          append(u4_2_pack(plain_L, plain_R))
+          init_L = cipher_L ^ plain_L
+          init_R = cipher_R ^ plain_R
+        return b"".join(out)
+      
+    elif mode == "cfb" and direction == "encrypt":
+      def prepared(data, init_vector):
+        try:
+          prev_cipher_L, prev_cipher_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        
+        data_len = len(data)
+        last_block_stop_i = data_len - data_len % 8
+        
+        out = []
+        append = out.append
+        for plain_L, plain_R in u4_2_iter_unpack(data[0:last_block_stop_i]):
+          prev_cipher_L, prev_cipher_R = encrypt(prev_cipher_L, prev_cipher_R)
+          prev_cipher_L ^= plain_L
+          prev_cipher_R ^= plain_R
+          append(u4_2_pack(prev_cipher_L, prev_cipher_R))
+        
+        if last_block_stop_i != data_len:
+          append(
+            bytes(
+              b ^ n for b, n in zip(
+                data[last_block_stop_i:],
+                u4_2_pack(*encrypt(prev_cipher_L, prev_cipher_R))
+              )
+            )
+          )
+        return b"".join(out)
+      
+    elif mode == "cfb":
+      def prepared(data, init_vector):
+        try:
+          prev_cipher_L, prev_cipher_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        
+        data_len = len(data)
+        last_block_stop_i = data_len - data_len % 8
+        
+        out = []
+        append = out.append
+        for cipher_L, cipher_R in u4_2_iter_unpack(data[0:last_block_stop_i]):
+          L, R = encrypt(prev_cipher_L, prev_cipher_R)
+          append(u4_2_pack(L ^ cipher_L, R ^ cipher_R))
+          prev_cipher_L = cipher_L
+          prev_cipher_R = cipher_R
+        
+        if last_block_stop_i != data_len:
+          append(
+            bytes(
+              b ^ n for b, n in zip(
+                data[last_block_stop_i:],
+                u4_2_pack(*encrypt(prev_cipher_L, prev_cipher_R))
+              )
+            )
+          )
+        return b"".join(out)
+      
+    elif mode == "ofb":
+      def prepared(data, init_vector):
+        try:
+          prev_L, prev_R = u4_2_unpack(init_vector)
+        except struct_error:
+          raise ValueError("initialization vector is not 8 bytes in length")
+        
+        data_len = len(data)
+        last_block_stop_i = data_len - data_len % 8
+        
+        out = []
+        append = out.append
+        for plain_L, plain_R in u4_2_iter_unpack(data[0:last_block_stop_i]):
+          prev_L, prev_R = encrypt(prev_L, prev_R)
+          append(u4_2_pack(plain_L ^ prev_L, plain_R ^ prev_R))
+        
+        if last_block_stop_i != data_len:
+          append(
+            bytes(
+              b ^ n for b, n in zip(
+                data[last_block_stop_i:],
+                u4_2_pack(*encrypt(prev_L, prev_R))
+              )
+            )
+          )
+        return b"".join(out)
+      
+    elif mode == "ctr":
+      def prepared(data, counter):
+        data_len = len(data)
+        last_block_stop_i = data_len - data_len % 8
+        
+        counter = iter(counter)
+        out = []
+        append = out.append
+        for (plain_L, plain_R), counter_n in zip(
+          u4_2_iter_unpack(data[0:last_block_stop_i]),
+          counter
+        ):
+          try:
+            counter_L, counter_R = u4_2_unpack(u8_1_pack(counter_n))
+          except struct_error:
+            raise ValueError("integer in counter is not less than 2^64")
+          counter_L, counter_R = encrypt(counter_L, counter_R)
+          append(u4_2_pack(plain_L ^ counter_L, plain_R ^ counter_R))
+        
+        if last_block_stop_i != data_len:
+          try:
+            counter_L, counter_R = u4_2_unpack(u8_1_pack(next(counter)))
+          except struct_error:
+            raise ValueError("integer in counter is not less than 2^64")
+          append(
+            bytes(
+              b ^ n for b, n in zip(
+                data[last_block_stop_i:],
+                u4_2_pack(*encrypt(counter_L, counter_R))
+              )
+            )
+          )
+        return b"".join(out)
+      
+    else:
+      # The ciphertext stealing modes only special case the last two blocks,
+      # so there is little to gain from specializing them.
+      method = getattr(self, "{}_{}".format(direction, mode))
+      
+      def prepared(*args):
+        return b"".join(method(*args))
+    
+    return prepared
+  
+  def encryptor(self, mode, *args, padding = None):
+    """
+    Return a :class:`CipherContext` object that encrypts data fed to it in
+    pieces, using a mode of operation.
+    
+    `mode` should be one of the modes in :data:`blowfish.MODES`, and `args` &
+    `padding` are the same as for the corresponding method (e.g.
+    ``encryptor("cbc", iv, padding = "pkcs7")`` is the streaming version of
+    ``encrypt_cbc(data, iv, padding = "pkcs7")``).
+    """
+    return CipherContext(self, mode, "encrypt", args, padding)
+  
+  def decryptor(self, mode, *args, padding = None):
+    """
+    Return a :class:`CipherContext` object that decrypts data fed to it in
+    pieces, using a mode of operation.
+    
+    `mode`, `args` & `padding` are the same as in :meth:`encryptor`.
+    """
+    return CipherContext(self, mode, "decrypt", args, padding)
+  
+  def encrypt_vectored(self, mode, buffers, *args, out = None, padding = None):
+    """
+    Encrypt the data in the sequence of :obj:`bytes`-like objects `buffers`
+    (e.g. the fragments of a network frame) as if it were concatenated, using
+    a mode of operation, without concatenating it.
+    
+    `mode`, `args` & `padding` are the same as in :meth:`encryptor`.
+    
+    If `out` is ``None``, a list of :obj:`bytearray` objects, one for each
+    buffer in `buffers` (of the same length, except the last one also holds
+    any padding), is returned. Otherwise, `out` should either be a writable
+    :obj:`bytes`-like object or a sequence of them, which the output is
+    written to in order, and the number of bytes written is returned.
+    
+    The result can be passed straight to :func:`socket.socket.sendmsg` or
+    :func:`os.writev`.
+    """
+    return _crypt_vectored(
+      CipherContext(self, mode, "encrypt", args, padding), buffers, out
+    )
+  
+  def decrypt_vectored(self, mode, buffers, *args, out = None, padding = None):
+    """
+    Decrypt the data in the sequence of :obj:`bytes`-like objects `buffers`
+    as if it were concatenated, using a mode of operation, without
+    concatenating it.
+    
+    `mode`, `args` & `padding` are the same as in :meth:`encryptor`, and `out`
+    & the return value the same as in :meth:`encrypt_vectored` (except that,
+    with `padding`, the buffers returned are truncated from the end instead).
+    """
+    return _crypt_vectored(
+      CipherContext(self, mode, "decrypt", args, padding), buffers, out
+    )
+
+  def encrypt_records(self, mode, data, offsets, init_vectors, f = xor):
+    """
+    Encrypt every record of a column of variable-length values in one call,
+    each on its own with its own initialization vector (or nonce), using the
+    CBC-CTS or CTR mode of operation.
+    
+    `data` should be a :obj:`bytes`-like object holding the values back to
+    back and `offsets` a sequence of integers (e.g. an :obj:`array.array`)
+    where record `i` is ``data[offsets[i]:offsets[i + 1]]``, like the value
+    and offset buffers of an Apache Arrow binary column.
+    
+    `mode` should either be ``"cbc_cts"`` or ``"ctr"``.
+    
+    With ``"cbc_cts"``, `init_vectors` should either be a sequence of 8-byte
+    :obj:`bytes`-like objects or a single :obj:`bytes`-like object holding
+    them back to back, one for each record, and every record should be
+    greater than 8 bytes in length.
+    
+    With ``"ctr"``, `init_vectors` should be a sequence of 64-bit integer
+    nonces, one for each record, and the counter of record `i` is
+    ``ctr_counter(init_vectors[i], f)``. The keystream for all of the records
+    is generated in one pass.
+    
+    Return a tuple of the encrypted data (a :obj:`bytes` object, which any
+    bytes outside the records are copied to unchanged) and `offsets`, since
+    the records stay the same length.
+    
+    The result for each record is the same as that of :meth:`encrypt_cbc_cts`
+    or :meth:`encrypt_ctr`. If the arguments are not valid, a
+    :exc:`ValueError` exception is raised.
+    """
+    return self._crypt_records("encrypt", mode, data, offsets, init_vectors, f)
+  
+  def decrypt_records(self, mode, data, offsets, init_vectors, f = xor):
+    """
+    Decrypt every record of a column of variable-length values in one call
+    (the reverse of :meth:`encrypt_records`, which the arguments & the
+    return value are the same as).
+    """
+    return self._crypt_records("decrypt", mode, data, offsets, init_vectors, f)
+  
+  def _crypt_records(self, direction, mode, data, offsets, init_vectors, f):
+    """
+    Implement :meth:`encrypt_records` & :meth:`decrypt_records`.
+    """
+    if mode not in ("cbc_cts", "ctr"):
+      raise ValueError("records can only use 'cbc_cts' or 'ctr' mode")
+    
+    data = memoryview(data).cast("B")
+    bounds = [int(offset) for offset in offsets]
+    if not bounds:
+      raise ValueError("offsets is empty")
+    if bounds[0] < 0 or bounds[-1] > len(data) or any(
+      a > b for a, b in zip(bounds, bounds[1:])
+    ):
+      raise ValueError("offsets are not ascending within data")
+    
+    if mode == "cbc_cts":
+      try:
+        column = memoryview(init_vectors).cast("B")
+      except TypeError:
+        column = init_vectors
+      else:
+        column = [column[i:i + 8] for i in range(0, len(column), 8)]
+    else:
+      column = init_vectors
+    if len(column) != len(bounds) - 1:
+      raise ValueError("init_vectors is not the same length as the records")
+    
+    start = bounds[0]
+    stop = bounds[-1]
+    
+    if mode == "ctr":
+      out = self._ctr_records(data[start:stop], bounds, column, f)
+    elif direction == "encrypt":
+      out = self._encrypt_cbc_cts_records(data, bounds, column)
+    else:
+      out = self._decrypt_cbc_cts_records(data, bounds, column)
+    
+    return b"".join((data[0:start], out, data[stop:])), offsets
+  
+  def _ctr_records(self, data, bounds, nonces, f):
+    """
+    Return the records `data` (spanning `bounds`) XORed with the keystream
+    of their CTR mode counters, generating all of the keystream at once.
+    """
+    lens = [b - a for a, b in zip(bounds, bounds[1:])]
+    
+    counters = []
+    extend = counters.extend
+    for nonce, record_len in zip(nonces, lens):
+      extend(f(nonce, n) for n in range(-(-record_len // 8)))
+    
+    try:
+      counter_blocks = Struct(
+        "{}{}Q".format(">" if self.byte_order == "big" else "<", len(counters))
+      ).pack(*counters)
+    except struct_error:
+      raise ValueError("integer in counter is not less than 2^64")
+    
+    # The keystream is not ECB data, so it bypasses the block cache.
+    encrypt = self._encrypt
+    u4_2_pack = self._u4_2_pack
+    keystream = memoryview(
+      b"".join([
+        u4_2_pack(*encrypt(L, R))
+        for L, R in self._u4_2_iter_unpack(counter_blocks)
+      ])
+    )
+    
+    pieces = []
+    append = pieces.append
+    i = 0
+    for record_len in lens:
+      append(keystream[i:i + record_len])
+      i += -(-record_len // 8) * 8
+    
+    return (
+      int.from_bytes(data, "big") ^ int.from_bytes(b"".join(pieces), "big")
+    ).to_bytes(len(data), "big")
+  
+  def _encrypt_cbc_cts_records(self, data, bounds, init_vectors):
+    """
+    Return the records of `data` (spanning `bounds`) encrypted using CBC-CTS
+    mode, each with its own initialization vector.
+    """
+    encrypt = self._encrypt
+    u4_2_pack = self._u4_2_pack
+    u4_2_unpack = self._u4_2_unpack
+    u4_2_iter_unpack = self._u4_2_iter_unpack
+    
+    out = []
+    append = out.append
+    for start, stop, init_vector in zip(bounds, bounds[1:], init_vectors):
+      if stop - start <= 8:
+        raise ValueError("record is not greater than 8 bytes in length")
+      try:
+        prev_L, prev_R = u4_2_unpack(init_vector)
+      except struct_error:
+        raise ValueError("initialization vector is not 8 bytes in length")
+      
+      # CBC over the record zero-padded past a partial (or empty) last block,
+      # with the last two cipher blocks swapped and the final one truncated.
+      extra_bytes = (stop - start) % 8
+      last_block_stop_i = stop - extra_bytes
+      
+      for plain_L, plain_R in u4_2_iter_unpack(data[start:last_block_stop_i]):
+        prev_L, prev_R = encrypt(prev_L ^ plain_L, prev_R ^ plain_R)
+        append(u4_2_pack(prev_L, prev_R))
+      
+      stolen_block = out.pop()
+      plain_L, plain_R = u4_2_unpack(
+        bytes(data[last_block_stop_i:stop]) + bytes(8 - extra_bytes)
+      )
+      append(u4_2_pack(*encrypt(prev_L ^ plain_L, prev_R ^ plain_R)))
+      append(stolen_block[:extra_bytes])
+    
+    return b"".join(out)
+  
+  def _decrypt_cbc_cts_records(self, data, bounds, init_vectors):
+    """
+    Return the records of `data` (spanning `bounds`) decrypted using CBC-CTS
+    mode, each with its own initialization vector.
+    """
+    decrypt = self._decrypt
+    u4_2_pack = self._u4_2_pack
+    u4_2_unpack = self._u4_2_unpack
+    u4_2_iter_unpack = self._u4_2_iter_unpack
+    
+    out = []
+    append = out.append
+    for start, stop, init_vector in zip(bounds, bounds[1:], init_vectors):
+      if stop - start <= 8:
+        raise ValueError("record is not greater than 8 bytes in length")
+      try:
+        prev_L, prev_R = u4_2_unpack(init_vector)
+      except struct_error:
+        raise ValueError("initialization vector is not 8 bytes in length")
+      
+      extra_bytes = (stop - start) % 8
+      last_block_start_i = stop - extra_bytes - 8
+      
+      for cipher_L, cipher_R in u4_2_iter_unpack(
+        data[start:last_block_start_i]
+      ):
+        L, R = decrypt(cipher_L, cipher_R)
+        append(u4_2_pack(prev_L ^ L, prev_R ^ R))
+        prev_L, prev_R = cipher_L, cipher_R
+      
+      # The last whole cipher block decrypts to the stolen cipher block XOR
+      # the zero-padded last plain block.
+      last_block = u4_2_pack(
+        *decrypt(*u4_2_unpack(data[last_block_start_i:stop - extra_bytes]))
+      )
+      tail = data[stop - extra_bytes:stop]
+      stolen_L, stolen_R = u4_2_unpack(
+        bytes(tail) + last_block[extra_bytes:]
+      )
+      L, R = decrypt(stolen_L, stolen_R)
+      append(u4_2_pack(prev_L ^ L, prev_R ^ R))
+      append(bytes(a ^ b for a, b in zip(last_block, tail)))
+    
+    return b"".join(out)
+
+  def aencrypt(
+    self,
+    mode,
+    data,
+    *args,
+    padding = None,
+    time_slice = 0.005,
+    executor = None,
+    offload_size = 64 * 1024
+  ):
+    """
+    Return an awaitable (a :class:`CipherAwaitable` object) that encrypts
+    `data` using a mode of operation, for use in :mod:`asyncio` coroutines
+    (``data_encrypted = await cipher.aencrypt("ctr", data, counter)``).
+    
+    `mode`, `args` & `padding` are the same as in :meth:`encryptor`.
+    
+    The data is encrypted in the event loop, a chunk at a time, yielding to
+    the loop whenever `time_slice` seconds have passed since it last did, so
+    small payloads are done in one go and large ones don't block the loop
+    for longer than that (give or take a chunk).
+    
+    If `executor` (a :class:`concurrent.futures.Executor` object) is given,
+    payloads longer than `offload_size` bytes are encrypted by it instead,
+    while the loop carries on. With a process pool, the arguments have to be
+    picklable (e.g. a :obj:`list` of counter values rather than a generator).
+    """
+    return CipherAwaitable(
+      self, mode, "encrypt", data, args, padding,
+      time_slice, executor, offload_size
+    )
+  
+  def adecrypt(
+    self,
+    mode,
+    data,
+    *args,
+    padding = None,
+    time_slice = 0.005,
+    executor = None,
+    offload_size = 64 * 1024
+  ):
+    """
+    Return an awaitable (a :class:`CipherAwaitable` object) that decrypts
+    `data` using a mode of operation, for use in :mod:`asyncio` coroutines.
+    
+    The arguments are the same as in :meth:`aencrypt`.
+    """
+    return CipherAwaitable(
+      self, mode, "decrypt", data, args, padding,
+      time_slice, executor, offload_size
+    )
+
+def _crypt_all(cipher, mode, direction, args, padding, data):
+  """
+  Return `data` encrypted or decrypted (depending on `direction`) with `cipher`
+  in `mode` (used by :class:`CipherAwaitable` executors).
+  """
+  kwargs = {} if padding is None else {"padding": padding}
+  return b"".join(
+    getattr(cipher, direction + "_" + mode)(data, *args, **kwargs)
+  )
+
+class CipherAwaitable(object):
+  """
+  Awaitable encryption or decryption of `data` (usually created with
+  :meth:`Cipher.aencrypt` or :meth:`Cipher.adecrypt`, which describe the
+  arguments).
+  
+  Awaiting it (or, on Python 3.4, ``yield from``-ing it) returns the output
+  as a :obj:`bytes` object. It can only be awaited once.
+  
+  When the data is processed in the event loop, :attr:`yields` counts how
+  many times it yielded to the loop, and :attr:`longest_slice` is the longest
+  time, in seconds, it kept the loop blocked.
+  """
+  
+  # Size of the first chunk processed in the loop. Later chunks are sized to
+  # take about a quarter of the time slice, from the rate measured so far.
+  _first_chunk_size = 512
+  
+  def __init__(
+    self,
+    cipher,
+    mode,
+    direction,
+    data,
+    args = (),
+    padding = None,
+    time_slice = 0.005,
+    executor = None,
+    offload_size = 64 * 1024
+  ):
+    if time_slice <= 0:
+      raise ValueError("time_slice is not positive")
+    
+    self.cipher = cipher
+    self.mode = mode
+    self.direction = direction
+    self.data = data
+    self.args = args
+    self.padding = padding
+    self.time_slice = time_slice
+    self.executor = executor
+    self.offload_size = offload_size
+    
+    self.yields = 0
+    self.longest_slice = 0.0
+  
+  def __await__(self):
+    data = memoryview(self.data).cast("B")
+    
+    if self.executor is not None and len(data) > self.offload_size:
+      import asyncio
+      loop = asyncio.get_event_loop()
+      return (
+        yield from loop.run_in_executor(
+          self.executor,
+          _crypt_all,
+          self.cipher,
+          self.mode,
+          self.direction,
+          self.args,
+          self.padding,
+          self.data
+        )
+      )
     
+    context = CipherContext(
+      self.cipher, self.mode, self.direction, self.args, self.padding
+    )
+    time_slice = self.time_slice
+    chunk_size = self._first_chunk_size
+    
+    out = []
+    append = out.append
+    slice_start = perf_counter()
+    start = 0
+    while start < len(data):
+      chunk_start = perf_counter()
+      append(context.update(data[start:start + chunk_size]))
+      start += chunk_size
+      now = perf_counter()
+      
+      # Grow the chunks at most twofold, in case a chunk was timed short.
+      chunk_time = now - chunk_start
+      if chunk_time:
+        chunk_size = max(
+          8,
+          min(2 * chunk_size, int(chunk_size * time_slice / 4 / chunk_time)) & ~7
+        )
+      
+      if now - slice_start >= time_slice and start < len(data):
+        self.longest_slice = max(self.longest_slice, now - slice_start)
+        self.yields += 1
+        # A bare yield is how asyncio tasks give other callbacks a turn (it's
+        # what asyncio.sleep(0) does).
+        yield
+        slice_start = perf_counter()
+    
+    append(context.finalize())
+    self.longest_slice = max(self.longest_slice, perf_counter() - slice_start)
+    return b"".join(out)
+  
+  # Python 3.4 coroutines use "yield from" instead of "await".
+  __iter__ = __await__
+
+class BlockCache(object):
+  """
+  Bounded LRU cache of the results of encrypting & decrypting blocks with a
+  :class:`Cipher` in ECB & ECB-CTS mode (usually created with
+  :meth:`Cipher.enable_block_cache`), so that repeated blocks (e.g. the
+  all-zero blocks of a disk image) skip the rounds.
+  
+  At most `max_blocks` results are kept for each direction. When another is
+  needed, the least recently used one is evicted.
+  
+  The :attr:`hits`, :attr:`misses` and :attr:`evictions` attributes count what
+  happened so far, and :attr:`hit_rate` is the fraction of blocks that were
+  found in the cache.
+  
+  Looking blocks up costs a little on every block, so the cache only pays off
+  when blocks do repeat. It should not be shared by several threads.
+  """
+  
+  def __init__(self, max_blocks = 4096):
+    if max_blocks <= 0:
+      raise ValueError("max_blocks is not positive")
+    self.max_blocks = max_blocks
+    
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    
+    self._encrypted = OrderedDict()
+    self._decrypted = OrderedDict()
+  
+  @property
+  def hit_rate(self):
+    """
+    Fraction of blocks that were found in the cache (0 if there were none
+    yet).
+    """
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
+  
+  def __len__(self):
+    return len(self._encrypted) + len(self._decrypted)
+  
+  def clear(self):
+    """
+    Remove every result from the cache (the counters are kept).
+    """
+    self._encrypted.clear()
+    self._decrypted.clear()
+  
+  def _wrap(self, function, results):
+    """
+    Return a version of the block function `function` (taking a pair of 32-bit
+    integers) that looks its result up in (or adds it to) `results` first.
+    """
+    max_blocks = self.max_blocks
+    move_to_end = results.move_to_end
+    
+    def cached_function(L, R):
+      key = L << 32 | R
+      try:
+        result = results[key]
+      except KeyError:
+        self.misses += 1
+        result = results[key] = function(L, R)
+        if len(results) > max_blocks:
+          results.popitem(last = False)
+          self.evictions += 1
+        return result
+      self.hits += 1
+      move_to_end(key)
+      return result
+    
+    return cached_function
+  
+  def encrypt_function(self, function):
+    return self._wrap(function, self._encrypted)
+  
+  def decrypt_function(self, function):
+    return self._wrap(function, self._decrypted)
+
+class _Scatter(object):
+  """
+  Writes data across `out`, either a writable :obj:`bytes`-like object or a
+  sequence of them, filling each before moving on to the next.
+  """
+  
+  def __init__(self, out):
+    try:
+      targets = [memoryview(out)]
+    except TypeError:
+      targets = out
+    self._targets = deque(memoryview(target).cast("B") for target in targets)
+    self.written = 0
+  
+  def write(self, data):
+    targets = self._targets
+    data_len = len(data)
+    written = 0
+    
+    while written < data_len:
+      if not targets:
+        raise ValueError("output buffers are too small")
+      target = targets[0]
+      n = min(len(target), data_len - written)
+      target[0:n] = data[written:written + n]
+      written += n
+      if n == len(target):
+        targets.popleft()
+      else:
+        targets[0] = target[n:]
+    
+    self.written += written
+  
+  def close(self):
+    """
+    Release the views of the targets left, so they can be resized.
+    """
+    for target in self._targets:
+      target.release()
+    self._targets.clear()
+
+def _crypt_vectored(context, buffers, out):
+  """
+  Feed every buffer in `buffers` to `context` and finalize it, writing the
+  output to `out` (see :meth:`Cipher.encrypt_vectored`).
+  """
+  buffers = [memoryview(data).cast("B") for data in buffers]
+  
+  if out is None:
+    outputs = [bytearray(len(data)) for data in buffers] or [bytearray()]
+    if context.padding is not None and context.direction == "encrypt":
+      outputs[-1] += bytes(8)
+    scatter = _Scatter(outputs)
+  else:
+    scatter = _Scatter(out)
+  
+  try:
+    for data in buffers:
+      for part in context._update_parts(data):
+        scatter.write(part)
+    scatter.write(context.finalize())
+  finally:
+    scatter.close()
+  
+  if out is not None:
+    return scatter.written
+  
+  # Trim what wasn't written (i.e. due to padding) off the end.
+  excess = sum(map(len, outputs)) - scatter.written
+  for output in reversed(outputs):
+    n = min(excess, len(output))
+    del output[len(output) - n:]
+    excess -= n
+  return outputs
+
+class CipherContext(object):
+  """
+  Streaming encryption or decryption with a mode of operation (usually
+  created with :meth:`Cipher.encryptor` or :meth:`Cipher.decryptor`).
+  
+  Data is fed to it in pieces of any length with :meth:`update` (or
+  :meth:`update_into`), each returning the output for as much of the data
+  fed so far as can be processed, and the rest is returned by
+  :meth:`finalize`. The concatenated output is the same as that of the
+  `direction` (``"encrypt"`` or ``"decrypt"``) `mode` method of `cipher`
+  given all the data at once, `args` (the arguments after `data`, e.g.
+  ``(init_vector,)``) and `padding`.
+  
+  Only whole blocks are processed by :meth:`update`, so up to 7 bytes are held
+  back until more data comes in. The ciphertext stealing modes hold back
+  between 9 and 16 bytes, and decryption with `padding` the last whole block,
+  since those are processed differently.
+  """
+  
+  def __init__(self, cipher, mode, direction, args = (), padding = None):
+    if direction not in ("encrypt", "decrypt"):
+      raise ValueError("direction must either be 'encrypt' or 'decrypt'")
+    
+    if mode not in MODES:
+      raise ValueError("unknown mode of operation {!r}".format(mode))
+    
+    if padding is not None:
+      if mode not in ("ecb", "cbc", "pcbc"):
+        raise ValueError("padding is not supported by {!r} mode".format(mode))
+      if padding not in PADDING_SCHEMES:
+        raise ValueError("unknown padding scheme {!r}".format(padding))
+    
+    if mode == "ctr":
+      counter, = args
+      self.counter = iter(counter)
+      register = None
+    elif mode in ("ecb", "ecb_cts"):
+      if args:
+        raise ValueError("{!r} mode takes no arguments".format(mode))
+      register = None
+    else:
+      register, = args
+      if len(register) != 8:
+        raise ValueError("initialization vector is not 8 bytes in length")
+      register = bytes(register)
+    
+    self.cipher = cipher
+    self.mode = mode
+    self.direction = direction
+    self.padding = padding
+    
+    # The chaining value: the initialization vector of the next block for
+    # CBC, CFB & OFB mode, and the value to XOR the next plaintext block with
+    # before encryption (or after decryption) for PCBC mode.
+    self._register = register
+    self._buffer = bytearray()
+    self._finalized = False
+    
+    self._method = getattr(cipher, "{}_{}".format(direction, mode))
+    self._process = cipher.prepare(mode.replace("_cts", ""), direction)
+    
+    # Number of bytes (in addition to any partial block) held back by update.
+    if mode.endswith("_cts"):
+      self._hold = 9
+    elif padding is not None and direction == "decrypt":
+      self._hold = 1
+    else:
+      self._hold = 0
+    
+    # Total number of bytes passed to update & processed so far.
+    self.bytes_in = 0
+    self.bytes_out = 0
+  
+  # Version, mode, direction, padding scheme (0 for none), bytes in & out,
+  # chaining value, key check value and length of the buffered data.
+  _checkpoint_struct = Struct(">4B2Q8s4sB")
+  
+  @property
+  def counter_position(self):
+    """
+    Number of values taken from the counter so far (CTR mode only), i.e. how
+    far ahead the counter passed to :meth:`restore` should start.
+    """
+    return -(-self.bytes_out // 8)
+  
+  def checkpoint(self):
+    """
+    Return the state of the context (the mode, chaining value, number of bytes
+    processed and the data held back) as a compact :obj:`bytes` object, which
+    :meth:`restore` turns back into a context that carries on exactly where
+    this one is. The output after restoring is the same as if the context had
+    carried on instead.
+    
+    To resume a job, save the checkpoint along with the output written so far
+    (:attr:`bytes_out` bytes), and feed the restored context the input from
+    :attr:`bytes_in` onwards.
+    
+    The checkpoint holds up to 16 bytes of the data held back as is, so it
+    should be kept as safe as the data itself. It also holds a key check
+    value (the first 4 bytes of an all-zero block encrypted), so that it is
+    not restored with the wrong key by mistake.
+    """
+    if self._finalized:
+      raise ValueError("context is already finalized")
+    
+    padding = self.padding
+    return self._checkpoint_struct.pack(
+      1,
+      MODES.index(self.mode),
+      self.direction == "decrypt",
+      0 if padding is None else PADDING_SCHEMES.index(padding) + 1,
+      self.bytes_in,
+      self.bytes_out,
+      self._register or bytes(8),
+      self.cipher.encrypt_block(bytes(8))[0:4],
+      len(self._buffer)
+    ) + self._buffer
+  
+  @classmethod
+  def restore(cls, cipher, checkpoint, counter = None):
+    """
+    Return a context that carries on from the state in `checkpoint` (returned
+    by :meth:`checkpoint`), using `cipher` (keyed with the same key).
+    
+    With CTR mode, `counter` should be an iterable that carries on where the
+    original counter was, i.e. skipping its first :attr:`counter_position`
+    values (e.g. ``ctr_counter(nonce, f, start = position)``), since
+    counters can't be saved.
+    
+    If `checkpoint` is not valid or `cipher` does not have the same key, a
+    :exc:`ValueError` exception is raised.
+    """
+    checkpoint_struct = cls._checkpoint_struct
+    try:
+      (
+        version, mode_i, decrypt, padding_i,
+        bytes_in, bytes_out,
+        register, check_value, buffer_len
+      ) = checkpoint_struct.unpack_from(checkpoint)
+    except struct_error:
+      raise ValueError("checkpoint is truncated")
+    
+    buffer = checkpoint[checkpoint_struct.size:]
+    if (
+      version != 1 or mode_i >= len(MODES) or decrypt > 1 or
+      padding_i > len(PADDING_SCHEMES) or len(buffer) != buffer_len
+    ):
+      raise ValueError("checkpoint is not valid")
+    if not compare_digest(check_value, cipher.encrypt_block(bytes(8))[0:4]):
+      raise ValueError("checkpoint was made with a different key")
+    
+    mode = MODES[mode_i]
+    if mode == "ctr":
+      if counter is None:
+        raise ValueError("CTR mode checkpoints need a counter to restore")
+      args = (counter,)
+    elif mode in ("ecb", "ecb_cts"):
+      args = ()
+    else:
+      args = (register,)
+    
+    context = cls(
+      cipher,
+      mode,
+      "decrypt" if decrypt else "encrypt",
+      args,
+      PADDING_SCHEMES[padding_i - 1] if padding_i else None
+    )
+    context._buffer += buffer
+    context.bytes_in = bytes_in
+    context.bytes_out = bytes_out
+    return context
+  
+  def _process_blocks(self, data):
+    """
+    Return the output of whole blocks `data`, updating the chaining value.
+    """
+    mode = self.mode
+    register = self._register
+    
+    if mode == "ctr":
+      return self._process(data, self.counter)
+    if register is None:
+      return self._process(data)
+    
+    out = self._process(data, register)
+    
+    if mode in ("cbc", "cbc_cts", "cfb"):
+      self._register = bytes(
+        (out if self.direction == "encrypt" else data)[-8:]
+      )
+    else:
+      # OFB: the last keystream block. PCBC: the last plaintext block XOR the
+      # last ciphertext block. Either way, the last input XOR output block.
+      self._register = bytes(a ^ b for a, b in zip(data[-8:], out[-8:]))
+    
+    return out
+  
+  def _update_parts(self, data):
+    """
+    Feed `data` (a :obj:`memoryview` of bytes) to the context and return a
+    list of the outputs of the data that can be processed so far.
+    
+    Whole blocks in `data` are processed straight from it. Only the bytes
+    completing a partial block fed earlier, and those held back, are copied.
+    """
+    buffer = self._buffer
+    buffer_len = len(buffer)
+    self.bytes_in += len(data)
+    
+    process_len = buffer_len + len(data) - self._hold
+    process_len -= process_len % 8
+    if process_len <= 0:
+      buffer += data
+      return []
+    
+    if process_len <= buffer_len:
+      parts = [self._process_blocks(bytes(buffer[0:process_len]))]
+      del buffer[0:process_len]
+      buffer += data
+    else:
+      parts = []
+      fill = -buffer_len % 8
+      if buffer_len:
+        buffer += data[0:fill]
+        parts.append(self._process_blocks(bytes(buffer)))
+        del buffer[:]
+      if process_len - buffer_len > fill:
+        parts.append(self._process_blocks(data[fill:process_len - buffer_len]))
+      buffer += data[process_len - buffer_len:]
+    
+    self.bytes_out += sum(map(len, parts))
+    return parts
+  
+  def update(self, data):
+    """
+    Feed `data` (a :obj:`bytes`-like object) to the context and return the
+    output of the data that can be processed so far as a :obj:`bytes` object.
+    """
+    if self._finalized:
+      raise ValueError("context is already finalized")
+    return b"".join(self._update_parts(memoryview(data).cast("B")))
+  
+  def update_into(self, data, out):
+    """
+    Same as :meth:`update`, but write the output to the writable
+    :obj:`bytes`-like object `out` instead, and return the number of bytes
+    written. `out` should be at least ``len(data) + 7`` bytes long.
+    """
+    result = self.update(data)
+    memoryview(out).cast("B")[0:len(result)] = result
+    return len(result)
+  
+  def update_vectored(self, buffers, out = None):
+    """
+    Feed every :obj:`bytes`-like object in the sequence `buffers` to the
+    context, in order, without concatenating them.
+    
+    If `out` is ``None``, return a list of the outputs :meth:`update` would
+    have returned for each buffer. Otherwise, `out` should either be a
+    writable :obj:`bytes`-like object or a sequence of them, which the output
+    is written to in order (filling each before moving on to the next), and
+    the number of bytes written is returned.
+    """
+    if self._finalized:
+      raise ValueError("context is already finalized")
+    
+    buffers = [memoryview(data).cast("B") for data in buffers]
+    
+    if out is None:
+      return [b"".join(self._update_parts(data)) for data in buffers]
+    
+    scatter = _Scatter(out)
+    try:
+      for data in buffers:
+        for part in self._update_parts(data):
+          scatter.write(part)
+    finally:
+      scatter.close()
+    return scatter.written
+  
+  def finalize(self):
+    """
+    Return the output of the rest of the data fed to the context as a
+    :obj:`bytes` object. The context can not be used afterwards.
+    
+    If the data fed to the context can not be processed by the mode (e.g. it
+    is not a multiple of the block-size in length with ECB mode and no
+    padding), a :exc:`ValueError` exception is raised.
+    """
+    if self._finalized:
+      raise ValueError("context is already finalized")
+    self._finalized = True
+    
+    mode = self.mode
+    tail = bytes(self._buffer)
+    del self._buffer[:]
+    
+    if mode.endswith("_cts"):
+      if self.bytes_in <= 8:
+        raise ValueError("data is not greater than 8 bytes in length")
+      args = () if mode == "ecb_cts" else (self._register,)
+      out = b"".join(self._method(tail, *args))
+    elif not tail and self.padding is None:
+      out = b""
+    elif mode in ("cfb", "ofb", "ctr") or self.padding is not None:
+      if mode == "ctr":
+        args = (self.counter,)
+      elif mode == "ecb":
+        args = ()
+      else:
+        args = (self._register,)
+      kwargs = {} if self.padding is None else {"padding": self.padding}
+      out = b"".join(self._method(tail, *args, **kwargs))
+    else:
+      raise ValueError("data is not a multiple of the block-size in length")
+    
+    self.bytes_out += len(out)
+    return out
+
+class CMAC(object):
+  """
+  Cipher-based Message Authentication Code (CMAC, also known as OMAC1) built on
+  the Blowfish block cipher.
+  
+  `cipher` should be a :class:`Cipher` object. For authenticated encryption,
+  it should be keyed with a different key than the one used to encrypt.
+  
+  `data`, if given, is passed to :meth:`update`.
+  
+  The tag is computed incrementally as data is fed to :meth:`update`, so a
+  message does not have to be held in memory all at once. The
+  ``*_cmac`` methods of :class:`Cipher` also feed a :class:`CMAC` object as
+  they encrypt or decrypt, so the data only has to be traversed once.
+  
+  The subkeys are derived as described in NIST SP 800-38B, using the 64-bit
+  block constant ``0x1b``.
+  """
+  
+  digest_size = 8
+  block_size = 8
+  
+  def __init__(self, cipher, data = b""):
+    self.cipher = cipher
+    
+    L = int.from_bytes(cipher.encrypt_block(bytes(8)), "big")
+    K1 = L << 1 & 0xffffffffffffffff ^ (0x1b if L >> 63 else 0)
+    K2 = K1 << 1 & 0xffffffffffffffff ^ (0x1b if K1 >> 63 else 0)
+    
+    # Subkeys are kept as pairs of 32-bit integers (in the cipher's byte
+    # order), just like blocks are in the modes of operation.
+    self._K1 = cipher._u4_2_unpack(K1.to_bytes(8, "big"))
+    self._K2 = cipher._u4_2_unpack(K2.to_bytes(8, "big"))
+    
+    # Chaining value.
+    self._L = 0x00000000
+    self._R = 0x00000000
+    
+    # The last (possibly full) block is always held back since it has to be
+    # treated differently if it turns out to be the final block.
+    self._buffer = b""
+    
+    if data:
+      self.update(data)
+  
+  def update(self, data):
+    """
+    Feed `data` to the MAC.
+    
+    `data` should be a :obj:`bytes`-like object (of any length).
+    """
+    data = memoryview(data).cast("B")
+    data_len = len(data)
+    if not data_len:
+      return
+    
+    cipher = self.cipher
+    
+    encrypt = cipher._encrypt
+    
+    L = self._L
+    R = self._R
+    buffer = self._buffer
+    
+    if buffer:
+      fill = 8 - len(buffer)
+      if fill:
+        buffer += data[0:fill]
+        data = data[fill:]
+        data_len = len(data)
+      if not data_len:
+        self._buffer = buffer
+        return
+      block_L, block_R = cipher._u4_2_unpack(buffer)
+      L, R = encrypt(L ^ block_L, R ^ block_R)
+    
+    last_block_start_i = data_len - (data_len % 8 or 8)
+    
+    for block_L, block_R in cipher._u4_2_iter_unpack(
+      data[0:last_block_start_i]
+    ):
+      L, R = encrypt(L ^ block_L, R ^ block_R)
+    
+    self._L = L
+    self._R = R
+    self._buffer = bytes(data[last_block_start_i:])
+  
+  def _update_block(self, block):
+    """
+    Feed a single `block` of data to the MAC.
+    
+    This is :meth:`update` for the ``*_cmac`` methods of :class:`Cipher`,
+    which feed it the blocks of a mode of operation one at a time. As long as
+    `block` is 8 bytes in length and the data fed to the MAC so far is a
+    multiple of 8 bytes in length, the held back block is simply swapped out.
+    """
+    buffer = self._buffer
+    if len(block) != 8 or len(buffer) % 8:
+      self.update(block)
+      return
+    
+    if buffer:
+      cipher = self.cipher
+      block_L, block_R = cipher._u4_2_unpack(buffer)
+      self._L, self._R = cipher._encrypt(
+        self._L ^ block_L,
+        self._R ^ block_R
+      )
+    self._buffer = bytes(block)
+  
+  def digest(self):
+    """
+    Return a :obj:`bytes` object containing the 8 byte tag of all the data
+    fed to the MAC so far.
+    
+    The MAC is not finalized, so more data can be fed to it afterwards.
+    """
+    cipher = self.cipher
+    buffer = self._buffer
+    
+    if len(buffer) == 8:
+      K_L, K_R = self._K1
+    else:
+      K_L, K_R = self._K2
+      buffer = buffer + b"\x80" + bytes(7 - len(buffer))
+    
+    block_L, block_R = cipher._u4_2_unpack(buffer)
+    return cipher._u4_2_pack(
+      *cipher._encrypt(self._L ^ block_L ^ K_L, self._R ^ block_R ^ K_R)
+    )
+  
+  def hexdigest(self):
+    """
+    Return the tag returned by :meth:`digest` as a string of hexadecimal
+    digits.
+    """
+    return hexlify(self.digest()).decode()
+  
+  def verify(self, tag):
+    """
+    Check, in constant time, that `tag` matches the tag returned by
+    :meth:`digest`.
+    If it does not, a :exc:`ValueError` exception is raised.
+    """
+    if not compare_digest(self.digest(), tag):
+      raise ValueError("tag does not match")
+  
+  def copy(self):
+    """
+    Return a copy of the MAC, which can be used to efficiently compute the tags
+    of data sharing a common prefix.
+    """
+    other = CMAC.__new__(CMAC)
+    other.cipher = self.cipher
+    other._K1 = self._K1
+    other._K2 = self._K2
+    other._L = self._L
+    other._R = self._R
+    other._buffer = self._buffer
+    return other
+
+class Container(object):
+  """
+  Chunked, authenticated container format.
+  
+  Data is split into chunks of `chunk_size` bytes (the last chunk may be
+  shorter). Every chunk is encrypted on its own in Counter (CTR) mode with
+  `cipher`, using a counter starting at a nonce derived from the container's
+  `nonce` and the chunk's index, and authenticated with a :class:`CMAC` using
+  `mac_cipher` (which should be keyed with a different key than `cipher`).
+  
+  Since the ciphertext is the same length as the plaintext, where every chunk
+  goes is known in advance. So chunks can be encrypted, written, read and
+  decrypted in any order, by any number of threads or processes (this object
+  can be pickled), with :meth:`write_chunk` & :meth:`decrypt_chunk`.
+  :class:`ContainerWriter` & :class:`ContainerReader` do the bookkeeping for
+  the common cases.
+  
+  `nonce` should be 8 random bytes that are never reused with the same key.
+  If it is ``None``, one is generated.
+  
+  All integers in the format are little-endian:
+  
+  =========================  ========  ====================================
+  Offset                     Size      Contents
+  =========================  ========  ====================================
+  0                          4         Magic number ``b"BFC1"``
+  4                          2         Format version (1)
+  6                          2         Reserved (0)
+  8                          4         Chunk size
+  12                         4         Reserved (0)
+  16                         8         Nonce
+  24 + i * chunk_size        <= chunk  Encrypted chunk i
+  24 + data length + 24 * i  8         Offset of chunk i
+  ...                        4         Length of chunk i
+  ...                        4         Reserved (0)
+  ...                        8         Tag of chunk i
+  end - 32                   8         Number of chunks
+  end - 24                   8         Data length
+  end - 16                   8         Tag of the header and index
+  end - 8                    4         Magic number ``b"BFCI"``
+  end - 4                    4         Reserved (0)
+  =========================  ========  ====================================
+  
+  The tag of a chunk covers the header, the chunk's index and its
+  ciphertext, so chunks can not be moved around or between containers.
+  The tag of the index also covers the header and the number of chunks, so
+  chunks can not be dropped either.
+  """
+  
+  magic = b"BFC1"
+  index_magic = b"BFCI"
+  version = 1
+  
+  _header_struct = Struct("<4sHHII8s")
+  _entry_struct = Struct("<QII8s")
+  _trailer_struct = Struct("<QQ8s4sI")
+  _index_struct = Struct("<Q")
+  
+  header_size = _header_struct.size
+  
+  def __init__(self, cipher, mac_cipher, chunk_size = 64 * 1024, nonce = None):
+    if not 0 < chunk_size < 2**32 or chunk_size % 8:
+      raise ValueError(
+        "chunk size is not a multiple of the block-size less than 2^32"
+      )
+    
+    if nonce is None:
+      nonce = urandom(8)
+    elif len(nonce) != 8:
+      raise ValueError("nonce is not 8 bytes in length")
+    
+    self.cipher = cipher
+    self.mac_cipher = mac_cipher
+    self.chunk_size = chunk_size
+    self.nonce = bytes(nonce)
+    
+    # MAC of the header, copied for every chunk.
+    self._header_mac = CMAC(mac_cipher, self.header())
+  
+  @classmethod
+  def from_header(cls, header, cipher, mac_cipher):
+    """
+    Return a :class:`Container` object with the parameters saved in `header`
+    (i.e. the first :attr:`header_size` bytes of a container).
+    If `header` is not a valid header, a :exc:`ValueError` exception is
+    raised.
+    """
+    try:
+      magic, version, _, chunk_size, _, nonce = cls._header_struct.unpack(
+        header
+      )
+    except struct_error:
+      raise ValueError("header is not {} bytes in length".format(
+        cls.header_size
+      ))
+    
+    if magic != cls.magic:
+      raise ValueError("not a container")
+    if version != cls.version:
+      raise ValueError("unsupported container version {}".format(version))
+    
+    return cls(cipher, mac_cipher, chunk_size, nonce)
+  
+  def header(self):
+    """
+    Return the header of the container as a :obj:`bytes` object.
+    """
+    return self._header_struct.pack(
+      self.magic, self.version, 0, self.chunk_size, 0, self.nonce
+    )
+  
+  def chunk_offset(self, index):
+    """
+    Return the offset of chunk `index` from the start of the container.
+    """
+    return self.header_size + index * self.chunk_size
+  
+  def chunk_count(self, data_len):
+    """
+    Return the number of chunks `data_len` bytes of data are split into.
+    """
+    return -(-data_len // self.chunk_size)
+  
+  def _chunk_counter(self, index):
+    """
+    Return the CTR mode counter of chunk `index`.
+    """
+    chunk_nonce = self.cipher.encrypt_block(
+      (int.from_bytes(self.nonce, "little") ^ index).to_bytes(8, "little")
+    )
+    return ctr_counter(int.from_bytes(chunk_nonce, "little"), xor)
+  
+  def _chunk_mac(self, index):
+    """
+    Return a :class:`CMAC` object fed with the header and the index of chunk
+    `index`.
+    """
+    mac = self._header_mac.copy()
+    mac.update(self._index_struct.pack(index))
+    return mac
+  
+  def encrypt_chunk(self, index, data):
+    """
+    Return a tuple of the encrypted chunk `index` and its tag, given its
+    plaintext `data`.
+    """
+    if len(data) > self.chunk_size:
+      raise ValueError("chunk is larger than the chunk size")
+    
+    mac = self._chunk_mac(index)
+    ciphertext = b"".join(
+      self.cipher.encrypt_ctr_cmac(data, self._chunk_counter(index), mac)
+    )
+    return ciphertext, mac.digest()
+  
+  def decrypt_chunk(self, index, data, tag):
+    """
+    Return the plaintext of chunk `index`, given its ciphertext `data` and
+    `tag`.
+    If `data` fails authentication, a :exc:`ValueError` exception is raised.
+    """
+    mac = self._chunk_mac(index)
+    plaintext = b"".join(
+      self.cipher.decrypt_ctr_cmac(data, self._chunk_counter(index), mac)
+    )
+    try:
+      mac.verify(tag)
+    except ValueError:
+      raise ValueError("chunk {} failed authentication".format(index))
+    return plaintext
+  
+  def write_chunk(self, file, index, data):
+    """
+    Encrypt chunk `index`, given its plaintext `data`, write it to its place in
+    `file` and return its tag.
+    
+    `file` should be a seekable, writable binary file object. To write chunks
+    from several threads, each should use its own file object.
+    """
+    ciphertext, tag = self.encrypt_chunk(index, data)
+    file.seek(self.chunk_offset(index))
+    file.write(ciphertext)
+    return tag
+  
+  def index(self, tags, data_len):
+    """
+    Return the index (which goes after the last chunk) of a container with
+    `data_len` bytes of data and chunk tags `tags`, as a :obj:`bytes`
+    object.
+    """
+    chunk_count = self.chunk_count(data_len)
+    if len(tags) != chunk_count:
+      raise ValueError("number of tags does not match the number of chunks")
+    
+    chunk_size = self.chunk_size
+    entry_pack = self._entry_struct.pack
+    entries = b"".join(
+      entry_pack(
+        self.chunk_offset(i),
+        min(chunk_size, data_len - i * chunk_size),
+        0,
+        tag
+      ) for i, tag in enumerate(tags)
+    )
+    
+    mac = self._header_mac.copy()
+    mac.update(entries)
+    mac.update(self._index_struct.pack(chunk_count))
+    mac.update(self._index_struct.pack(data_len))
+    
+    return entries + self._trailer_struct.pack(
+      chunk_count, data_len, mac.digest(), self.index_magic, 0
+    )
+  
+  def write_index(self, file, tags, data_len):
+    """
+    Write the index of a container with `data_len` bytes of data and chunk
+    tags `tags` to its place in `file`, completing the container.
+    """
+    file.seek(self.header_size + data_len)
+    file.write(self.index(tags, data_len))
+    file.truncate()
+
+class ContainerWriter(object):
+  """
+  Write data to a :class:`Container` sequentially.
+  
+  `file` should be a writable binary file object. It does not have to be
+  seekable (e.g. it can be a pipe), and the container is written to it from
+  its current position.
+  
+  `cipher`, `mac_cipher`, `chunk_size` and `nonce` are the same as in
+  :class:`Container`.
+  
+  `executor`, if given, should be a :class:`concurrent.futures.Executor`
+  object to encrypt chunks with in parallel. Up to `max_pending` chunks are
+  submitted to it at a time. Chunks are always written in order.
+  
+  The container is only complete once :meth:`close` is called (or the
+  ``with`` block the object is used in is exited).
+  """
+  
+  def __init__(
+    self,
+    file,
+    cipher,
+    mac_cipher,
+    chunk_size = 64 * 1024,
+    nonce = None,
+    executor = None,
+    max_pending = 8
+  ):
+    self.file = file
+    self.container = Container(cipher, mac_cipher, chunk_size, nonce)
+    self.executor = executor
+    self.max_pending = max_pending
+    
+    self.tags = []
+    self.data_len = 0
+    
+    self._buffer = bytearray()
+    self._pending = deque()
+    self._closed = False
+    
+    file.write(self.container.header())
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+  
+  def _submit(self, data):
+    """
+    Encrypt the next chunk, given its plaintext `data`.
+    """
+    index = len(self.tags) + len(self._pending)
+    pending = self._pending
+    
+    if self.executor is None:
+      self._write(*self.container.encrypt_chunk(index, data))
+      return
+    
+    pending.append(
+      self.executor.submit(self.container.encrypt_chunk, index, data)
+    )
+    while len(pending) > self.max_pending:
+      self._write(*pending.popleft().result())
+  
+  def _write(self, ciphertext, tag):
+    """
+    Write the next encrypted chunk.
+    """
+    self.file.write(ciphertext)
+    self.tags.append(tag)
+  
+  def write(self, data):
+    """
+    Write `data` to the container.
+    """
+    if self._closed:
+      raise ValueError("container is closed")
+    
+    data = memoryview(data).cast("B")
+    self.data_len += len(data)
+    
+    chunk_size = self.container.chunk_size
+    buffer = self._buffer
+    
+    if buffer:
+      fill = chunk_size - len(buffer)
+      buffer += data[0:fill]
+      data = data[fill:]
+      if len(buffer) < chunk_size:
+        return
+      self._submit(bytes(buffer))
+      del buffer[:]
+    
+    last_chunk_start_i = len(data) - len(data) % chunk_size
+    for i in range(0, last_chunk_start_i, chunk_size):
+      self._submit(bytes(data[i:i + chunk_size]))
+    buffer += data[last_chunk_start_i:]
+  
+  def close(self):
+    """
+    Write the last chunk (if any) and the index, completing the container.
+    """
+    if self._closed:
+      return
+    
+    if self._buffer:
+      self._submit(bytes(self._buffer))
+      del self._buffer[:]
+    
+    while self._pending:
+      self._write(*self._pending.popleft().result())
+    
+    self.file.write(self.container.index(self.tags, self.data_len))
+    self._closed = True
+
+class ContainerReader(object):
+  """
+  Read data from a :class:`Container`, in any order.
+  
+  `file` should be a readable, seekable binary file object holding a complete
+  container (starting at its beginning).
+  
+  `cipher` & `mac_cipher` should be the same as the ones the container was
+  written with.
+  
+  The header and index of the container are checked when the object is
+  created, but chunks are only authenticated (and decrypted) when they are
+  read. If any fail authentication, a :exc:`ValueError` exception is raised.
+  
+  Data can be read a chunk at a time with :meth:`read_chunk` (or
+  :meth:`read_chunks`, which can decrypt chunks in parallel), or like a file
+  with :meth:`read`, :meth:`seek` & :meth:`tell`.
+  """
+  
+  def __init__(self, file, cipher, mac_cipher):
+    self.file = file
+    
+    file.seek(0)
+    self.container = container = Container.from_header(
+      file.read(Container.header_size),
+      cipher,
+      mac_cipher
+    )
+    
+    trailer_struct = Container._trailer_struct
+    entry_struct = Container._entry_struct
+    
+    end = file.seek(0, 2)
+    if end < container.header_size + trailer_struct.size:
+      raise ValueError("container is truncated")
+    file.seek(end - trailer_struct.size)
+    chunk_count, data_len, _, index_magic, _ = trailer_struct.unpack(
+      file.read(trailer_struct.size)
+    )
+    if index_magic != Container.index_magic:
+      raise ValueError("container index is missing")
+    
+    index_size = entry_struct.size * chunk_count
+    if (
+      chunk_count != container.chunk_count(data_len)
+      or container.header_size + data_len + index_size + trailer_struct.size
+        != end
+    ):
+      raise ValueError("container is truncated")
+    
+    file.seek(container.header_size + data_len)
+    self.tags = tags = [
+      tag for _, _, _, tag in entry_struct.iter_unpack(file.read(index_size))
+    ]
+    
+    file.seek(container.header_size + data_len)
+    if not compare_digest(
+      container.index(tags, data_len),
+      file.read(index_size + trailer_struct.size)
+    ):
+      raise ValueError("container index failed authentication")
+    
+    self.chunk_count = chunk_count
+    self.data_len = data_len
+    
+    self._position = 0
+    self._chunk = (None, b"")
+  
+  def _read_ciphertext(self, index):
+    """
+    Return the ciphertext of chunk `index`.
+    """
+    if not 0 <= index < self.chunk_count:
+      raise IndexError("chunk index out of range")
+    
+    container = self.container
+    self.file.seek(container.chunk_offset(index))
+    return self.file.read(
+      min(container.chunk_size, self.data_len - index * container.chunk_size)
+    )
+  
+  def read_chunk(self, index):
+    """
+    Return the (authenticated) plaintext of chunk `index`.
+    """
+    return self.container.decrypt_chunk(
+      index,
+      self._read_ciphertext(index),
+      self.tags[index]
+    )
+  
+  def read_chunks(self, indexes = None, executor = None):
+    """
+    Return an iterator over the (authenticated) plaintext of the chunks in
+    `indexes` (all the chunks by default).
+    
+    `executor`, if given, should be a :class:`concurrent.futures.Executor`
+    object to decrypt the chunks with in parallel. The chunks are still
+    returned in order.
+    """
+    if indexes is None:
+      indexes = range(self.chunk_count)
+    
+    if executor is None:
+      for index in indexes:
+        yield self.read_chunk(index)
+      return
+    
+    indexes = list(indexes)
+    for plaintext in executor.map(
+      self.container.decrypt_chunk,
+      indexes,
+      (self._read_ciphertext(index) for index in indexes),
+      (self.tags[index] for index in indexes)
+    ):
+      yield plaintext
+  
+  def readable(self):
+    return True
+  
+  def seekable(self):
+    return True
+  
+  def tell(self):
+    """
+    Return the current position in the data.
+    """
+    return self._position
+  
+  def seek(self, offset, whence = 0):
+    """
+    Change the current position in the data to `offset`, relative to the
+    start (if `whence` is 0), the current position (1) or the end (2).
+    Return the new position.
+    """
+    if whence == 0:
+      position = offset
+    elif whence == 1:
+      position = self._position + offset
+    elif whence == 2:
+      position = self.data_len + offset
+    else:
+      raise ValueError("invalid whence {!r}".format(whence))
+    
+    if position < 0:
+      raise ValueError("negative seek position {}".format(position))
+    
+    self._position = position
+    return position
+  
+  def read(self, size = -1):
+    """
+    Return up to `size` bytes of data (all the data to the end if `size` is
+    negative) from the current position, decrypting only the chunks needed.
+    """
+    position = self._position
+    stop = self.data_len if size < 0 else min(self.data_len, position + size)
+    chunk_size = self.container.chunk_size
+    
+    parts = []
+    while position < stop:
+      index = position // chunk_size
+      if self._chunk[0] != index:
+        self._chunk = (index, self.read_chunk(index))
+      
+      chunk_start = index * chunk_size
+      part = self._chunk[1][position - chunk_start:stop - chunk_start]
+      parts.append(part)
+      position += len(part)
+    
+    self._position = position
+    return b"".join(parts)
+
+class SectorCipher(object):
+  """
+  Sector-addressed encryption, for disk images, database pages, etc.
+  
+  Data is split into sectors of `sector_size` bytes (a multiple of the
+  block-size), each encrypted on its own in Cipher-Block Chaining (CBC) mode
+  with an initialization vector derived from its sector number, the same way
+  as ESSIV: the sector number (as a 64-bit integer) encrypted with a second
+  cipher keyed with the SHA-256 hash of `key`. So any sector can be
+  decrypted or rewritten in place without touching the others, and identical
+  sectors encrypt differently at different sector numbers.
+  
+  `key` and `byte_order` are the same as in :class:`Cipher`.
+  
+  Many sectors can be encrypted or decrypted at once, in place, in any
+  writable buffer (e.g. an :class:`mmap.mmap` of an image file), with
+  :meth:`encrypt_in_place` & :meth:`decrypt_in_place`, optionally spread
+  across a :class:`concurrent.futures.Executor` (this object can be
+  pickled, so process pools work too).
+  """
+  
+  def __init__(self, key, sector_size = 512, byte_order = "big"):
+    if sector_size <= 0 or sector_size % 8:
+      raise ValueError("sector size is not a multiple of the block-size")
+    
+    self.sector_size = sector_size
+    self.cipher = Cipher(key, byte_order)
+    self.iv_cipher = Cipher(sha256(key).digest(), byte_order)
+  
+  def sector_iv(self, sector):
+    """
+    Return the initialization vector of sector number `sector`.
+    """
+    iv_cipher = self.iv_cipher
+    return iv_cipher.encrypt_u64(sector).to_bytes(8, iv_cipher.byte_order)
+  
+  def encrypt_sector(self, sector, data):
+    """
+    Return the encryption of sector number `sector`, given its plaintext
+    `data`, as a :obj:`bytes` object.
+    
+    `data` should be a :obj:`bytes`-like object of `sector_size` bytes.
+    If it is not, a :exc:`ValueError` exception is raised.
+    """
+    if len(data) != self.sector_size:
+      raise ValueError("data is not {} bytes in length".format(
+        self.sector_size
+      ))
+    return b"".join(self.cipher.encrypt_cbc(data, self.sector_iv(sector)))
+  
+  def decrypt_sector(self, sector, data):
+    """
+    Return the decryption of sector number `sector`, given its ciphertext
+    `data`, as a :obj:`bytes` object.
+    
+    `data` should be a :obj:`bytes`-like object of `sector_size` bytes.
+    If it is not, a :exc:`ValueError` exception is raised.
+    """
+    if len(data) != self.sector_size:
+      raise ValueError("data is not {} bytes in length".format(
+        self.sector_size
+      ))
+    return b"".join(self.cipher.decrypt_cbc(data, self.sector_iv(sector)))
+  
+  def _crypt_sectors(self, decrypt, sectors, data):
+    """
+    Return a list of sector numbers `sectors` encrypted (or decrypted, if
+    `decrypt` is true), given their contents `data`.
+    """
+    crypt_sector = self.decrypt_sector if decrypt else self.encrypt_sector
+    return [
+      crypt_sector(sector, sector_data)
+      for sector, sector_data in zip(sectors, data)
+    ]
+  
+  def _crypt_in_place(
+    self,
+    decrypt,
+    buffer,
+    sectors,
+    executor,
+    batch_size,
+    max_pending
+  ):
+    """
+    Encrypt (or decrypt, if `decrypt` is true) sector numbers `sectors` of
+    `buffer` in place.
+    """
+    sector_size = self.sector_size
+    
+    with memoryview(buffer) as buffer_view, buffer_view.cast("B") as view:
+      sector_count = len(view) // sector_size
+      if sectors is None:
+        sectors = range(0, sector_count)
+      elif not isinstance(sectors, range):
+        sectors = list(sectors)
+      
+      # Check every sector number before anything is written, so that a bad
+      # one leaves the buffer untouched rather than partly encrypted.
+      if sectors and (min(sectors) < 0 or max(sectors) >= sector_count):
+        raise ValueError("sector number out of range")
+      
+      def read(batch):
+        return [
+          bytes(view[sector * sector_size:(sector + 1) * sector_size])
+          for sector in batch
+        ]
+      
+      def write(batch, batch_data):
+        for sector, sector_data in zip(batch, batch_data):
+          view[sector * sector_size:(sector + 1) * sector_size] = sector_data
+      
+      def iter_batches():
+        batch = []
+        for sector in sectors:
+          batch.append(sector)
+          if len(batch) == batch_size:
+            yield batch
+            batch = []
+        if batch:
+          yield batch
+      
+      batches = iter_batches()
+      
+      if executor is None:
+        for batch in batches:
+          write(batch, self._crypt_sectors(decrypt, batch, read(batch)))
+        return
+      
+      # Keep a bounded number of batches in flight, so that a whole image is
+      # not copied into the executor's queue at once.
+      pending = deque()
+      for batch in batches:
+        pending.append((
+          batch,
+          executor.submit(self._crypt_sectors, decrypt, batch, read(batch))
+        ))
+        while len(pending) > max_pending:
+          batch, future = pending.popleft()
+          write(batch, future.result())
+      while pending:
+        batch, future = pending.popleft()
+        write(batch, future.result())
+  
+  def encrypt_in_place(
+    self,
+    buffer,
+    sectors = None,
+    executor = None,
+    batch_size = 64,
+    max_pending = 8
+  ):
+    """
+    Encrypt sectors of `buffer` in place.
+    
+    `buffer` should be a writable :obj:`bytes`-like object (e.g. a
+    :obj:`bytearray` or an :class:`mmap.mmap` object) holding sector 0 at
+    its start, sector 1 after it, etc.
+    
+    `sectors` should be an iterable (e.g. a :obj:`list` or :obj:`range`) of
+    the sector numbers to encrypt. By default, every whole sector in `buffer`
+    is. If a sector is not within `buffer`, a :exc:`ValueError` exception is
+    raised before any sector is encrypted.
+    
+    `executor`, if given, should be a :class:`concurrent.futures.Executor`
+    object to encrypt sectors with in parallel, `batch_size` sectors per
+    task, with up to `max_pending` tasks submitted to it at a time.
+    """
+    self._crypt_in_place(
+      False, buffer, sectors, executor, batch_size, max_pending
+    )
+  
+  def decrypt_in_place(
+    self,
+    buffer,
+    sectors = None,
+    executor = None,
+    batch_size = 64,
+    max_pending = 8
+  ):
+    """
+    Decrypt sectors of `buffer` in place.
+    
+    `buffer`, `sectors`, `executor`, `batch_size` and `max_pending` are the
+    same as in :meth:`encrypt_in_place`.
+    """
+    self._crypt_in_place(
+      True, buffer, sectors, executor, batch_size, max_pending
+    )
+
+class PageCache(object):
+  """
+  Memory-bounded LRU cache of the decrypted pages of a file encrypted with a
+  :class:`SectorCipher` (each page being a sector).
+  
+  `file` should be a readable (and, to use :meth:`write_page`, writable)
+  seekable binary file object holding the encrypted sectors, sector 0 first.
+  
+  `sector_cipher` should be the :class:`SectorCipher` object the file was
+  encrypted with. Its `sector_size` is the page size.
+  
+  At most `max_size` bytes worth of decrypted pages are kept. When another
+  page is needed, the least recently used one is evicted.
+  
+  The object can be shared by several threads. If some of them ask for the
+  same page while it is being decrypted, they all wait for that one
+  decryption instead of repeating it.
+  
+  The :attr:`hits` (including reads that waited for another thread's
+  decryption), :attr:`misses`, :attr:`evictions` and :attr:`invalidations`
+  attributes count what happened so far, and :attr:`hit_rate` is the
+  fraction of page reads that did not have to decrypt the page themselves.
+  """
+  
+  def __init__(self, file, sector_cipher, max_size = 4 * 1024 * 1024):
+    self.file = file
+    self.sector_cipher = sector_cipher
+    self.page_size = sector_cipher.sector_size
+    self.max_pages = max(1, max_size // self.page_size)
+    
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+    
+    import threading
+    
+    self._pages = OrderedDict()
+    self._loading = {}
+    self._stale = set()
+    self._lock = threading.Lock()
+    self._file_lock = threading.Lock()
+  
+  @property
+  def hit_rate(self):
+    """
+    Fraction of page reads that did not decrypt the page themselves (0 if
+    there were none yet).
+    """
+    reads = self.hits + self.misses
+    return self.hits / reads if reads else 0.0
+  
+  def __len__(self):
+    return len(self._pages)
+  
+  def _load(self, page):
+    """
+    Return the decryption of `page` read from the file.
+    """
+    page_size = self.page_size
+    with self._file_lock:
+      self.file.seek(page * page_size)
+      data = self.file.read(page_size)
+    if not data:
+      raise ValueError("page {} is not in the file".format(page))
+    if len(data) != page_size:
+      raise ValueError("page {} is truncated".format(page))
+    return self.sector_cipher.decrypt_sector(page, data)
+  
+  def read_page(self, page):
+    """
+    Return the decrypted contents of page number `page` as a :obj:`bytes`
+    object.
+    """
+    if page < 0:
+      raise ValueError("page number is negative")
+    
+    with self._lock:
+      data = self._pages.get(page)
+      if data is not None:
+        self._pages.move_to_end(page)
+        self.hits += 1
+        return data
+      
+      future = self._loading.get(page)
+      if future is None:
+        from concurrent.futures import Future
+        
+        self.misses += 1
+        future = self._loading[page] = Future()
+        future.set_running_or_notify_cancel()
+        loading = True
+      else:
+        self.hits += 1
+        loading = False
+    
+    if not loading:
+      # Someone else is already decrypting it.
+      return future.result()
+    
+    try:
+      data = self._load(page)
+    except BaseException as e:
+      with self._lock:
+        del self._loading[page]
+        self._stale.discard(page)
+      future.set_exception(e)
+      raise
+    
+    with self._lock:
+      del self._loading[page]
+      # Don't cache it if the page was written to while it was being read.
+      if page in self._stale:
+        self._stale.remove(page)
+      else:
+        self._pages[page] = data
+        while len(self._pages) > self.max_pages:
+          self._pages.popitem(last = False)
+          self.evictions += 1
+    
+    future.set_result(data)
+    return data
+  
+  def read(self, offset, size):
+    """
+    Return up to `size` bytes of decrypted data, starting `offset` bytes into
+    the file, reading whole pages through the cache.
+    
+    Fewer bytes are returned only when the end of the file is reached. A
+    truncated last page raises :exc:`ValueError` like any other bad page.
+    """
+    page_size = self.page_size
+    with self._file_lock:
+      file_size = self.file.seek(0, 2)
+    parts = []
+    stop = min(offset + size, file_size)
+    while offset < stop:
+      page, page_offset = divmod(offset, page_size)
+      data = self.read_page(page)
+      part = data[page_offset:page_offset + stop - offset]
+      parts.append(part)
+      offset += len(part)
+    return b"".join(parts)
+  
+  def invalidate(self, page = None):
+    """
+    Drop page number `page` (or all pages if it is ``None``) from the cache.
+    """
+    with self._lock:
+      if page is None:
+        self.invalidations += len(self._pages)
+        self._pages.clear()
+        self._stale.update(self._loading)
+      else:
+        if self._pages.pop(page, None) is not None:
+          self.invalidations += 1
+        if page in self._loading:
+          self._stale.add(page)
+  
+  def write_page(self, page, data):
+    """
+    Encrypt `data` and write it to page number `page` in the file,
+    invalidating the cached copy of the page.
+    
+    `data` should be a :obj:`bytes`-like object of `page_size` bytes.
+    """
+    if page < 0:
+      raise ValueError("page number is negative")
+    
+    encrypted = self.sector_cipher.encrypt_sector(page, data)
+    with self._file_lock:
+      self.file.seek(page * self.page_size)
+      self.file.write(encrypted)
+    self.invalidate(page)
+
+class Random(object):
+  """
+  Deterministic generator of random bytes, seeded by `key` and `nonce`.
+  
+  The bytes are the keystream of a :class:`Cipher` keyed with `key` (and
+  interpreting bytes in `byte_order`) in Counter (CTR) mode, with the counter
+  for block ``n`` being ``nonce ^ n`` (i.e. the same as
+  ``cipher.encrypt_ctr(bytes(size), ctr_counter(nonce, operator.xor))``).
+  So the same `key` and `nonce` always give the same bytes, and different
+  nonces give independent streams.
+  
+  `nonce` should be a 64-bit integer.
+  
+  Keystream is generated `batch_size` bytes at a time (rounded up to a
+  multiple of the block-size) and handed out from there.
+  
+  :meth:`jumpahead` skips over part of the stream without generating it, so
+  that e.g. shard ``i`` of a data set can start at block ``i * shard_blocks``
+  and be generated in parallel with the others, without any overlap.
+  
+  This is not meant to be used for anything that needs to be unpredictable
+  (e.g. keys), and the stream repeats after 2^64 blocks.
+  """
+  
+  def __init__(self, key, nonce = 0, byte_order = "big", batch_size = 64 * 1024):
+    if not 0 <= nonce <= 0xffffffffffffffff:
+      raise ValueError("nonce is not a 64-bit unsigned integer")
+    
+    if batch_size <= 0:
+      raise ValueError("batch size is not positive")
+    
+    self.cipher = Cipher(key, byte_order)
+    self.nonce = nonce
+    self.batch_blocks = -(-batch_size // 8)
+    
+    self._block = 0
+    self._buffer = b""
+    self._offset = 0
+  
+  def _refill(self):
+    """
+    Replace the buffer with the next batch of keystream.
+    """
+    cipher = self.cipher
+    encrypt = cipher._encrypt
+    u4_2_pack = cipher._u4_2_pack
+    nonce = self.nonce
+    
+    start = self._block
+    stop = start + self.batch_blocks
+    
+    # Blocks are numbered modulo 2^64, like ctr_counter does.
+    counters = (
+      nonce ^ n & 0xffffffffffffffff for n in range(start, stop)
+    )
+    if cipher.byte_order == "big":
+      self._buffer = b"".join([
+        u4_2_pack(*encrypt(c >> 32, c & 0xffffffff)) for c in counters
+      ])
+    else:
+      self._buffer = b"".join([
+        u4_2_pack(*encrypt(c & 0xffffffff, c >> 32)) for c in counters
+      ])
+    self._offset = 0
+    self._block = stop
+  
+  def tell(self):
+    """
+    Return the position in the stream, in bytes.
+    """
+    return self._block * 8 - len(self._buffer) + self._offset
+  
+  def jumpahead(self, blocks):
+    """
+    Skip the next `blocks` blocks (8 bytes each) of the stream, as if
+    ``randbytes(8 * blocks)`` had been called, without generating them.
+    """
+    if blocks < 0:
+      raise ValueError("can not jump backwards")
+    
+    position = self.tell() + 8 * blocks
+    self._block = position // 8
+    self._buffer = b""
+    self._offset = 0
+    if position % 8:
+      self._refill()
+      self._offset = position % 8
+  
+  def randbytes(self, n):
+    """
+    Return the next `n` bytes of the stream as a :obj:`bytes` object.
+    """
+    buffer = bytearray(n)
+    self.readinto(buffer)
+    return bytes(buffer)
+  
+  def readinto(self, buffer):
+    """
+    Fill the writable :obj:`bytes`-like object `buffer` with the next
+    ``len(buffer)`` bytes of the stream, and return that number.
+    """
+    buffer = memoryview(buffer).cast("B")
+    buffer_len = len(buffer)
+    
+    i = 0
+    while i < buffer_len:
+      if self._offset == len(self._buffer):
+        self._refill()
+      
+      offset = self._offset
+      n = min(buffer_len - i, len(self._buffer) - offset)
+      buffer[i:i + n] = self._buffer[offset:offset + n]
+      self._offset = offset + n
+      i += n
+    
+    return buffer_len
+
+class ScheduleCache(object):
+  """
+  Persistent, on-disk cache of key schedules (i.e. the subkey P arrays and
+  S-boxes derived from keys), to be passed to :class:`Cipher` as its
+  `schedule_cache` argument.
+  
+  Deriving a key schedule takes 521 block encryptions. Loading one from the
+  cache only takes reading a small (4 KiB or so) file, which makes it well
+  suited to short-lived processes that keep using the same keys.
+  
+  `directory` is the directory the schedules are saved in. It is created
+  (only accessible by its owner) if it does not exist.
+  
+  `max_size` is the maximum total size, in bytes, of the saved schedules.
+  When it is exceeded, the least recently used schedules are evicted.
+  
+  Each schedule is saved to its own file, named after a SHA-256 hash of the
+  key and the `P_array` & `S_boxes` it was derived from, with the following
+  fixed (little-endian) layout:
+  
+  ============  ========  =============================================
+  Offset        Size      Contents
+  ============  ========  =============================================
+  0             4         Magic number ``b"BFKS"``
+  4             2         Format version (1)
+  6             2         Reserved (0)
+  8             4         Number n of 32-bit integers in the P array
+  12            4         Reserved (0)
+  16            32        SHA-256 hash identifying the schedule
+  48            4 * n     Subkey P array
+  48 + 4 * n    4096      S-boxes
+  4144 + 4 * n  32        SHA-256 hash of everything before it
+  ============  ========  =============================================
+  
+  Files that fail any of the integrity checks are treated as missing and
+  are deleted. I/O errors are also treated as misses, so the cache never
+  prevents a :class:`Cipher` from being created.
+  
+  The number of :attr:`hits`, :attr:`misses` and :attr:`evictions` are
+  counted for the life of the object.
+  
+  .. warning::
+      
+      A key schedule is as good as the key it was derived from, so the cache
+      directory should be protected just as well as the keys are.
+  """
+  
+  magic = b"BFKS"
+  version = 1
+  suffix = ".bfks"
+  
+  _header_struct = Struct("<4sHHII32s")
+  
+  def __init__(self, directory, max_size = 16 * 1024 * 1024):
+    self.directory = str(directory)
+    self.max_size = max_size
+    
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    
+    os.makedirs(self.directory, 0o700, exist_ok = True)
+    
+  def _schedule_id(self, key, P_array, S_boxes):
+    """
+    Return the SHA-256 hash identifying the schedule derived from `key`,
+    `P_array` and `S_boxes`.
+    """
+    n = len(P_array)
+    h = sha256(b"blowfish key schedule\x00")
+    h.update(Struct("<BI").pack(len(key), n))
+    h.update(key)
+    h.update(Struct("<{}I".format(n)).pack(*P_array))
+    h.update(Struct("<1024I").pack(*chain.from_iterable(S_boxes)))
+    return h.digest()
+  
+  def _path(self, schedule_id):
+    """
+    Return the path of the file the schedule identified by `schedule_id` is
+    saved in.
+    """
+    return os.path.join(
+      self.directory,
+      hexlify(schedule_id).decode() + self.suffix
+    )
+  
+  def _parse(self, buffer, schedule_id, n):
+    """
+    Return the subkey P array & S-boxes saved in `buffer`, or ``None`` if it
+    fails any of the integrity checks.
+    """
+    header_size = self._header_struct.size
+    if len(buffer) != header_size + 4 * n + 4096 + 32:
+      return None
+    
+    magic, version, _, saved_n, _, saved_id = self._header_struct.unpack_from(
+      buffer
+    )
+    if (
+      magic != self.magic
+      or version != self.version
+      or saved_n != n
+      or saved_id != schedule_id
+    ):
+      return None
+    
+    if not compare_digest(sha256(buffer[:-32]).digest(), bytes(buffer[-32:])):
+      return None
+    
+    values = array(_U4_TYPECODE)
+    values.frombytes(buffer[header_size:-32])
+    if sys.byteorder != "little":
+      values.byteswap()
+    
+    P = tuple(zip(values[0:n:2], values[1:n:2]))
+    S = tuple(
+      tuple(values[i:i + 256]) for i in range(n, n + 1024, 256)
+    )
+    return P, S
+  
+  def load(self, key, P_array = PI_P_ARRAY, S_boxes = PI_S_BOXES):
+    """
+    Return the subkey P array & S-boxes derived from `key`, `P_array` and
+    `S_boxes` if they are in the cache, otherwise ``None``.
+    """
+    schedule_id = self._schedule_id(key, P_array, S_boxes)
+    path = self._path(schedule_id)
+    
+    try:
+      with open(path, "rb") as f:
+        schedule = self._parse(f.read(), schedule_id, len(P_array))
+    except (OSError, ValueError):
+      schedule = None
+    else:
+      if schedule is None:
+        self._remove(path)
+    
+    if schedule is None:
+      self.misses += 1
+      return None
+    
+    self.hits += 1
+    try:
+      # Keep track of when the schedule was last used, for eviction.
+      os.utime(path)
+    except OSError:
+      pass
+    return schedule
+  
+  def store(self, key, P_array, S_boxes, P, S):
+    """
+    Save the subkey P array `P` & S-boxes `S`, derived from `key`, `P_array`
+    and `S_boxes`, to the cache, evicting the least recently used schedules if
+    the cache grows over :attr:`max_size`.
+    """
+    schedule_id = self._schedule_id(key, P_array, S_boxes)
+    path = self._path(schedule_id)
+    
+    values = array(
+      _U4_TYPECODE,
+      chain(chain.from_iterable(P), chain.from_iterable(S))
+    )
+    if sys.byteorder != "little":
+      values.byteswap()
+    
+    contents = self._header_struct.pack(
+      self.magic, self.version, 0, len(P) * 2, 0, schedule_id
+    ) + values.tobytes()
+    contents += sha256(contents).digest()
+    
+    # Write to a temporary file first and then move it into place, so that
+    # other processes never see a partially written schedule.
+    temp_path = "{}.{}.tmp".format(path, hexlify(urandom(8)).decode())
+    try:
+      fd = os.open(
+        temp_path,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+        0o600
+      )
+      with open(fd, "wb") as f:
+        f.write(contents)
+      os.replace(temp_path, path)
+    except OSError:
+      self._remove(temp_path)
+      return
+    
+    self._evict()
+  
+  def _remove(self, path):
+    """
+    Remove the file at `path`, if possible.
+    """
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+  
+  def _entries(self):
+    """
+    Return a list of ``(last_used, size, path)`` tuples of the saved
+    schedules.
+    """
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith(self.suffix):
+        continue
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+  
+  def _evict(self):
+    """
+    Remove the least recently used schedules until the total size of the
+    cache is no more than :attr:`max_size`.
+    """
+    entries = self._entries()
+    size = sum(entry_size for _, entry_size, _ in entries)
+    if size <= self.max_size:
+      return
+    
+    for _, entry_size, path in sorted(entries):
+      self._remove(path)
+      self.evictions += 1
+      size -= entry_size
+      if size <= self.max_size:
+        break
+  
+  def size(self):
+    """
+    Return the total size, in bytes, of the saved schedules.
+    """
+    return sum(entry_size for _, entry_size, _ in self._entries())
+  
+  def clear(self):
+    """
+    Remove all the saved schedules.
+    """
+    for _, _, path in self._entries():
+      self._remove(path)
+
+def _restore_cipher(byte_order, P, S, fuse_S_boxes, buffer_S_boxes = False):
+  """
+  Return a :class:`Cipher` object with the given key schedule (used to unpickle
+  :class:`Cipher` objects).
+  """
+  cipher = Cipher.__new__(Cipher)
+  cipher._init_byte_order(byte_order)
+  cipher._init_schedule(P, S, fuse_S_boxes, buffer_S_boxes)
+  return cipher
+
+def freeze_schedules(ciphers = (), freeze_gc = False):
+  """
+  Prepare key schedules to be shared with worker processes forked from this
+  one (e.g. by a pre-fork server), without each worker ending up with its own
+  copy of the memory they are in.
+  
+  Each :class:`Cipher` object in `ciphers` is switched over to buffer-backed
+  S-boxes (as if it had been created with ``buffer_S_boxes = True``), so
+  using it does not write to the pages holding them.
+  
+  If `freeze_gc` is true (and on Python 3.7+), a garbage collection is also
+  run and :func:`gc.freeze` is called, so that collections in the workers do
+  not write to the pages either.
+  
+  .. warning::
+      
+      :func:`gc.freeze` is process-wide: it moves *every* object in the
+      interpreter (not just the ciphers) out of reach of the garbage
+      collector, until :func:`gc.unfreeze` is called. Only pass
+      ``freeze_gc = True`` in the parent process of a pre-fork server, right
+      before forking.
+  """
+  for cipher in ciphers:
+    if not isinstance(cipher.S[0], array):
+      cipher._init_schedule(
+        cipher.P,
+        cipher.S,
+        cipher.S12 is not None,
+        buffer_S_boxes = True
+      )
+  
+  if freeze_gc and hasattr(gc, "freeze"):
+    gc.collect()
+    gc.freeze()
+
+def _iter_chunks(src, chunk_size):
+  """
+  Return an iterator over `chunk_size` byte chunks (the last one possibly
+  shorter) of `src`, a :obj:`bytes`-like object or readable binary file object.
+  """
+  if not hasattr(src, "read"):
+    view = memoryview(src).cast("B")
+    for i in range(0, len(view), chunk_size):
+      yield view[i:i + chunk_size]
+    return
+  
+  # Reads may return less than asked for (e.g. from pipes).
+  buffer = bytearray()
+  while True:
+    data = src.read(chunk_size - len(buffer))
+    if not data:
+      break
+    buffer += data
+    if len(buffer) == chunk_size:
+      yield bytes(buffer)
+      del buffer[:]
+  if buffer:
+    yield bytes(buffer)
+
+def _chunk_args_function(mode, direction, args):
+  """
+  Return a function that, given the next chunk of data (a whole number of
+  blocks, except for the last chunk), returns the arguments (after `data`) the
+  `direction` `mode` method needs to process that chunk on its own, given
+  the arguments `args` for all the data. The counter blocks of CTR mode are
+  returned as lists, so that they can be pickled.
+  
+  If `mode` can not process chunks independently in `direction`, ``None`` is
+  returned.
+  """
+  if mode == "ecb":
+    return lambda chunk: ()
+  
+  if mode == "ctr":
+    counter = iter(args[0])
+    return lambda chunk: (list(islice(counter, -(-len(chunk) // 8))),)
+  
+  if direction == "decrypt" and mode in ("cbc", "cfb"):
+    init_vectors = [bytes(args[0])]
+    
+    def chunk_args(chunk):
+      init_vectors.append(bytes(chunk[-8:]))
+      return (init_vectors.pop(0),)
+    
+    return chunk_args
+  
+  return None
+
+# Ciphers rebuilt in this process from schedules pickled by _WorkerCipher
+# (i.e. in the worker processes of an executor), most recently used last.
+_worker_ciphers = OrderedDict()
+_max_worker_ciphers = 8
+
+def _worker_cipher(schedule):
+  """
+  Return the :class:`Cipher` object pickled into `schedule`, only unpickling
+  it the first time this process sees it.
+  """
+  try:
+    _worker_ciphers.move_to_end(schedule)
+    return _worker_ciphers[schedule]
+  except KeyError:
+    import pickle
+    
+    cipher = _worker_ciphers[schedule] = pickle.loads(schedule)
+    if len(_worker_ciphers) > _max_worker_ciphers:
+      _worker_ciphers.popitem(last = False)
+    return cipher
+
+class _WorkerCipher(object):
+  """
+  Stands in for `cipher` in the arguments of the tasks submitted to a process
+  pool, so that the cipher is pickled once rather than for every chunk, and
+  each worker process rebuilds it (e.g. fuses its S-boxes again) only once
+  (see :func:`_worker_cipher`).
+  """
+  
+  def __init__(self, cipher):
+    import pickle
+    
+    self._schedule = pickle.dumps(cipher, pickle.HIGHEST_PROTOCOL)
+  
+  def __reduce__(self):
+    return _worker_cipher, (self._schedule,)
+
+def _task_cipher(cipher, executor):
+  """
+  Return what to pass `cipher` as to the tasks submitted to `executor`.
+  """
+  from concurrent.futures import ProcessPoolExecutor
+  
+  if isinstance(executor, ProcessPoolExecutor):
+    return _WorkerCipher(cipher)
+  return cipher
+
+def _crypt_chunk(cipher, mode, direction, args, data):
+  """
+  Return `data` encrypted or decrypted (depending on `direction`) with `cipher`
+  in `mode`, given the arguments returned for it by a function from
+  :func:`_chunk_args_function`.
+  """
+  if mode == "ctr":
+    args = (iter(args[0]),)
+  return b"".join(getattr(cipher, direction + "_" + mode)(data, *args))
+
+def _reencrypt_chunk(
+  old_cipher,
+  old_mode,
+  old_args,
+  new_cipher,
+  new_mode,
+  new_args,
+  data
+):
+  """
+  Return `data` decrypted with `old_cipher` in `old_mode` and encrypted with
+  `new_cipher` in `new_mode` (used by :func:`reencrypt` to re-encrypt chunks in
+  parallel).
+  """
+  return _crypt_chunk(
+    new_cipher, new_mode, "encrypt", new_args,
+    _crypt_chunk(old_cipher, old_mode, "decrypt", old_args, data)
+  )
+
+def reencrypt(
+  src,
+  old_cipher,
+  old_mode,
+  new_cipher,
+  new_mode,
+  old_args = (),
+  new_args = (),
+  old_padding = None,
+  new_padding = None,
+  chunk_size = None,
+  executor = None,
+  max_pending = 8
+):
+  """
+  Return an iterator that re-encrypts `src` (e.g. to rotate keys): decrypts
+  it with `old_cipher` in `old_mode` (one of :data:`blowfish.MODES`) and
+  encrypts the result with `new_cipher` in `new_mode`, a chunk at a time.
+  
+  `src` should be a :obj:`bytes`-like object or a readable binary file
+  object.
+  
+  `old_args` & `old_padding` (and `new_args` & `new_padding`) are the
+  arguments after `data` and the `padding` of the corresponding methods,
+  e.g. ``old_args = (iv,)`` for CBC mode or ``new_args = (counter,)`` for CTR
+  mode.
+  
+  Each iteration returns the re-encrypted :obj:`bytes` of (roughly) one
+  `chunk_size` byte chunk of `src`, which should be a multiple of the
+  block-size. Only the plaintext of the chunk being worked on is ever held in
+  memory.
+  
+  `executor`, if given, should be a :class:`concurrent.futures.Executor`
+  object to re-encrypt up to `max_pending` chunks with in parallel. That's
+  only possible when every chunk can be decrypted without the ones before it
+  (ECB, CBC, CFB or CTR `old_mode`) and encrypted without them (ECB or CTR
+  `new_mode`), without padding. Otherwise, `executor` is not used.
+  
+  If `chunk_size` is ``None``, it (and `executor`, unless given) is picked by
+  :data:`blowfish.autotuner` (for decrypting in `old_mode`), if set, or is
+  64 KB otherwise.
+  """
+  chunk_size, executor = _tuned_settings(
+    chunk_size, executor, old_mode, "decrypt", _stream_size(src)
+  )
+  if chunk_size <= 0 or chunk_size % 8:
+    raise ValueError("chunk size is not a multiple of the block-size")
+  
+  chunks = _iter_chunks(src, chunk_size)
+  
+  old_chunk_args = _chunk_args_function(old_mode, "decrypt", old_args)
+  new_chunk_args = _chunk_args_function(new_mode, "encrypt", new_args)
+  
+  if (
+    executor is None
+    or old_chunk_args is None
+    or new_chunk_args is None
+    or old_padding is not None
+    or new_padding is not None
+  ):
+    decryptor = old_cipher.decryptor(old_mode, *old_args, padding = old_padding)
+    encryptor = new_cipher.encryptor(new_mode, *new_args, padding = new_padding)
+    
+    for chunk in chunks:
+      out = encryptor.update(decryptor.update(chunk))
+      if out:
+        yield out
+    
+    out = encryptor.update(decryptor.finalize()) + encryptor.finalize()
+    if out:
+      yield out
+    return
+  
+  old_task_cipher = _task_cipher(old_cipher, executor)
+  new_task_cipher = _task_cipher(new_cipher, executor)
+  
+  pending = deque()
+  for chunk in chunks:
+    chunk = bytes(chunk)
+    pending.append(
+      executor.submit(
+        _reencrypt_chunk,
+        old_task_cipher, old_mode, old_chunk_args(chunk),
+        new_task_cipher, new_mode, new_chunk_args(chunk),
+        chunk
+      )
+    )
+    while len(pending) > max_pending:
+      yield pending.popleft().result()
+  
+  while pending:
+    yield pending.popleft().result()
+
+class PipelineStats(object):
+  """
+  Statistics of a :func:`pipeline` run.
+  
+  :attr:`bytes_in` & :attr:`bytes_out` are the number of bytes read and
+  written, :attr:`elapsed` the number of seconds the run took, and
+  :attr:`busy` maps each stage (``"read"``, ``"cipher"`` and ``"write"``) to
+  the number of seconds it spent working rather than waiting on the other
+  stages.
+  """
+  
+  stages = ("read", "cipher", "write")
+  
+  def __init__(self):
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.elapsed = 0.0
+    self.busy = dict.fromkeys(self.stages, 0.0)
+  
+  def utilization(self):
+    """
+    Return a :obj:`dict` mapping each stage to the fraction of the run it was
+    busy.
+    """
+    return {
+      stage: busy / self.elapsed if self.elapsed else 0.0
+      for stage, busy in self.busy.items()
+    }
+  
+  def __repr__(self):
+    return "{}(bytes_in={}, bytes_out={}, elapsed={:.3f}, {})".format(
+      type(self).__name__,
+      self.bytes_in,
+      self.bytes_out,
+      self.elapsed,
+      ", ".join(
+        "{}={:.0%}".format(stage, utilization)
+        for stage, utilization in sorted(self.utilization().items())
+      )
+    )
+
+def pipeline(
+  reader,
+  writer,
+  cipher,
+  mode,
+  *args,
+  direction = "encrypt",
+  padding = None,
+  chunk_size = None,
+  queue_size = 4,
+  executor = None
+):
+  """
+  Encrypt (or decrypt, depending on `direction`) everything read from
+  `reader`, a readable binary file object (e.g. a file or pipe), with `cipher`
+  in `mode` and write the result to `writer`, a writable binary file object,
+  overlapping the reads, the encryption and the writes.
+  
+  `mode` should be one of :data:`blowfish.MODES`, and `args` & `padding` are
+  the same as for the corresponding method (e.g. ``pipeline(src, dst, cipher,
+  "cbc", iv)``).
+  
+  Reading and writing each run in their own thread, passing `chunk_size` byte
+  chunks through queues of at most `queue_size` chunks, so a stage that gets
+  ahead waits for the others (and memory use stays bounded).
+  
+  `executor`, if given, should be a :class:`concurrent.futures.Executor`
+  object to fan the chunks out to, for modes that can process chunks
+  independently (ECB & CTR mode, and CBC & CFB mode decryption) without
+  padding. The output is still written in order.
+  
+  If `chunk_size` is ``None``, it (and `executor`, unless given) is picked by
+  :data:`blowfish.autotuner`, if set, or is 64 KB otherwise.
+  
+  Return a :class:`PipelineStats` object.
+  """
+  if direction not in ("encrypt", "decrypt"):
+    raise ValueError("direction must either be 'encrypt' or 'decrypt'")
+  chunk_size, executor = _tuned_settings(
+    chunk_size, executor, mode, direction, _stream_size(reader)
+  )
+  if chunk_size <= 0 or chunk_size % 8:
+    raise ValueError("chunk size is not a multiple of the block-size")
+  
+  import threading
+  from queue import Queue, Empty
+  
+  stats = PipelineStats()
+  busy = stats.busy
+  errors = []
+  in_queue = Queue(queue_size)
+  out_queue = Queue(queue_size)
+  
+  chunk_args = None
+  if executor is not None and padding is None:
+    chunk_args = _chunk_args_function(mode, direction, args)
+  if chunk_args is None:
+    context = CipherContext(cipher, mode, direction, args, padding)
+  else:
+    task_cipher = _task_cipher(cipher, executor)
+  
+  def read_stage():
+    try:
+      chunks = _iter_chunks(reader, chunk_size)
+      while not errors:
+        start = perf_counter()
+        chunk = next(chunks, None)
+        busy["read"] += perf_counter() - start
+        if chunk is None:
+          break
+        stats.bytes_in += len(chunk)
+        in_queue.put(chunk)
+    except BaseException as e:
+      errors.append(e)
+    finally:
+      in_queue.put(None)
+  
+  def write_stage():
+    while True:
+      data = out_queue.get()
+      if data is None:
+        break
+      if errors:
+        # Keep draining the queue, so that the other stages don't block.
+        continue
+      try:
+        start = perf_counter()
+        writer.write(data)
+        busy["write"] += perf_counter() - start
+        stats.bytes_out += len(data)
+      except BaseException as e:
+        errors.append(e)
+  
+  def cipher_stage(chunk):
+    start = perf_counter()
+    if chunk is None:
+      out = [future.result() for future in pending]
+      if chunk_args is None:
+        out.append(context.finalize())
+    elif chunk_args is None:
+      out = [context.update(chunk)]
+    else:
+      pending.append(
+        executor.submit(
+          _crypt_chunk, task_cipher, mode, direction, chunk_args(chunk), chunk
+        )
+      )
+      out = [pending.popleft().result()] if len(pending) > queue_size else []
+    busy["cipher"] += perf_counter() - start
+    
+    for data in out:
+      if data:
+        out_queue.put(data)
+  
+  threads = [
+    threading.Thread(target = read_stage),
+    threading.Thread(target = write_stage)
+  ]
+  run_start = perf_counter()
+  for thread in threads:
+    thread.start()
+  
+  pending = deque()
+  try:
+    while True:
+      chunk = in_queue.get()
+      # After an error, keep taking chunks until the reader is done, so that
+      # it doesn't block on a full queue.
+      if not errors:
+        try:
+          cipher_stage(chunk)
+        except BaseException as e:
+          errors.append(e)
+      if chunk is None:
+        break
+  except BaseException as e:
+    # E.g. KeyboardInterrupt while waiting on the reader.
+    errors.append(e)
+    raise
+  finally:
+    out_queue.put(None)
+    while threads[0].is_alive():
+      try:
+        in_queue.get(timeout = 0.1)
+      except Empty:
+        pass
+    for thread in threads:
+      thread.join()
+    stats.elapsed = perf_counter() - run_start
+  
+  if errors:
+    raise errors[0]
+  
+  return stats
+
+# Autotuner used by the bulk & streaming functions when they're not given a
+# chunk size (see Autotuner).
+autotuner = None
+
+TuningDecision = namedtuple("TuningDecision", "chunk_size workers source")
+
+class Autotuner(object):
+  """
+  Picks the chunk size and number of worker processes that :func:`pipeline`
+  and :func:`reencrypt` use, per mode, direction and payload size bucket, by
+  timing the candidates on this host.
+  
+  To have them used automatically (whenever those functions are not given a
+  `chunk_size`), assign an :class:`Autotuner` object to
+  ``blowfish.autotuner``. Nothing else consults it: the other APIs either
+  size their own chunks (:func:`aencrypt` & :func:`adecrypt`) or leave it to
+  the caller (:class:`CipherContext`, :class:`SectorCipher`, the vectored
+  methods).
+  
+  `path`, if given, is a JSON file the decisions are loaded from and saved to,
+  so calibration only has to happen once per host.
+  
+  `chunk_sizes` & `worker_counts` are the candidates (0 workers meaning no
+  worker processes). Worker counts greater than the number of CPUs, or for
+  modes that can't process chunks in parallel, are skipped.
+  
+  If `calibrate_on_first_use` is true, a combination of mode, direction and
+  size bucket without a decision is calibrated the first time it's asked
+  for (once, even if it's asked for by several threads at the same time),
+  using a sample of at most `sample_size` bytes. Otherwise, the
+  defaults (64 KB chunks, no workers) are used until :meth:`calibrate` is
+  called.
+  
+  `fixed`, if given, should be a :obj:`dict` with a ``"chunk_size"`` and/or
+  ``"workers"`` to use instead of what calibration decided.
+  
+  :attr:`decisions` maps ``"mode/direction/bucket"`` keys to what was decided
+  (the chunk size, workers and measured throughput in bytes per second).
+  """
+  
+  version = 1
+  
+  # Upper bounds of the payload size buckets (the last one has none).
+  size_buckets = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+  
+  default_chunk_size = 64 * 1024
+  
+  def __init__(
+    self,
+    path = None,
+    chunk_sizes = (4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024),
+    worker_counts = (0, 2, 4, 8),
+    calibrate_on_first_use = True,
+    sample_size = 256 * 1024,
+    fixed = None
+  ):
+    self.path = path
+    self.chunk_sizes = chunk_sizes
+    self.worker_counts = tuple(
+      n for n in worker_counts if n <= (os.cpu_count() or 1)
+    ) or (0,)
+    self.calibrate_on_first_use = calibrate_on_first_use
+    self.sample_size = sample_size
+    self.fixed = dict(fixed or {})
+    
+    import threading
+    
+    self.decisions = {}
+    self._executors = {}
+    self._lock = threading.Lock()
+    self._calibration_locks = {}
+    
+    if path is not None and os.path.exists(path):
+      self.load()
+  
+  def load(self):
+    """
+    Load the decisions saved to :attr:`path`. Decisions saved by another
+    version of the autotuner are ignored.
+    """
+    import json
+    
+    with open(self.path) as f:
+      saved = json.load(f)
+    if saved.get("version") == self.version:
+      self.decisions.update(saved["decisions"])
+  
+  def save(self):
+    """
+    Save the decisions to :attr:`path` (atomically).
+    """
+    import json
+    
+    temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+    with open(temp_path, "w") as f:
+      json.dump(
+        {"version": self.version, "decisions": self.decisions},
+        f,
+        indent = 2,
+        sort_keys = True
+      )
+    os.replace(temp_path, self.path)
+  
+  @classmethod
+  def size_bucket(cls, size):
+    """
+    Return the upper bound of the size bucket `size` bytes fall in (``None``
+    for the last bucket, or if `size` is unknown).
+    """
+    if size is not None:
+      for bucket in cls.size_buckets:
+        if size < bucket:
+          return bucket
+    return None
+  
+  @staticmethod
+  def _key(mode, direction, bucket):
+    return "{}/{}/{}".format(mode, direction, bucket or "max")
+  
+  def settings(self, mode, direction = "encrypt", size = None):
+    """
+    Return a :class:`TuningDecision` (a named tuple of the `chunk_size`,
+    `workers` and the `source` of the decision: ``"fixed"``,
+    ``"calibrated"`` or ``"default"``) for processing `size` bytes (if known)
+    in `mode` & `direction`.
+    """
+    key = self._key(mode, direction, self.size_bucket(size))
+    decision = self.decisions.get(key)
+    
+    if decision is None and self.calibrate_on_first_use and (
+      "chunk_size" not in self.fixed or "workers" not in self.fixed
+    ):
+      import threading
+      
+      # Only one caller calibrates a key; the others wait for its decision.
+      with self._lock:
+        calibration_lock = self._calibration_locks.setdefault(
+          key, threading.Lock()
+        )
+      with calibration_lock:
+        decision = self.decisions.get(key)
+        if decision is None:
+          decision = self.calibrate(mode, direction, size)
+    
+    if decision is None:
+      chunk_size, workers, source = self.default_chunk_size, 0, "default"
+    else:
+      chunk_size, workers, source = (
+        decision["chunk_size"], decision["workers"], "calibrated"
+      )
+    
+    if self.fixed:
+      chunk_size = self.fixed.get("chunk_size", chunk_size)
+      workers = self.fixed.get("workers", workers)
+      source = "fixed"
+    
+    return TuningDecision(chunk_size, workers, source)
+  
+  def executor(self, workers):
+    """
+    Return a process pool with `workers` workers, shared by everything using
+    this autotuner (or ``None`` if `workers` is 0) until :meth:`shutdown` is
+    called.
+    """
+    if not workers:
+      return None
+    from concurrent.futures import ProcessPoolExecutor
+    
+    with self._lock:
+      executor = self._executors.get(workers)
+      if executor is None:
+        executor = self._executors[workers] = ProcessPoolExecutor(workers)
+      return executor
+  
+  def shutdown(self):
+    """
+    Shut down the process pools returned by :meth:`executor`.
+    """
+    with self._lock:
+      executors = list(self._executors.values())
+      self._executors.clear()
+    for executor in executors:
+      executor.shutdown()
+  
+  def calibrate(self, mode, direction = "encrypt", size = None):
+    """
+    Time every candidate chunk size and worker count processing a sample of
+    data in `mode` & `direction`, record the fastest combination for the size
+    bucket of `size` (saving it, if there is a :attr:`path`) and return it.
+    """
+    bucket = self.size_bucket(size)
+    sample = urandom(min(bucket or self.sample_size, self.sample_size))
+    cipher = Cipher(urandom(16))
+    
+    if mode in ("ecb", "cbc", "pcbc"):
+      sample = sample[0:len(sample) - len(sample) % 8]
+    
+    def mode_args():
+      if mode == "ctr":
+        return (ctr_counter(0, xor),)
+      if mode in ("ecb", "ecb_cts"):
+        return ()
+      return (bytes(8),)
+    
+    if _chunk_args_function(mode, direction, mode_args()) is None:
+      worker_counts = (0,)
+    else:
+      worker_counts = self.worker_counts
+    
+    def time_chunk_sizes(workers, executor):
+      for chunk_size in self.chunk_sizes:
+        if chunk_size > len(sample) and chunk_size != self.chunk_sizes[0]:
+          continue
+        stats = pipeline(
+          BytesIO(sample),
+          BytesIO(),
+          cipher,
+          mode,
+          *mode_args(),
+          direction = direction,
+          chunk_size = chunk_size,
+          executor = executor
+        )
+        yield {
+          "chunk_size": chunk_size,
+          "workers": workers,
+          "throughput": len(sample) / stats.elapsed if stats.elapsed else 0.0
+        }
+    
+    from concurrent.futures import ProcessPoolExecutor
+    
+    candidates = []
+    for workers in worker_counts:
+      if workers:
+        # Each worker count gets its own pool, shut down once it's timed.
+        with ProcessPoolExecutor(workers) as executor:
+          candidates.extend(time_chunk_sizes(workers, executor))
+      else:
+        candidates.extend(time_chunk_sizes(workers, None))
+    best = max(candidates, key = lambda candidate: candidate["throughput"])
+    
+    with self._lock:
+      self.decisions[self._key(mode, direction, bucket)] = best
+      if self.path is not None:
+        self.save()
+    return best
+
+def _tuned_settings(chunk_size, executor, mode, direction, size):
+  """
+  Return the chunk size & executor to use, given the `chunk_size` & `executor`
+  arguments of a bulk or streaming function, consulting :data:`autotuner`
+  when `chunk_size` is ``None``.
+  """
+  if chunk_size is not None:
+    return chunk_size, executor
+  
+  tuner = autotuner
+  if tuner is None:
+    return Autotuner.default_chunk_size, executor
+  
+  decision = tuner.settings(mode, direction, size)
+  if executor is None:
+    executor = tuner.executor(decision.workers)
+  return decision.chunk_size, executor
+
+def _stream_size(src):
+  """
+  Return the number of bytes in `src` (a :obj:`bytes`-like or binary file
+  object), if it can be told.
+  """
+  if not hasattr(src, "read"):
+    return len(memoryview(src).cast("B"))
+  try:
+    return os.fstat(src.fileno()).st_size
+  except (AttributeError, OSError, ValueError):
+    return None
+
+def _ctr_crypt_into(crypt, src, dst, counter, chunk_size = 64 * 1024):
+  """
+  Encrypt (or decrypt) the :obj:`memoryview` `src` into `dst` (of the same
+  length, possibly `src` itself) with the prepared CTR mode function `crypt`
+  and `counter`, a chunk at a time.
+  """
+  for i in range(0, len(src), chunk_size):
+    dst[i:i + chunk_size] = crypt(src[i:i + chunk_size], counter)
+
+def dumps(obj, cipher, nonce = None, in_place = False):
+  """
+  Pickle `obj` with protocol 5 and encrypt it with `cipher` using CTR mode,
+  keeping large buffers (e.g. the data of NumPy arrays) out-of-band, so they
+  are never concatenated with the rest of the pickle or copied whole.
+  
+  Return a tuple of the encrypted pickle stream (a :obj:`bytes` object, which
+  starts with the 8-byte nonce) and a list of the encrypted out-of-band
+  buffers, to be sent along with it and passed to :func:`loads`.
+  
+  `nonce` should be a random 64-bit integer that is never used again with
+  the same key. By default, one is generated.
+  
+  If `in_place` is true, each out-of-band buffer is encrypted in the memory
+  of the object it belongs to (which has to be writable and is left
+  holding the encrypted data), and the list holds :obj:`memoryview` objects
+  of it. Otherwise, each one is encrypted into a new :obj:`bytearray`, a chunk
+  at a time.
+  
+  This needs pickle protocol 5 (Python 3.8+). If it is not available, a
+  :exc:`RuntimeError` exception is raised.
+  """
+  import pickle
+  
+  if not hasattr(pickle, "PickleBuffer"):
+    raise RuntimeError("pickle protocol 5 is not available (needs Python 3.8+)")
+  
+  if nonce is None:
+    nonce = int.from_bytes(urandom(8), "big")
+  
+  pickle_buffers = []
+  stream = pickle.dumps(obj, 5, buffer_callback = pickle_buffers.append)
+  
+  srcs = [pickle_buffer.raw() for pickle_buffer in pickle_buffers]
+  if in_place and any(src.readonly for src in srcs):
+    raise ValueError("out-of-band buffer is not writable")
+  
+  crypt = cipher.prepare("ctr", "encrypt")
+  counter = ctr_counter(nonce, xor)
+  
+  # The buffers use the counter first (in order), then the stream.
+  buffers = []
+  for src in srcs:
+    dst = src if in_place else bytearray(len(src))
+    _ctr_crypt_into(crypt, src, memoryview(dst), counter)
+    buffers.append(dst)
+  
+  return nonce.to_bytes(8, "big") + crypt(stream, counter), buffers
+
+def loads(data, cipher, buffers = ()):
+  """
+  Decrypt and unpickle an object encrypted by :func:`dumps`.
+  
+  `data` should be the encrypted pickle stream and `buffers` the encrypted
+  out-of-band buffers that came with it, in order.
+  
+  Buffers that are writable (e.g. :obj:`bytearray` objects received from a
+  socket) are decrypted in place, and back the objects unpickled from them
+  (e.g. NumPy arrays) without being copied. Read-only buffers are decrypted
+  into new :obj:`bytearray` objects, a chunk at a time.
+  
+  This needs pickle protocol 5 (Python 3.8+). If it is not available, a
+  :exc:`RuntimeError` exception is raised.
+  """
+  import pickle
+  
+  if not hasattr(pickle, "PickleBuffer"):
+    raise RuntimeError("pickle protocol 5 is not available (needs Python 3.8+)")
+  
+  data = memoryview(data).cast("B")
+  if len(data) < 8:
+    raise ValueError("data is not at least 8 bytes in length")
+  
+  crypt = cipher.prepare("ctr", "decrypt")
+  counter = ctr_counter(int.from_bytes(data[0:8], "big"), xor)
+  
+  plain_buffers = []
+  for buffer in buffers:
+    src = memoryview(buffer).cast("B")
+    dst = src if not src.readonly else memoryview(bytearray(len(src)))
+    _ctr_crypt_into(crypt, src, dst, counter)
+    plain_buffers.append(dst)
+  
+  return pickle.loads(crypt(data[8:], counter), buffers = plain_buffers)
+
+# Magic, version, file size, bytes done (including the pending window), length
+# of the pending window, digest of the arguments (see _journal_args_digest) and
+# length of the context checkpoint.
+_JOURNAL_HEADER_STRUCT = Struct(">8sB3Q32sH")
+_JOURNAL_MAGIC = b"BFJOURNL"
+_JOURNAL_VERSION = 2
+
+def _journal_args_digest(cipher, direction, mode, args):
+  """
+  Return a digest of everything the output saved in a journal depends on
+  besides the file: `direction`, `mode`, its `args` (the IV or CTR nonce) and
+  the key of `cipher` (through its encryption of an all-zero block).
+  """
+  h = sha256(b"blowfish file journal\x00")
+  h.update("{}\x00{}\x00".format(direction, mode).encode())
+  for arg in args:
+    h.update(arg.to_bytes(8, "big") if isinstance(arg, int) else bytes(arg))
+  h.update(cipher.encrypt_block(bytes(8)))
+  return h.digest()
+
+def _write_journal(path, contents):
+  """
+  Durably replace the journal at `path` with `contents` (plus a digest), so
+  that it either holds the old or the new contents after a crash.
+  """
+  contents += sha256(contents).digest()
+  temp_path = path + ".tmp"
+  with open(temp_path, "wb") as f:
+    f.write(contents)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+  
+  # Make the rename itself durable (not possible on Windows).
+  try:
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(dir_fd)
+  except OSError:
+    pass
+  finally:
+    os.close(dir_fd)
+
+def _read_journal(path):
+  """
+  Return the file size, bytes done, pending window, arguments digest and
+  context checkpoint saved in the journal at `path`, or ``None`` if there is
+  none.
+  """
+  try:
+    with open(path, "rb") as f:
+      contents = f.read()
+  except FileNotFoundError:
+    return None
+  
+  header_size = _JOURNAL_HEADER_STRUCT.size
+  body, digest = contents[:-32], contents[-32:]
+  if len(body) < header_size or not compare_digest(
+    sha256(body).digest(), digest
+  ):
+    raise ValueError("journal is corrupt")
+  
+  (
+    magic, version,
+    file_size, done, pending_len, args_digest,
+    checkpoint_len
+  ) = _JOURNAL_HEADER_STRUCT.unpack_from(body)
+  if magic != _JOURNAL_MAGIC or version != _JOURNAL_VERSION:
+    raise ValueError("journal is not a journal of a supported version")
+  
+  checkpoint = body[header_size:header_size + checkpoint_len]
+  pending = body[header_size + checkpoint_len:]
+  if len(pending) != pending_len or pending_len > done:
+    raise ValueError("journal is corrupt")
+  return file_size, done, pending, args_digest, checkpoint
+
+def _crypt_file_inplace(
+  direction,
+  path,
+  cipher,
+  mode,
+  args,
+  window_size,
+  journal_path
+):
+  """
+  Implement :func:`encrypt_file_inplace` & :func:`decrypt_file_inplace`.
+  """
+  if mode not in ("ecb", "cbc", "pcbc", "cfb", "ofb", "ctr"):
+    raise ValueError("{!r} mode can't process files in place".format(mode))
+  if window_size <= 0 or window_size % ALLOCATIONGRANULARITY:
+    raise ValueError(
+      "window_size is not a multiple of {}".format(ALLOCATIONGRANULARITY)
+    )
+  if journal_path is None:
+    journal_path = path + ".journal"
+  
+  if mode == "ctr":
+    nonce, = args
+  args_digest = _journal_args_digest(cipher, direction, mode, args)
+  
+  with open(path, "r+b") as f:
+    file_size = os.fstat(f.fileno()).st_size
+    if mode in ("ecb", "cbc", "pcbc") and file_size % 8:
+      raise ValueError("file is not a multiple of the block-size in length")
+    
+    def apply(offset, window):
+      if window:
+        with mmap(f.fileno(), len(window), offset = offset) as m:
+          m[:] = window
+          m.flush()
+    
+    journal = _read_journal(journal_path)
+    if journal is None:
+      done = 0
+      if mode == "ctr":
+        context = CipherContext(
+          cipher, mode, direction, (ctr_counter(nonce, xor),)
+        )
+      else:
+        context = CipherContext(cipher, mode, direction, args)
+    else:
+      journal_size, done, pending, journal_args_digest, checkpoint = journal
+      if journal_size != file_size or not compare_digest(
+        journal_args_digest, args_digest
+      ):
+        raise ValueError("journal is not for this file and arguments")
+      # There's no state left to restore if the last window was pending.
+      if done < file_size:
+        context = CipherContext.restore(
+          cipher,
+          checkpoint,
+          ctr_counter(nonce, xor, done // 8) if mode == "ctr" else None
+        )
+        if context.mode != mode or context.direction != direction:
+          raise ValueError("journal is not for this file and arguments")
+      # The pending window may or may not have been written before the crash,
+      # so it's written again (it's the output, so that's harmless).
+      apply(done - len(pending), pending)
+    
+    processed = 0
+    while done < file_size:
+      window_len = min(window_size, file_size - done)
+      with mmap(f.fileno(), window_len, offset = done) as m:
+        window = context.update(m[:])
+      if done + window_len == file_size:
+        window += context.finalize()
+      
+      # Save the output and the state after it before overwriting the input,
+      # so that a crash at any point can be recovered from.
+      checkpoint = b"" if context._finalized else context.checkpoint()
+      _write_journal(
+        journal_path,
+        _JOURNAL_HEADER_STRUCT.pack(
+          _JOURNAL_MAGIC, _JOURNAL_VERSION,
+          file_size, done + window_len, window_len, args_digest,
+          len(checkpoint)
+        ) + checkpoint + window
+      )
+      apply(done, window)
+      done += window_len
+      processed += window_len
+    
+    os.fsync(f.fileno())
+  
+  try:
+    os.remove(journal_path)
+  except FileNotFoundError:
+    pass
+  return processed
+
+def encrypt_file_inplace(
+  path,
+  cipher,
+  mode,
+  *args,
+  window_size = 64 * 1024,
+  journal_path = None
+):
+  """
+  Encrypt the file at `path` in place with `cipher`, using a length-preserving
+  mode of operation, without needing memory or disk space for a copy of it.
+  
+  `mode` should be ``"ctr"``, ``"ofb"`` or ``"cfb"``, or ``"ecb"``, ``"cbc"``
+  or ``"pcbc"`` if the file is a multiple of the block-size in length
+  (otherwise a :exc:`ValueError` exception is raised). With CTR mode, `args`
+  should be ``(nonce,)`` and the counter is ``ctr_counter(nonce, xor)``.
+  Otherwise, `args` are the same as for the corresponding method.
+  
+  The file is walked through an :class:`mmap.mmap` window of `window_size`
+  bytes (a multiple of :data:`mmap.ALLOCATIONGRANULARITY`) at a time. Before
+  each window is overwritten, its output and the state of the mode after it
+  are saved to a journal at `journal_path` (``path + ".journal"`` by
+  default), which holds no more than a window of output.
+  
+  That makes every byte written twice (to the journal, then to the file) and
+  costs two syncs per window, so this does about twice the I/O of copying
+  the file. A larger `window_size` means fewer syncs, but a larger journal
+  and more to rewrite when resuming.
+  
+  If this is interrupted (e.g. by a crash), calling it again with the same
+  arguments resumes where it stopped, rewriting the last window from the
+  journal, so no block is left half-written or encrypted twice. The journal
+  records a digest of the key, the mode and `args`, and a
+  :exc:`ValueError` exception is raised if they don't match it. The journal
+  is removed once the whole file is done. Since it holds up to a window of
+  output (which, when decrypting, is plaintext), it should be kept as safe as
+  the file.
+  
+  Return the number of bytes encrypted by this call (not counting those done
+  before an interruption).
+  """
+  return _crypt_file_inplace(
+    "encrypt", path, cipher, mode, args, window_size, journal_path
+  )
+
+def decrypt_file_inplace(
+  path,
+  cipher,
+  mode,
+  *args,
+  window_size = 64 * 1024,
+  journal_path = None
+):
+  """
+  Decrypt the file at `path` in place (the reverse of
+  :func:`encrypt_file_inplace`, which the arguments & the return value are
+  the same as).
+  """
+  return _crypt_file_inplace(
+    "decrypt", path, cipher, mode, args, window_size, journal_path
+  )
+
 def ctr_counter(nonce, f, start = 0):
   """
   Return an infinite iterator that starts at `start` and iterates by 1 over
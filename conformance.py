@@ -0,0 +1,277 @@
+# vim: filetype=python3 tabstop=2 expandtab
+
+"""
+Differential conformance & throughput harness.
+
+Runs every mode of operation (with & without padding), byte order, P array
+length and edge case payload size through every engine (the ways a
+:class:`blowfish.Cipher` can be set up) and API style, checks that they all
+give byte-for-byte the same output (or all raise :exc:`ValueError`), and times
+each engine & style on a large payload, printing a single throughput matrix.
+
+The engines are checked against each other, and against the module that is
+imported as :mod:`blowfish` (which may be the pure-Python module or the
+compiled extension built with ``BLOWFISH_EXT=1``), whose block function is
+checked against Schneier's test vectors by ``test.py``.
+
+Usage: python3 conformance.py [large payload size in bytes]
+"""
+
+import blowfish
+import sys
+import io
+import operator
+from time import perf_counter
+from os import urandom
+from concurrent.futures import ThreadPoolExecutor
+
+# Keyword arguments of blowfish.Cipher for each engine. The first one is the
+# reference the others are compared with.
+ENGINES = (
+  ("default", {}),
+  ("fused", {"fuse_S_boxes": True}),
+  ("buffer", {"buffer_S_boxes": True}),
+)
+
+STYLES = ("generator", "one-shot", "into", "streaming", "parallel")
+
+# Modes, with the padding they are used with.
+MODES = tuple(
+  (mode, None) for mode in blowfish.MODES
+) + tuple(
+  (mode, "pkcs7") for mode in ("ecb", "cbc", "pcbc")
+)
+
+BYTE_ORDERS = ("big", "little")
+
+P_ARRAY_LENGTHS = (4, 18, 34)
+
+SIZES = (0, 1, 7, 8, 9, 16, 17)
+
+def p_array(length):
+  """
+  Return a P array of `length` values (the default one, extended with values
+  from the first S-box if need be).
+  """
+  return (blowfish.PI_P_ARRAY + blowfish.PI_S_BOXES[0])[:length]
+
+def mode_args(mode, nonce, init_vector):
+  """
+  Return a fresh tuple of the arguments (after the data) of `mode`.
+  """
+  if mode == "ctr":
+    return (blowfish.ctr_counter(nonce, operator.xor),)
+  if mode in ("ecb", "ecb_cts"):
+    return ()
+  return (init_vector,)
+
+def run_style(style, cipher, mode, padding, direction, data, args, executor):
+  """
+  Return the output of `cipher` for `data` in `mode` & `direction` using the
+  API `style`, or ``None`` if the style does not support `padding`.
+  """
+  kwargs = {} if padding is None else {"padding": padding}
+  
+  if style == "generator":
+    return b"".join(
+      getattr(cipher, "{}_{}".format(direction, mode))(data, *args, **kwargs)
+    )
+  
+  if style == "one-shot":
+    if padding is not None:
+      return None
+    return cipher.prepare(mode, direction)(data, *args)
+  
+  context = blowfish.CipherContext(cipher, mode, direction, args, padding)
+  
+  if style == "into":
+    out = bytearray(len(data) + 16)
+    written = context.update_into(data, out)
+    tail = context.finalize()
+    return bytes(out[:written]) + tail
+  
+  if style == "streaming":
+    out = []
+    view = memoryview(data)
+    for piece_len in (1, 7, 0, 9, 3):
+      out.append(context.update(view[0:piece_len]))
+      view = view[piece_len:]
+    out.append(context.update(view))
+    out.append(context.finalize())
+    return b"".join(out)
+  
+  if style == "parallel":
+    dst = io.BytesIO()
+    blowfish.pipeline(
+      io.BytesIO(data), dst, cipher, mode, *args,
+      direction = direction,
+      padding = padding,
+      chunk_size = 64,
+      executor = executor
+    )
+    return dst.getvalue()
+  
+  raise ValueError("unknown style {!r}".format(style))
+
+def outcome(style, cipher, mode, padding, direction, data, args, executor):
+  """
+  Return the output of :func:`run_style`, or ``ValueError`` (the class) if
+  it raised it.
+  """
+  try:
+    return run_style(
+      style, cipher, mode, padding, direction, data, args, executor
+    )
+  except ValueError:
+    return ValueError
+
+def check(sizes = SIZES, engines = ENGINES, styles = STYLES, executor = None):
+  """
+  Return a list of descriptions of the combinations of engine, mode, byte
+  order, P array length, payload size, direction and style whose output (or
+  lack of it) differs from the reference (the first engine's generator).
+  """
+  key = urandom(16)
+  nonce = int.from_bytes(urandom(8), "big")
+  init_vector = urandom(8)
+  failures = []
+  
+  for byte_order in BYTE_ORDERS:
+    for P_len in P_ARRAY_LENGTHS:
+      ciphers = [
+        (
+          name,
+          blowfish.Cipher(key, byte_order, P_array = p_array(P_len), **kwargs)
+        )
+        for name, kwargs in engines
+      ]
+      reference_cipher = ciphers[0][1]
+      
+      for mode, padding in MODES:
+        for size in sizes:
+          plain_data = urandom(size)
+          encrypted_data = outcome(
+            "generator", reference_cipher, mode, padding, "encrypt",
+            plain_data, mode_args(mode, nonce, init_vector), None
+          )
+          
+          for direction, data, expected in (
+            ("encrypt", plain_data, encrypted_data),
+            ("decrypt", encrypted_data, plain_data),
+          ):
+            if data is ValueError:
+              # Data this mode can't process: everything should refuse it.
+              data = plain_data
+              expected = ValueError
+            
+            for name, cipher in ciphers:
+              for style in styles:
+                result = outcome(
+                  style, cipher, mode, padding, direction, data,
+                  mode_args(mode, nonce, init_vector), executor
+                )
+                if result is not None and result != expected:
+                  failures.append(
+                    "{} {} ({}) {}, {} byte order, {} P array, {} bytes, "
+                    "{}".format(
+                      name, mode, padding, direction, byte_order, P_len,
+                      size, style
+                    )
+                  )
+  
+  return failures
+
+def throughput(
+  size = 1024 * 1024,
+  engines = ENGINES,
+  styles = STYLES,
+  executor = None
+):
+  """
+  Encrypt `size` random bytes with every engine, mode & API style (checking
+  that they all agree) and return a tuple of the throughput matrix (a
+  :obj:`dict` mapping ``(engine, mode, style)`` to bytes per second, or
+  ``None`` where the style does not support the mode) and a list of the
+  combinations that did not agree.
+  """
+  key = urandom(16)
+  nonce = int.from_bytes(urandom(8), "big")
+  init_vector = urandom(8)
+  data = urandom(size - size % 8)
+  
+  matrix = {}
+  failures = []
+  for mode, padding in MODES:
+    mode_name = mode if padding is None else "{}+{}".format(mode, padding)
+    expected = None
+    
+    for name, kwargs in engines:
+      cipher = blowfish.Cipher(key, **kwargs)
+      for style in styles:
+        start = perf_counter()
+        result = run_style(
+          style, cipher, mode, padding, "encrypt", data,
+          mode_args(mode, nonce, init_vector), executor
+        )
+        elapsed = perf_counter() - start
+        
+        if result is None:
+          matrix[name, mode_name, style] = None
+          continue
+        matrix[name, mode_name, style] = len(data) / elapsed if elapsed else 0.0
+        
+        if expected is None:
+          expected = result
+        elif result != expected:
+          failures.append("{} {} {}".format(name, mode_name, style))
+  
+  return matrix, failures
+
+def format_matrix(matrix):
+  """
+  Return the throughput matrix as a table (in KB/s), one row per engine &
+  mode and one column per style.
+  """
+  styles = []
+  rows = []
+  for engine, mode, style in matrix:
+    if style not in styles:
+      styles.append(style)
+    if (engine, mode) not in rows:
+      rows.append((engine, mode))
+  
+  lines = [
+    "{:<8} {:<14}".format("engine", "mode") + "".join(
+      "{:>11}".format(style) for style in styles
+    )
+  ]
+  for engine, mode in rows:
+    cells = []
+    for style in styles:
+      rate = matrix.get((engine, mode, style))
+      cells.append(
+        "{:>11}".format("n/a" if rate is None else "{:.1f}".format(rate / 1000))
+      )
+    lines.append("{:<8} {:<14}".format(engine, mode) + "".join(cells))
+  return "\n".join(lines)
+
+if __name__ == "__main__":
+  large_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2 * 1024 * 1024
+  print("Using {}".format(blowfish.__file__))
+  
+  with ThreadPoolExecutor(2) as executor:
+    print("Checking conformance...")
+    failures = check(executor = executor)
+    
+    print("Timing {} byte payloads...".format(large_size))
+    matrix, large_failures = throughput(large_size, executor = executor)
+  
+  failures += large_failures
+  print("\nThroughput (KB/s):")
+  print(format_matrix(matrix))
+  
+  print()
+  for failure in failures:
+    print("MISMATCH:", failure)
+  print("{} mismatches".format(len(failures)))
+  sys.exit(1 if failures else 0)
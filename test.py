@@ -2,8 +2,27 @@
 
 import unittest
 import blowfish
+import conformance
 import operator
+import os
+import sys
+import subprocess
+import tempfile
+import io
+import gc
+import pickle
+import hashlib
+import mmap
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from os import urandom
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class CipherMixin(object):
   """
@@ -12,6 +31,8 @@ class CipherMixin(object):
   
   byte_order = None
   
+  cipher_options = {}
+  
   test_vectors = ()
   
   @classmethod
@@ -21,7 +42,11 @@ class CipherMixin(object):
     """
     cls.test_vectors = [
       (
-        blowfish.Cipher(bytes.fromhex(key), cls.byte_order),
+        blowfish.Cipher(
+          bytes.fromhex(key),
+          cls.byte_order,
+          **cls.cipher_options
+        ),
         key, clear_text, cipher_text
       )
       for key, clear_text, cipher_text in cls.test_vectors
@@ -49,6 +74,56 @@ class CipherMixin(object):
           bytes.fromhex(clear_text)
         )
 
+  def test_u64(self):
+    """
+    Test encryption & decryption of 64-bit integers.
+    """
+    for cipher, key, clear_text, cipher_text in self.test_vectors:
+      with self.subTest(key = key, clear_text = clear_text):
+        n = int.from_bytes(bytes.fromhex(clear_text), cipher.byte_order)
+        m = int.from_bytes(bytes.fromhex(cipher_text), cipher.byte_order)
+        self.assertEqual(cipher.encrypt_u64(n), m)
+        self.assertEqual(cipher.decrypt_u64(m), n)
+    
+    cipher = self.test_vectors[0][0]
+    for n in (-1, 2**64):
+      with self.subTest(n = n):
+        with self.assertRaises(ValueError):
+          cipher.encrypt_u64(n)
+  
+  def test_u64_array(self):
+    """
+    Test bulk encryption & decryption of 64-bit integers.
+    """
+    cipher = self.test_vectors[0][0]
+    values = [0, 1, 2, 2**32, 2**64 - 1] + list(range(1000, 1100))
+    expected = [cipher.encrypt_u64(n) for n in values]
+    
+    encrypted = cipher.encrypt_u64_array(array("Q", values))
+    self.assertEqual(encrypted, array("Q", expected))
+    self.assertEqual(cipher.decrypt_u64_array(encrypted), array("Q", values))
+    
+    self.assertEqual(cipher.encrypt_u64_array(values), expected)
+    
+    with self.assertRaises(ValueError):
+      cipher.encrypt_u64_array(array("I", values[:3]))
+  
+  @unittest.skipIf(numpy is None, "NumPy is not installed")
+  def test_u64_numpy(self):
+    """
+    Test bulk encryption & decryption of NumPy arrays.
+    """
+    cipher = self.test_vectors[0][0]
+    values = numpy.arange(1000, 1100, dtype = numpy.uint64)
+    
+    encrypted = cipher.encrypt_u64_array(values)
+    self.assertEqual(encrypted.dtype, values.dtype)
+    self.assertEqual(
+      encrypted.tolist(),
+      [cipher.encrypt_u64(n) for n in values.tolist()]
+    )
+    self.assertTrue((cipher.decrypt_u64_array(encrypted) == values).all())
+
 class CipherBigEndian(CipherMixin, unittest.TestCase):
   """
   Test core functionality with big-endian byte order input data.
@@ -149,6 +224,8 @@ class ModesOfOperationMixin(object):
   """
   byte_order = None
   
+  cipher_options = {}
+  
   @classmethod
   def setUpClass(cls):
     """
@@ -156,7 +233,8 @@ class ModesOfOperationMixin(object):
     """
     cls.cipher = blowfish.Cipher(
       b"this ist ein key",
-      byte_order = cls.byte_order
+      byte_order = cls.byte_order,
+      **cls.cipher_options
     )
     cls.block_multiple_data = urandom(500 * 8)
   
@@ -308,6 +386,478 @@ class ModesOfOperationMixin(object):
         )
         self.assertEqual(data, decrypted_data)
 
+  def test_range_decryption(self):
+    """
+    Test decrypting ranges of blocks in CBC & CFB modes.
+    """
+    cipher = self.cipher
+    init_vector = urandom(8)
+    
+    for mode, extra_bytes in (("cbc", 0), ("cfb", 0), ("cfb", 5)):
+      encrypt = getattr(cipher, "encrypt_" + mode)
+      decrypt_range = getattr(cipher, "decrypt_{}_range".format(mode))
+      
+      data = urandom(10 * 8 + extra_bytes)
+      encrypted_data = b"".join(encrypt(data, init_vector))
+      
+      for start_block in range(0, 12):
+        for stop_block in list(range(start_block, 13)) + [None]:
+          with self.subTest(
+            mode = mode,
+            extra_bytes = extra_bytes,
+            start_block = start_block,
+            stop_block = stop_block
+          ):
+            self.assertEqual(
+              b"".join(
+                decrypt_range(
+                  encrypted_data,
+                  init_vector,
+                  start_block,
+                  stop_block
+                )
+              ),
+              data[
+                start_block * 8:None if stop_block is None else stop_block * 8
+              ]
+            )
+    
+    self.assertRaises(
+      ValueError,
+      cipher.decrypt_pcbc_range, bytes(16), init_vector, 1, 2
+    )
+    self.assertRaises(
+      ValueError,
+      b"".join, cipher.decrypt_cbc_range(bytes(16), init_vector, -1, 2)
+    )
+    
+    # The initialization vector is checked even if the range doesn't start at
+    # the first block.
+    for mode in ("cbc", "cfb"):
+      decrypt_range = getattr(cipher, "decrypt_{}_range".format(mode))
+      for start_block in (0, 1, 5):
+        with self.subTest(mode = mode, start_block = start_block):
+          with self.assertRaisesRegex(ValueError, "initialization vector"):
+            b"".join(decrypt_range(bytes(32), b"short", start_block, 3))
+    
+    # Nothing before an empty range past the end of short data is looked at.
+    self.assertEqual(
+      b"".join(cipher.decrypt_cfb_range(bytes(5), init_vector, 1, None)),
+      b""
+    )
+  
+  def test_padding(self):
+    """
+    Test the padding schemes of the ECB, CBC & PCBC modes.
+    """
+    cipher = self.cipher
+    init_vector = urandom(8)
+    
+    modes = (
+      (cipher.encrypt_ecb, cipher.decrypt_ecb, ()),
+      (cipher.encrypt_cbc, cipher.decrypt_cbc, (init_vector,)),
+      (cipher.encrypt_pcbc, cipher.decrypt_pcbc, (init_vector,)),
+    )
+    
+    for encrypt, decrypt, args in modes:
+      for padding in blowfish.PADDING_SCHEMES:
+        for i in range(0, 17):
+          with self.subTest(mode = encrypt.__name__, padding = padding, i = i):
+            data = urandom(i)
+            if padding == "zero":
+              data = data.replace(b"\x00", b"\x01")
+            
+            encrypted_data = b"".join(encrypt(data, *args, padding = padding))
+            decrypted_data = b"".join(
+              decrypt(encrypted_data, *args, padding = padding)
+            )
+            
+            self.assertEqual(len(encrypted_data) % 8, 0)
+            self.assertEqual(data, decrypted_data)
+  
+  def test_pkcs7_padding(self):
+    """
+    Test PKCS#7 padding against manually padded data.
+    """
+    cipher = self.cipher
+    init_vector = urandom(8)
+    
+    for i in range(0, 8):
+      with self.subTest(extra_bytes = i):
+        data = self.block_multiple_data + urandom(i)
+        padded_data = data + bytes((8 - i,)) * (8 - i)
+        
+        self.assertEqual(
+          b"".join(cipher.encrypt_cbc(data, init_vector, padding = "pkcs7")),
+          b"".join(cipher.encrypt_cbc(padded_data, init_vector))
+        )
+  
+  def test_invalid_padding(self):
+    """
+    Test that invalid padding is rejected.
+    """
+    cipher = self.cipher
+    
+    for padding in ("pkcs7", "x923", "iso10126"):
+      with self.subTest(padding = padding):
+        for last_block in (bytes(8), b"\x01" * 7 + b"\x09"):
+          encrypted_data = b"".join(cipher.encrypt_ecb(last_block))
+          self.assertRaises(
+            ValueError,
+            b"".join, cipher.decrypt_ecb(encrypted_data, padding = padding)
+          )
+        
+        self.assertRaises(
+          ValueError,
+          b"".join, cipher.decrypt_ecb(b"", padding = padding)
+        )
+    
+    self.assertRaises(
+      ValueError,
+      b"".join, cipher.encrypt_ecb(b"", padding = "unknown")
+    )
+
+  def test_prepare(self):
+    """
+    Test that prepared functions give the same results as the methods.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    
+    for mode in blowfish.MODES:
+      encrypt = cipher.prepare(mode, "encrypt")
+      decrypt = cipher.prepare(mode, "decrypt")
+      
+      for i in (0, 1, 7, 8, 9, 32, 33, 4000):
+        if mode in ("ecb", "cbc", "pcbc") and i % 8:
+          continue
+        if mode in ("ecb_cts", "cbc_cts") and i <= 8:
+          continue
+        
+        with self.subTest(mode = mode, data_len = i):
+          data = urandom(i)
+          
+          if mode == "ctr":
+            args = lambda: (blowfish.ctr_counter(nonce, operator.xor),)
+          elif mode in ("ecb", "ecb_cts"):
+            args = lambda: ()
+          else:
+            args = lambda: (init_vector,)
+          
+          encrypted_data = b"".join(
+            getattr(cipher, "encrypt_" + mode)(data, *args())
+          )
+          
+          self.assertEqual(encrypt(data, *args()), encrypted_data)
+          self.assertEqual(decrypt(encrypted_data, *args()), data)
+    
+    self.assertRaises(ValueError, cipher.prepare, "xts", "encrypt")
+    self.assertRaises(ValueError, cipher.prepare, "cbc", "sideways")
+    self.assertRaises(ValueError, cipher.prepare("cbc", "encrypt"), b"1", b"2")
+  
+  def test_streaming(self):
+    """
+    Test that streaming contexts give the same results as the methods,
+    however the data is split up.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    
+    for mode in blowfish.MODES:
+      for padding in (None, "pkcs7"):
+        if padding is not None and mode not in ("ecb", "cbc", "pcbc"):
+          continue
+        
+        for i in (0, 1, 7, 8, 9, 16, 17, 100, 1000):
+          if padding is None and mode in ("ecb", "cbc", "pcbc") and i % 8:
+            continue
+          if mode in ("ecb_cts", "cbc_cts") and i <= 8:
+            continue
+          
+          with self.subTest(mode = mode, padding = padding, data_len = i):
+            data = urandom(i)
+            
+            if mode == "ctr":
+              args = lambda: (blowfish.ctr_counter(nonce, operator.xor),)
+            elif mode in ("ecb", "ecb_cts"):
+              args = lambda: ()
+            else:
+              args = lambda: (init_vector,)
+            
+            encrypted_data = b"".join(
+              getattr(cipher, "encrypt_" + mode)(
+                data, *args(), **({"padding": padding} if padding else {})
+              )
+            )
+            
+            for direction, data_in, data_out in (
+              ("encrypt", data, encrypted_data),
+              ("decrypt", encrypted_data, data)
+            ):
+              context = getattr(cipher, direction + "or")(
+                mode, *args(), padding = padding
+              )
+              out = bytearray()
+              for piece_len in (3, 0, 8, 13, 1, 64):
+                piece, data_in = data_in[:piece_len], data_in[piece_len:]
+                out += context.update(piece)
+              buffer = bytearray(len(data_in) + 7)
+              out += buffer[:context.update_into(data_in, buffer)]
+              out += context.finalize()
+              
+              self.assertEqual(out, data_out)
+    
+    context = cipher.encryptor("ecb")
+    context.update(urandom(12))
+    self.assertRaises(ValueError, context.finalize)
+    self.assertRaises(ValueError, cipher.encryptor, "ctr", [0], padding = "pkcs7")
+    self.assertRaises(ValueError, cipher.encryptor, "cbc", b"short")
+  
+  def test_checkpoint(self):
+    """
+    Test that restored checkpoints carry on exactly where they were made.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    data = urandom(203)
+    
+    for mode in blowfish.MODES:
+      for padding in (None, "pkcs7"):
+        if padding is not None and mode not in ("ecb", "cbc", "pcbc"):
+          continue
+        if mode == "ctr":
+          args = lambda start = 0: (
+            blowfish.ctr_counter(nonce, operator.xor, start),
+          )
+        elif mode in ("ecb", "ecb_cts"):
+          args = lambda: ()
+        else:
+          args = lambda: (init_vector,)
+        
+        plain_data = data if padding or mode not in ("ecb", "cbc", "pcbc") else (
+          data[:200]
+        )
+        context = cipher.encryptor(mode, *args(), padding = padding)
+        encrypted_data = context.update(plain_data) + context.finalize()
+        
+        for direction, data_in, expected in (
+          ("encrypt", plain_data, encrypted_data),
+          ("decrypt", encrypted_data, plain_data)
+        ):
+          with self.subTest(mode = mode, padding = padding, direction = direction):
+            context = getattr(cipher, direction + "or")(
+              mode, *args(), padding = padding
+            )
+            out = context.update(data_in[:13]) + context.update(data_in[13:99])
+            checkpoint = context.checkpoint()
+            
+            if mode == "ctr":
+              restored = blowfish.CipherContext.restore(
+                cipher, checkpoint, args(context.counter_position)[0]
+              )
+            else:
+              restored = blowfish.CipherContext.restore(cipher, checkpoint)
+            self.assertEqual(restored.bytes_in, 99)
+            self.assertEqual(restored.bytes_out, len(out))
+            
+            out += restored.update(data_in[99:]) + restored.finalize()
+            self.assertEqual(out, expected)
+    
+    checkpoint = cipher.encryptor("cbc", init_vector).checkpoint()
+    self.assertRaises(
+      ValueError,
+      blowfish.CipherContext.restore, blowfish.Cipher(urandom(8)), checkpoint
+    )
+    self.assertRaises(
+      ValueError,
+      blowfish.CipherContext.restore, cipher, checkpoint[:-1]
+    )
+    self.assertRaises(
+      ValueError,
+      blowfish.CipherContext.restore,
+      cipher,
+      cipher.encryptor("ctr", [0]).checkpoint()
+    )
+  
+  def test_vectored(self):
+    """
+    Test that the vectored methods give the same results as the methods,
+    with fragments that aren't block-aligned.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    
+    fragment_lens = (3, 0, 13, 8, 1, 29)
+    data = urandom(sum(fragment_lens) + 10)
+    fragments = []
+    start = 0
+    for fragment_len in fragment_lens + (10,):
+      fragments.append(memoryview(data)[start:start + fragment_len])
+      start += fragment_len
+    
+    for mode in blowfish.MODES:
+      for padding in (None, "pkcs7"):
+        if padding is not None and mode not in ("ecb", "cbc", "pcbc"):
+          continue
+        
+        with self.subTest(mode = mode, padding = padding):
+          if mode == "ctr":
+            args = lambda: (blowfish.ctr_counter(nonce, operator.xor),)
+          elif mode in ("ecb", "ecb_cts"):
+            args = lambda: ()
+          else:
+            args = lambda: (init_vector,)
+          kwargs = {"padding": padding} if padding else {}
+          
+          encrypted_data = b"".join(
+            getattr(cipher, "encrypt_" + mode)(data, *args(), **kwargs)
+          )
+          
+          outputs = cipher.encrypt_vectored(mode, fragments, *args(), **kwargs)
+          self.assertEqual(b"".join(outputs), encrypted_data)
+          self.assertEqual(
+            [len(output) for output in outputs[:-1]],
+            list(fragment_lens)
+          )
+          
+          out = bytearray(len(encrypted_data))
+          self.assertEqual(
+            cipher.encrypt_vectored(
+              mode, fragments, *args(), out = out, **kwargs
+            ),
+            len(encrypted_data)
+          )
+          self.assertEqual(out, encrypted_data)
+          
+          outs = [bytearray(11), bytearray(0), bytearray(len(data))]
+          written = cipher.decrypt_vectored(
+            mode, [encrypted_data[:5], encrypted_data[5:]], *args(),
+            out = outs, **kwargs
+          )
+          self.assertEqual(written, len(data))
+          self.assertEqual(b"".join(outs)[:written], data)
+          
+          context = cipher.encryptor(mode, *args(), **kwargs)
+          pieces = context.update_vectored(fragments)
+          self.assertEqual(len(pieces), len(fragments))
+          self.assertEqual(
+            b"".join(pieces) + context.finalize(),
+            encrypted_data
+          )
+    
+    self.assertRaises(
+      ValueError,
+      cipher.encrypt_vectored, "ofb", fragments, init_vector,
+      out = bytearray(10)
+    )
+  
+  def test_records(self):
+    """
+    Test that encrypting a column of records gives the same results as
+    encrypting each record with the methods.
+    """
+    cipher = self.cipher
+    record_lens = (9, 16, 17, 100, 12, 8 * 30 + 3)
+    offsets = array("q", [5])
+    for record_len in record_lens:
+      offsets.append(offsets[-1] + record_len)
+    data = urandom(offsets[-1] + 3)
+    
+    init_vectors = [urandom(8) for record_len in record_lens]
+    nonces = [int.from_bytes(urandom(8), "big") for record_len in record_lens]
+    
+    for mode, column, method_args in (
+      ("cbc_cts", init_vectors, lambda i: (init_vectors[i],)),
+      ("cbc_cts", b"".join(init_vectors), lambda i: (init_vectors[i],)),
+      ("ctr", nonces, lambda i: (
+        blowfish.ctr_counter(nonces[i], operator.xor),
+      )),
+    ):
+      with self.subTest(mode = mode, column = type(column)):
+        encrypted_data, encrypted_offsets = cipher.encrypt_records(
+          mode, data, offsets, column
+        )
+        self.assertIs(encrypted_offsets, offsets)
+        self.assertEqual(len(encrypted_data), len(data))
+        self.assertEqual(encrypted_data[:5], data[:5])
+        self.assertEqual(encrypted_data[-3:], data[-3:])
+        
+        for i in range(len(record_lens)):
+          start, stop = offsets[i], offsets[i + 1]
+          self.assertEqual(
+            encrypted_data[start:stop],
+            b"".join(
+              getattr(cipher, "encrypt_" + mode)(
+                data[start:stop], *method_args(i)
+              )
+            )
+          )
+        
+        self.assertEqual(
+          cipher.decrypt_records(mode, encrypted_data, offsets, column)[0],
+          data
+        )
+    
+    self.assertRaises(
+      ValueError,
+      cipher.encrypt_records, "cbc_cts", data, [0, 8], [bytes(8)]
+    )
+    self.assertRaises(
+      ValueError,
+      cipher.encrypt_records, "ctr", data, [0, 9, 4], [0, 0]
+    )
+    self.assertRaises(
+      ValueError,
+      cipher.encrypt_records, "ctr", data, [0, 9], [0, 0]
+    )
+    self.assertRaises(
+      ValueError,
+      cipher.encrypt_records, "cbc", data, [0, 16], [bytes(8)]
+    )
+  
+  def test_allocated_blocks(self):
+    """
+    Test that the methods don't hold on to memory for the blocks they have
+    returned, i.e. that the number of allocated blocks after consuming an
+    iterator is nowhere near the number of blocks of output.
+    """
+    cipher = self.cipher
+    data = self.block_multiple_data
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    
+    for mode in blowfish.MODES:
+      for direction in ("encrypt", "decrypt"):
+        with self.subTest(mode = mode, direction = direction):
+          if mode == "ctr":
+            args = lambda: (blowfish.ctr_counter(nonce, operator.xor),)
+          elif mode in ("ecb", "ecb_cts"):
+            args = lambda: ()
+          else:
+            args = lambda: (init_vector,)
+          method = getattr(cipher, "{}_{}".format(direction, mode))
+          
+          # Warm up any caches first, so they aren't counted.
+          for block in method(data, *args()):
+            pass
+          del block
+          gc.collect()
+          
+          blocks_before = sys.getallocatedblocks()
+          for block in method(data, *args()):
+            pass
+          del block
+          gc.collect()
+          
+          self.assertLess(
+            sys.getallocatedblocks() - blocks_before,
+            len(data) // 8 // 50
+          )
+  
 class ModesOfOperationBigEndian(ModesOfOperationMixin, unittest.TestCase):
   """
   Test the modes of operation using big-endian byte order input.
@@ -322,3 +872,1490 @@ class ModesOfOperationLittleEndian(ModesOfOperationMixin, unittest.TestCase):
   
   byte_order = "little"
 
+class CipherFusedBigEndian(CipherMixin, unittest.TestCase):
+  """
+  Test core functionality with fused S-boxes and big-endian byte order input
+  data.
+  """
+  
+  byte_order = "big"
+  
+  cipher_options = {"fuse_S_boxes": True}
+  
+  test_vectors = CipherBigEndian.test_vectors
+  
+class CipherFusedLittleEndian(CipherMixin, unittest.TestCase):
+  """
+  Test core functionality with fused S-boxes and little-endian byte order
+  input data.
+  """
+  
+  byte_order = "little"
+  
+  cipher_options = {"fuse_S_boxes": True}
+  
+  test_vectors = CipherLittleEndian.test_vectors
+
+class ModesOfOperationFused(ModesOfOperationMixin, unittest.TestCase):
+  """
+  Test the modes of operation with fused S-boxes.
+  """
+  
+  byte_order = "big"
+  
+  cipher_options = {"fuse_S_boxes": True}
+
+class ModesOfOperationBufferSBoxes(ModesOfOperationMixin, unittest.TestCase):
+  """
+  Test the modes of operation with buffer-backed S-boxes.
+  """
+  
+  byte_order = "little"
+  
+  cipher_options = {"buffer_S_boxes": True}
+
+class FreezeSchedulesTest(unittest.TestCase):
+  """
+  Test sharing key schedules with forked processes.
+  """
+  
+  @staticmethod
+  def private_dirty():
+    """
+    Return the size of the private, modified memory of this process.
+    """
+    with open("/proc/self/smaps_rollup") as f:
+      for line in f:
+        if line.startswith("Private_Dirty:"):
+          return int(line.split()[1]) * 1024
+  
+  def forked_private_dirty(self, ciphers):
+    """
+    Return how much private memory a forked child process dirties while
+    encrypting a few blocks with each of `ciphers`.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      try:
+        os.close(read_fd)
+        before = self.private_dirty()
+        for cipher in ciphers:
+          for i in range(0, 16):
+            cipher.encrypt_block(urandom(8))
+        os.write(write_fd, str(self.private_dirty() - before).encode())
+      finally:
+        os._exit(0)
+    
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+      result = f.read()
+    os.waitpid(pid, 0)
+    return int(result)
+  
+  def test_freeze(self):
+    """
+    Test that frozen ciphers still give the same results.
+    """
+    key = urandom(16)
+    expected = blowfish.Cipher(key)
+    cipher = blowfish.Cipher(key)
+    if hasattr(gc, "get_freeze_count"):
+      freeze_count = gc.get_freeze_count()
+      self.addCleanup(gc.unfreeze)
+    blowfish.freeze_schedules([cipher])
+    
+    # The garbage collector is left alone unless asked for.
+    if hasattr(gc, "get_freeze_count"):
+      self.assertEqual(gc.get_freeze_count(), freeze_count)
+    
+    block = urandom(8)
+    self.assertEqual(cipher.encrypt_block(block), expected.encrypt_block(block))
+    self.assertEqual(
+      list(map(list, cipher.S)),
+      list(map(list, expected.S))
+    )
+    
+    unpickled = pickle.loads(pickle.dumps(cipher))
+    self.assertEqual(unpickled.encrypt_block(block), cipher.encrypt_block(block))
+  
+  @unittest.skipUnless(
+    hasattr(os, "fork") and os.path.exists("/proc/self/smaps_rollup"),
+    "requires fork() and /proc/self/smaps_rollup"
+  )
+  def test_private_memory_after_fork(self):
+    """
+    Test that frozen ciphers stay (mostly) shared with forked processes.
+    """
+    keys = [urandom(16) for i in range(0, 100)]
+    
+    ciphers = [blowfish.Cipher(key) for key in keys]
+    unfrozen = self.forked_private_dirty(ciphers)
+    
+    blowfish.freeze_schedules(ciphers, freeze_gc = True)
+    try:
+      frozen = self.forked_private_dirty(ciphers)
+    finally:
+      if hasattr(gc, "unfreeze"):
+        gc.unfreeze()
+    
+    self.assertLess(frozen, unfrozen / 2)
+
+class CMACMixin(object):
+  """
+  Test the CMAC and the modes of operation that also compute one.
+  """
+  byte_order = None
+  
+  @classmethod
+  def setUpClass(cls):
+    """
+    Setup the Cipher objects and dummy test data.
+    """
+    cls.cipher = blowfish.Cipher(
+      b"this ist ein key",
+      byte_order = cls.byte_order
+    )
+    cls.mac_cipher = blowfish.Cipher(
+      b"this ist ein mac key",
+      byte_order = cls.byte_order
+    )
+    cls.block_multiple_data = urandom(100 * 8)
+  
+  def reference_cmac(self, data):
+    """
+    Compute the CMAC of `data` directly from the definition in
+    NIST SP 800-38B.
+    """
+    encrypt_block = self.mac_cipher.encrypt_block
+    
+    def double(block):
+      n = int.from_bytes(block, "big") << 1
+      if n >> 64:
+        n ^= 0x1000000000000001b
+      return n.to_bytes(8, "big")
+    
+    def xor(a, b):
+      return bytes(x ^ y for x, y in zip(a, b))
+    
+    K1 = double(encrypt_block(bytes(8)))
+    K2 = double(K1)
+    
+    blocks = [data[i:i + 8] for i in range(0, len(data), 8)] or [b""]
+    if len(blocks[-1]) == 8:
+      blocks[-1] = xor(blocks[-1], K1)
+    else:
+      blocks[-1] = xor(
+        blocks[-1] + b"\x80" + bytes(7 - len(blocks[-1])),
+        K2
+      )
+    
+    X = bytes(8)
+    for block in blocks:
+      X = encrypt_block(xor(X, block))
+    return X
+  
+  def test_cmac(self):
+    """
+    Test CMAC against the reference implementation.
+    """
+    for i in (0, 1, 7, 8, 9, 16, 17, 800):
+      with self.subTest(data_len = i):
+        data = urandom(i)
+        self.assertEqual(
+          blowfish.CMAC(self.mac_cipher, data).digest(),
+          self.reference_cmac(data)
+        )
+  
+  def test_cmac_update(self):
+    """
+    Test that feeding CMAC data in pieces gives the same tag as feeding it
+    all at once.
+    """
+    data = self.block_multiple_data + urandom(5)
+    for step in (1, 3, 8, 13, 64):
+      with self.subTest(step = step):
+        mac = blowfish.CMAC(self.mac_cipher)
+        for i in range(0, len(data), step):
+          mac.update(data[i:i + step])
+        self.assertEqual(mac.digest(), self.reference_cmac(data))
+        mac.verify(self.reference_cmac(data))
+        self.assertRaises(ValueError, mac.verify, bytes(8))
+  
+  def test_cbc_cmac_mode(self):
+    """
+    Test CBC mode with CMAC.
+    """
+    cipher = self.cipher
+    data = self.block_multiple_data
+    init_vector = urandom(8)
+    
+    for prefix in (b"", urandom(3), urandom(8)):
+      with self.subTest(prefix_len = len(prefix)):
+        mac = blowfish.CMAC(self.mac_cipher, prefix)
+        encrypted_data = b"".join(
+          cipher.encrypt_cbc_cmac(data, init_vector, mac)
+        )
+        self.assertEqual(
+          encrypted_data,
+          b"".join(cipher.encrypt_cbc(data, init_vector))
+        )
+        tag = mac.digest()
+        self.assertEqual(tag, self.reference_cmac(prefix + encrypted_data))
+        
+        mac = blowfish.CMAC(self.mac_cipher, prefix)
+        decrypted_data = b"".join(
+          cipher.decrypt_cbc_cmac(encrypted_data, init_vector, mac)
+        )
+        mac.verify(tag)
+        self.assertEqual(data, decrypted_data)
+  
+  def test_ctr_cmac_mode(self):
+    """
+    Test CTR mode with CMAC.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    
+    for i in range(0, 8):
+      for prefix in (b"", urandom(3), urandom(8)):
+        with self.subTest(extra_bytes = i, prefix_len = len(prefix)):
+          data = self.block_multiple_data + urandom(i)
+          
+          mac = blowfish.CMAC(self.mac_cipher, prefix)
+          encrypted_data = b"".join(
+            cipher.encrypt_ctr_cmac(
+              data,
+              blowfish.ctr_counter(nonce, operator.xor),
+              mac
+            )
+          )
+          self.assertEqual(
+            encrypted_data,
+            b"".join(
+              cipher.encrypt_ctr(
+                data,
+                blowfish.ctr_counter(nonce, operator.xor)
+              )
+            )
+          )
+          tag = mac.digest()
+          self.assertEqual(tag, self.reference_cmac(prefix + encrypted_data))
+          
+          mac = blowfish.CMAC(self.mac_cipher, prefix)
+          decrypted_data = b"".join(
+            cipher.decrypt_ctr_cmac(
+              encrypted_data,
+              blowfish.ctr_counter(nonce, operator.xor),
+              mac
+            )
+          )
+          mac.verify(tag)
+          self.assertEqual(data, decrypted_data)
+
+class CMACBigEndian(CMACMixin, unittest.TestCase):
+  """
+  Test the CMAC using big-endian byte order input.
+  """
+  
+  byte_order = "big"
+  
+class CMACLittleEndian(CMACMixin, unittest.TestCase):
+  """
+  Test the CMAC using little-endian byte order input.
+  """
+  
+  byte_order = "little"
+
+class ScheduleCacheTest(unittest.TestCase):
+  """
+  Test the persistent key schedule cache.
+  """
+  
+  def setUp(self):
+    """
+    Setup a temporary cache directory.
+    """
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.cache = blowfish.ScheduleCache(self.temp_dir.name)
+  
+  def tearDown(self):
+    """
+    Remove the temporary cache directory.
+    """
+    self.temp_dir.cleanup()
+  
+  def test_hit(self):
+    """
+    Test that a cached schedule is the same as a derived one.
+    """
+    key = urandom(16)
+    P_array = blowfish.PI_P_ARRAY[:16]
+    
+    for kwargs in ({}, {"P_array": P_array}):
+      with self.subTest(**kwargs):
+        expected = blowfish.Cipher(key, **kwargs)
+        
+        first = blowfish.Cipher(key, schedule_cache = self.cache, **kwargs)
+        second = blowfish.Cipher(key, schedule_cache = self.cache, **kwargs)
+        
+        self.assertEqual(first.P, expected.P)
+        self.assertEqual(first.S, expected.S)
+        self.assertEqual(second.P, expected.P)
+        self.assertEqual(second.S, expected.S)
+    
+    self.assertEqual(self.cache.misses, 2)
+    self.assertEqual(self.cache.hits, 2)
+  
+  def test_corrupt(self):
+    """
+    Test that a corrupt schedule is not used.
+    """
+    key = urandom(16)
+    expected = blowfish.Cipher(key, schedule_cache = self.cache)
+    
+    path, = [
+      os.path.join(self.temp_dir.name, name)
+      for name in os.listdir(self.temp_dir.name)
+    ]
+    with open(path, "r+b") as f:
+      f.seek(100)
+      byte = f.read(1)
+      f.seek(100)
+      f.write(bytes((byte[0] ^ 1,)))
+    
+    self.assertIsNone(self.cache.load(key))
+    
+    cipher = blowfish.Cipher(key, schedule_cache = self.cache)
+    self.assertEqual(cipher.P, expected.P)
+    self.assertEqual(cipher.S, expected.S)
+    self.assertIsNotNone(self.cache.load(key))
+  
+  def test_eviction(self):
+    """
+    Test that the size of the cache is bounded.
+    """
+    blowfish.Cipher(urandom(16), schedule_cache = self.cache)
+    entry_size = self.cache.size()
+    
+    cache = blowfish.ScheduleCache(
+      self.temp_dir.name,
+      max_size = 3 * entry_size
+    )
+    for i in range(0, 6):
+      blowfish.Cipher(urandom(16), schedule_cache = cache)
+    
+    self.assertEqual(cache.size(), 3 * entry_size)
+    self.assertEqual(cache.evictions, 4)
+
+class ContainerTest(unittest.TestCase):
+  """
+  Test the chunked container format.
+  """
+  
+  def setUp(self):
+    self.cipher = blowfish.Cipher(urandom(16))
+    self.mac_cipher = blowfish.Cipher(urandom(16))
+  
+  def write(self, data, chunk_size = 64, **kwargs):
+    f = io.BytesIO()
+    with blowfish.ContainerWriter(
+      f, self.cipher, self.mac_cipher, chunk_size, **kwargs
+    ) as writer:
+      for i in range(0, len(data), 50):
+        writer.write(data[i:i + 50])
+    return f
+  
+  def test_round_trip(self):
+    """
+    Test that data written to a container reads back the same.
+    """
+    thread_pool = ThreadPoolExecutor(2)
+    self.addCleanup(thread_pool.shutdown)
+    
+    for data_len in (0, 1, 63, 64, 128, 1000):
+      data = urandom(data_len)
+      for kwargs in ({}, {"executor": thread_pool, "max_pending": 2}):
+        with self.subTest(data_len = data_len, **kwargs):
+          f = self.write(data, **kwargs)
+          reader = blowfish.ContainerReader(f, self.cipher, self.mac_cipher)
+          
+          self.assertEqual(reader.data_len, data_len)
+          self.assertEqual(reader.read(), data)
+          self.assertEqual(
+            b"".join(reader.read_chunks(executor = kwargs.get("executor"))),
+            data
+          )
+  
+  def test_random_access(self):
+    """
+    Test reading from arbitrary positions.
+    """
+    data = urandom(1000)
+    reader = blowfish.ContainerReader(
+      self.write(data),
+      self.cipher,
+      self.mac_cipher
+    )
+    
+    for start, size in ((0, 10), (60, 10), (64, 64), (900, 200), (1000, 5)):
+      with self.subTest(start = start, size = size):
+        self.assertEqual(reader.seek(start), start)
+        self.assertEqual(reader.read(size), data[start:start + size])
+        self.assertEqual(reader.tell(), min(start + size, len(data)))
+    
+    self.assertEqual(reader.read_chunk(3), data[192:256])
+  
+  def test_parallel_chunks(self):
+    """
+    Test writing chunks out of order with a pickled container.
+    """
+    data = urandom(300)
+    container = blowfish.Container(self.cipher, self.mac_cipher, 64)
+    container = pickle.loads(pickle.dumps(container))
+    
+    f = io.BytesIO()
+    f.write(container.header())
+    tags = [None] * container.chunk_count(len(data))
+    for i in reversed(range(0, len(tags))):
+      tags[i] = container.write_chunk(f, i, data[i * 64:(i + 1) * 64])
+    container.write_index(f, tags, len(data))
+    
+    reader = blowfish.ContainerReader(f, self.cipher, self.mac_cipher)
+    self.assertEqual(reader.read(), data)
+  
+  def test_tamper(self):
+    """
+    Test that modified containers are detected.
+    """
+    data = urandom(300)
+    container_bytes = self.write(data).getvalue()
+    
+    for offset in (20, 100, len(container_bytes) - 40, len(container_bytes) - 20):
+      with self.subTest(offset = offset):
+        modified = bytearray(container_bytes)
+        modified[offset] ^= 1
+        
+        with self.assertRaises(ValueError):
+          reader = blowfish.ContainerReader(
+            io.BytesIO(modified),
+            self.cipher,
+            self.mac_cipher
+          )
+          reader.read()
+    
+    with self.assertRaises(ValueError):
+      blowfish.ContainerReader(
+        io.BytesIO(container_bytes[:-1]),
+        self.cipher,
+        self.mac_cipher
+      )
+
+class RandomTest(unittest.TestCase):
+  """
+  Test the deterministic random byte generator.
+  """
+  
+  def keystream(self, key, nonce, size, byte_order = "big"):
+    cipher = blowfish.Cipher(key, byte_order)
+    return b"".join(
+      cipher.encrypt_ctr(bytes(size), blowfish.ctr_counter(nonce, operator.xor))
+    )
+  
+  def test_keystream(self):
+    """
+    Test that the bytes are the CTR mode keystream, however they are read.
+    """
+    key = urandom(16)
+    nonce = int.from_bytes(urandom(8), "big")
+    
+    for byte_order in ("big", "little"):
+      expected = self.keystream(key, nonce, 1000, byte_order)
+      
+      with self.subTest(byte_order = byte_order, method = "randbytes"):
+        random = blowfish.Random(key, nonce, byte_order, batch_size = 64)
+        self.assertEqual(
+          b"".join(random.randbytes(n) for n in (1, 7, 8, 100, 0, 884)),
+          expected
+        )
+      
+      with self.subTest(byte_order = byte_order, method = "readinto"):
+        random = blowfish.Random(key, nonce, byte_order, batch_size = 64)
+        buffer = bytearray(1000)
+        self.assertEqual(random.readinto(memoryview(buffer)[:3]), 3)
+        self.assertEqual(random.readinto(memoryview(buffer)[3:]), 997)
+        self.assertEqual(buffer, expected)
+  
+  def test_jumpahead(self):
+    """
+    Test skipping over blocks of the stream.
+    """
+    key = urandom(16)
+    expected = self.keystream(key, 0, 1000)
+    
+    for start, blocks in ((0, 0), (0, 10), (5, 3), (13, 100)):
+      with self.subTest(start = start, blocks = blocks):
+        random = blowfish.Random(key, batch_size = 64)
+        random.randbytes(start)
+        random.jumpahead(blocks)
+        position = start + 8 * blocks
+        self.assertEqual(random.tell(), position)
+        self.assertEqual(random.randbytes(50), expected[position:position + 50])
+    
+    with self.assertRaises(ValueError):
+      blowfish.Random(key).jumpahead(-1)
+
+class SectorCipherTest(unittest.TestCase):
+  """
+  Test sector-addressed encryption.
+  """
+  
+  def setUp(self):
+    self.key = urandom(16)
+    self.sector_cipher = blowfish.SectorCipher(self.key, 64)
+  
+  def test_sector(self):
+    """
+    Test that sectors are CBC encrypted with ESSIV initialization vectors.
+    """
+    iv_cipher = blowfish.Cipher(hashlib.sha256(self.key).digest())
+    cipher = blowfish.Cipher(self.key)
+    data = urandom(64)
+    
+    for sector in (0, 1, 2**64 - 1):
+      with self.subTest(sector = sector):
+        iv = iv_cipher.encrypt_block(sector.to_bytes(8, "big"))
+        encrypted = self.sector_cipher.encrypt_sector(sector, data)
+        self.assertEqual(encrypted, b"".join(cipher.encrypt_cbc(data, iv)))
+        self.assertEqual(
+          self.sector_cipher.decrypt_sector(sector, encrypted),
+          data
+        )
+    
+    self.assertNotEqual(
+      self.sector_cipher.encrypt_sector(3, data),
+      self.sector_cipher.encrypt_sector(4, data)
+    )
+    
+    with self.assertRaises(ValueError):
+      self.sector_cipher.encrypt_sector(0, data[:-8])
+  
+  def test_in_place(self):
+    """
+    Test encrypting and decrypting sectors of a buffer in place.
+    """
+    thread_pool = ThreadPoolExecutor(2)
+    self.addCleanup(thread_pool.shutdown)
+    
+    data = urandom(64 * 20)
+    
+    for sectors in (None, range(5, 12), [19, 0, 7]):
+      for executor in (None, thread_pool):
+        with self.subTest(sectors = sectors, executor = executor):
+          buffer = bytearray(data)
+          self.sector_cipher.encrypt_in_place(
+            buffer, sectors, executor, batch_size = 3, max_pending = 2
+          )
+          
+          for sector in range(0, 20):
+            sector_data = data[sector * 64:(sector + 1) * 64]
+            if sectors is None or sector in sectors:
+              sector_data = self.sector_cipher.encrypt_sector(
+                sector, sector_data
+              )
+            self.assertEqual(
+              buffer[sector * 64:(sector + 1) * 64],
+              sector_data
+            )
+          
+          self.sector_cipher.decrypt_in_place(buffer, sectors, executor)
+          self.assertEqual(buffer, data)
+    
+    with self.assertRaises(ValueError):
+      self.sector_cipher.encrypt_in_place(bytearray(data), [20])
+    
+    # A bad sector at the end leaves the buffer unchanged.
+    for executor in (None, thread_pool):
+      with self.subTest(executor = executor):
+        buffer = bytearray(data)
+        with self.assertRaises(ValueError):
+          self.sector_cipher.encrypt_in_place(
+            buffer, iter(range(0, 21)), executor, batch_size = 3
+          )
+        self.assertEqual(buffer, data)
+  
+  def test_mmap(self):
+    """
+    Test encrypting an mmap'd image file in place.
+    """
+    data = urandom(64 * 8)
+    with tempfile.TemporaryFile() as f:
+      f.write(data)
+      f.flush()
+      
+      with mmap.mmap(f.fileno(), 0) as image:
+        self.sector_cipher.encrypt_in_place(image)
+      
+      f.seek(64)
+      self.assertEqual(
+        self.sector_cipher.decrypt_sector(1, f.read(64)),
+        data[64:128]
+      )
+
+class PageCacheTest(unittest.TestCase):
+  """
+  Test the decrypted page cache.
+  """
+  
+  def setUp(self):
+    self.sector_cipher = blowfish.SectorCipher(urandom(16), 64)
+    self.data = urandom(64 * 10)
+    
+    encrypted = bytearray(self.data)
+    self.sector_cipher.encrypt_in_place(encrypted)
+    self.file = io.BytesIO(encrypted)
+  
+  def test_lru(self):
+    """
+    Test hits, misses and evictions.
+    """
+    cache = blowfish.PageCache(self.file, self.sector_cipher, 3 * 64)
+    
+    for page in (0, 1, 2, 0, 3, 1, 0):
+      self.assertEqual(
+        cache.read_page(page),
+        self.data[page * 64:(page + 1) * 64]
+      )
+    
+    self.assertEqual(cache.hits, 2)
+    self.assertEqual(cache.misses, 5)
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(len(cache), 3)
+    self.assertAlmostEqual(cache.hit_rate, 2 / 7)
+    
+    self.assertEqual(cache.read(100, 200), self.data[100:300])
+    self.assertEqual(cache.read(600, 100), self.data[600:])
+    self.assertEqual(cache.read(700, 100), b"")
+  
+  def test_read_errors(self):
+    """
+    Test that only the end of the file cuts a read short.
+    """
+    cache = blowfish.PageCache(self.file, self.sector_cipher)
+    with self.assertRaisesRegex(ValueError, "page number is negative"):
+      cache.read(-10, 20)
+    
+    self.file.truncate(150)
+    cache = blowfish.PageCache(self.file, self.sector_cipher)
+    self.assertEqual(cache.read(0, 128), self.data[:128])
+    with self.assertRaisesRegex(ValueError, "page 2 is truncated"):
+      cache.read(0, 192)
+  
+  def test_write(self):
+    """
+    Test that writing a page invalidates it.
+    """
+    cache = blowfish.PageCache(self.file, self.sector_cipher)
+    cache.read_page(4)
+    
+    new_data = urandom(64)
+    cache.write_page(4, new_data)
+    self.assertEqual(cache.invalidations, 1)
+    self.assertEqual(cache.read_page(4), new_data)
+    self.assertEqual(cache.misses, 2)
+    
+    self.file.seek(4 * 64)
+    self.assertEqual(
+      self.sector_cipher.decrypt_sector(4, self.file.read(64)),
+      new_data
+    )
+  
+  def test_shared_decryption(self):
+    """
+    Test that concurrent readers of a page share one decryption.
+    """
+    cache = blowfish.PageCache(self.file, self.sector_cipher)
+    loads = []
+    load = cache._load
+    
+    def slow_load(page):
+      loads.append(page)
+      time.sleep(0.1)
+      return load(page)
+    
+    cache._load = slow_load
+    
+    with ThreadPoolExecutor(4) as executor:
+      results = list(executor.map(cache.read_page, [2] * 4))
+    
+    self.assertEqual(results, [self.data[128:192]] * 4)
+    self.assertEqual(loads, [2])
+    self.assertEqual(cache.misses, 1)
+    self.assertEqual(cache.hits, 3)
+
+class ReencryptTest(unittest.TestCase):
+  """
+  Test re-encrypting data under a new key and mode.
+  """
+  
+  def test_reencrypt(self):
+    """
+    Test that re-encrypting is the same as decrypting and encrypting.
+    """
+    thread_pool = ThreadPoolExecutor(2)
+    self.addCleanup(thread_pool.shutdown)
+    
+    old_cipher = blowfish.Cipher(urandom(16))
+    new_cipher = blowfish.Cipher(urandom(16))
+    old_nonce = int.from_bytes(urandom(8), "big")
+    new_nonce = int.from_bytes(urandom(8), "big")
+    
+    def mode_args(mode, nonce, init_vector):
+      if mode == "ctr":
+        return (blowfish.ctr_counter(nonce, operator.xor),)
+      if mode in ("ecb", "ecb_cts"):
+        return ()
+      return (init_vector,)
+    
+    old_iv = urandom(8)
+    new_iv = urandom(8)
+    
+    for old_mode, new_mode, data_len in (
+      ("cbc", "ctr", 1000),
+      ("cbc", "ecb", 1000),
+      ("ctr", "ctr", 1001),
+      ("cfb", "ctr", 1001),
+      ("ecb", "cbc", 1000),
+      ("ofb", "cbc_cts", 1001),
+      ("pcbc", "cfb", 1000),
+    ):
+      data = urandom(data_len)
+      old_data = b"".join(
+        getattr(old_cipher, "encrypt_" + old_mode)(
+          data, *mode_args(old_mode, old_nonce, old_iv)
+        )
+      )
+      expected = b"".join(
+        getattr(new_cipher, "encrypt_" + new_mode)(
+          data, *mode_args(new_mode, new_nonce, new_iv)
+        )
+      )
+      
+      for src, executor in (
+        (old_data, None),
+        (io.BytesIO(old_data), None),
+        (old_data, thread_pool),
+      ):
+        with self.subTest(
+          old_mode = old_mode,
+          new_mode = new_mode,
+          src = type(src),
+          executor = executor
+        ):
+          self.assertEqual(
+            b"".join(
+              blowfish.reencrypt(
+                src,
+                old_cipher, old_mode,
+                new_cipher, new_mode,
+                mode_args(old_mode, old_nonce, old_iv),
+                mode_args(new_mode, new_nonce, new_iv),
+                chunk_size = 64,
+                executor = executor,
+                max_pending = 2
+              )
+            ),
+            expected
+          )
+  
+  def test_padding(self):
+    """
+    Test re-encrypting padded data.
+    """
+    old_cipher = blowfish.Cipher(urandom(16))
+    new_cipher = blowfish.Cipher(urandom(16))
+    iv = urandom(8)
+    data = urandom(100)
+    
+    old_data = b"".join(old_cipher.encrypt_cbc(data, iv, padding = "pkcs7"))
+    new_data = b"".join(
+      blowfish.reencrypt(
+        old_data,
+        old_cipher, "cbc",
+        new_cipher, "ecb",
+        (iv,), (),
+        old_padding = "pkcs7",
+        new_padding = "x923",
+        chunk_size = 16
+      )
+    )
+    self.assertEqual(
+      b"".join(new_cipher.decrypt_ecb(new_data, padding = "x923")),
+      data
+    )
+  
+  def test_process_pool(self):
+    """
+    Test re-encrypting with a process pool, which each cipher is only
+    unpickled once per worker for.
+    """
+    old_cipher = blowfish.Cipher(urandom(16), fuse_S_boxes = True)
+    new_cipher = blowfish.Cipher(urandom(16))
+    nonce = int.from_bytes(urandom(8), "big")
+    data = urandom(1000)
+    
+    old_data = b"".join(
+      old_cipher.encrypt_ctr(data, blowfish.ctr_counter(nonce, operator.xor))
+    )
+    with ProcessPoolExecutor(2) as executor:
+      self.assertEqual(
+        b"".join(
+          blowfish.reencrypt(
+            old_data,
+            old_cipher, "ctr",
+            new_cipher, "ecb",
+            (blowfish.ctr_counter(nonce, operator.xor),),
+            chunk_size = 64,
+            executor = executor
+          )
+        ),
+        b"".join(new_cipher.encrypt_ecb(data))
+      )
+    
+    worker_cipher = blowfish._WorkerCipher(old_cipher)
+    restored = pickle.loads(pickle.dumps(worker_cipher))
+    self.assertIs(pickle.loads(pickle.dumps(worker_cipher)), restored)
+    self.assertEqual(
+      restored.encrypt_block(bytes(8)),
+      old_cipher.encrypt_block(bytes(8))
+    )
+
+class PipelineTest(unittest.TestCase):
+  """
+  Test the overlapped read/encrypt/write pipeline.
+  """
+  
+  def setUp(self):
+    self.cipher = blowfish.Cipher(urandom(16))
+    self.data = urandom(1000)
+  
+  def test_pipeline(self):
+    """
+    Test that the output is the same as the mode method's.
+    """
+    thread_pool = ThreadPoolExecutor(2)
+    self.addCleanup(thread_pool.shutdown)
+    
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    iv = urandom(8)
+    
+    for mode, direction, args, kwargs in (
+      ("cbc", "encrypt", (iv,), {"padding": "pkcs7"}),
+      ("cbc", "decrypt", (iv,), {}),
+      ("ctr", "encrypt", (nonce,), {}),
+      ("cfb", "decrypt", (iv,), {}),
+      ("ofb", "encrypt", (iv,), {}),
+    ):
+      for executor in (None, thread_pool):
+        with self.subTest(mode = mode, direction = direction, executor = executor):
+          data = self.data[:-8] if kwargs else self.data
+          
+          def mode_args():
+            if mode == "ctr":
+              return (blowfish.ctr_counter(nonce, operator.xor),)
+            return args
+          
+          expected = b"".join(
+            getattr(cipher, direction + "_" + mode)(data, *mode_args(), **kwargs)
+          )
+          
+          out = io.BytesIO()
+          stats = blowfish.pipeline(
+            io.BytesIO(data), out, cipher, mode, *mode_args(),
+            direction = direction,
+            chunk_size = 64,
+            queue_size = 2,
+            executor = executor,
+            **kwargs
+          )
+          
+          self.assertEqual(out.getvalue(), expected)
+          self.assertEqual(stats.bytes_in, len(data))
+          self.assertEqual(stats.bytes_out, len(expected))
+          self.assertEqual(
+            set(stats.utilization()),
+            {"read", "cipher", "write"}
+          )
+  
+  def test_errors(self):
+    """
+    Test that errors in any stage are raised.
+    """
+    class BrokenWriter(object):
+      def write(self, data):
+        raise OSError("disk full")
+    
+    with self.assertRaises(OSError):
+      blowfish.pipeline(
+        io.BytesIO(self.data), BrokenWriter(), self.cipher, "ecb",
+        chunk_size = 64
+      )
+    
+    with self.assertRaises(ValueError):
+      blowfish.pipeline(
+        io.BytesIO(self.data[:-1]), io.BytesIO(), self.cipher, "ecb",
+        chunk_size = 64
+      )
+
+class BlockCacheTest(unittest.TestCase):
+  """
+  Test the ECB block result cache.
+  """
+  
+  def test_block_cache(self):
+    """
+    Test that results are the same with the cache, and that repeated blocks
+    are found in it.
+    """
+    key = urandom(16)
+    cipher = blowfish.Cipher(key)
+    cached_cipher = blowfish.Cipher(key)
+    block_cache = cached_cipher.enable_block_cache(max_blocks = 8)
+    self.assertIs(cached_cipher.block_cache, block_cache)
+    
+    data = bytes(64) + urandom(64) + bytes(64) + urandom(5)
+    
+    for mode, data, kwargs in (
+      ("ecb", data[:-5], {}),
+      ("ecb", data, {"padding": "pkcs7"}),
+      ("ecb_cts", data, {}),
+    ):
+      with self.subTest(mode = mode, kwargs = kwargs):
+        encrypted_data = b"".join(
+          getattr(cipher, "encrypt_" + mode)(data, **kwargs)
+        )
+        self.assertEqual(
+          b"".join(getattr(cached_cipher, "encrypt_" + mode)(data, **kwargs)),
+          encrypted_data
+        )
+        self.assertEqual(
+          b"".join(
+            getattr(cached_cipher, "decrypt_" + mode)(encrypted_data, **kwargs)
+          ),
+          data
+        )
+    
+    self.assertEqual(
+      cached_cipher.prepare("ecb", "encrypt")(data[:64]),
+      cipher.prepare("ecb", "encrypt")(data[:64])
+    )
+    
+    self.assertGreater(block_cache.hits, 0)
+    self.assertGreater(block_cache.evictions, 0)
+    self.assertLessEqual(len(block_cache), 16)
+    self.assertGreater(block_cache.hit_rate, 0.0)
+    self.assertLess(block_cache.hit_rate, 1.0)
+    
+    block_cache.clear()
+    self.assertEqual(len(block_cache), 0)
+    
+    self.assertIsNone(pickle.loads(pickle.dumps(cached_cipher)).block_cache)
+    self.assertRaises(ValueError, blowfish.BlockCache, 0)
+  
+  def test_records_bypass(self):
+    """
+    Test that the CTR mode keystream of records is not put in the cache.
+    """
+    key = urandom(16)
+    cipher = blowfish.Cipher(key)
+    cached_cipher = blowfish.Cipher(key)
+    block_cache = cached_cipher.enable_block_cache()
+    
+    data = urandom(64)
+    offsets = [0, 32, 64]
+    nonces = [1, 2]
+    self.assertEqual(
+      cached_cipher.encrypt_records("ctr", data, offsets, nonces),
+      cipher.encrypt_records("ctr", data, offsets, nonces)
+    )
+    self.assertEqual(len(block_cache), 0)
+    self.assertEqual((block_cache.hits, block_cache.misses), (0, 0))
+
+class OutOfBandBlob(object):
+  """
+  An object pickled with its data out-of-band (like a NumPy array).
+  """
+  
+  def __init__(self, data):
+    self.data = data
+  
+  def __reduce_ex__(self, protocol):
+    return OutOfBandBlob, (pickle.PickleBuffer(self.data),)
+
+@unittest.skipIf(
+  not hasattr(pickle, "PickleBuffer"),
+  "pickle protocol 5 is not available"
+)
+class DumpsTest(unittest.TestCase):
+  """
+  Test encrypted pickling with out-of-band buffers.
+  """
+  
+  def setUp(self):
+    self.cipher = blowfish.Cipher(urandom(16))
+  
+  def test_dumps(self):
+    """
+    Test that objects round-trip, with the buffers encrypted separately.
+    """
+    cipher = self.cipher
+    blob_data = urandom(100003)
+    
+    for in_place in (False, True):
+      with self.subTest(in_place = in_place):
+        blob = OutOfBandBlob(bytearray(blob_data))
+        obj = {"name": "blob", "blobs": [blob, OutOfBandBlob(bytearray(7))]}
+        
+        data, buffers = blowfish.dumps(obj, cipher, in_place = in_place)
+        self.assertEqual(len(buffers), 2)
+        self.assertEqual(len(buffers[0]), len(blob_data))
+        self.assertNotEqual(bytes(buffers[0]), blob_data)
+        self.assertNotIn(b"blob", data)
+        self.assertEqual(blob.data != blob_data, in_place)
+        
+        loaded = blowfish.loads(
+          data, cipher, [bytes(buffer) for buffer in buffers]
+        )
+        self.assertEqual(loaded["name"], "blob")
+        self.assertEqual(bytes(loaded["blobs"][0].data), blob_data)
+        self.assertEqual(bytes(loaded["blobs"][1].data), bytes(7))
+    
+    # Writable buffers are decrypted in place.
+    data, buffers = blowfish.dumps(OutOfBandBlob(bytearray(blob_data)), cipher)
+    loaded = blowfish.loads(data, cipher, buffers)
+    self.assertEqual(buffers[0], blob_data)
+    
+    self.assertRaises(
+      ValueError,
+      blowfish.dumps, OutOfBandBlob(blob_data), cipher, in_place = True
+    )
+  
+  @unittest.skipIf(numpy is None, "NumPy is not installed")
+  def test_dumps_numpy(self):
+    array = numpy.arange(100000, dtype = numpy.float64)
+    data, buffers = blowfish.dumps(array, self.cipher)
+    self.assertEqual(len(buffers), 1)
+    self.assertTrue(
+      numpy.array_equal(blowfish.loads(data, self.cipher, buffers), array)
+    )
+
+class AsyncTest(unittest.TestCase):
+  """
+  Test the awaitable encryption & decryption.
+  """
+  
+  def setUp(self):
+    self.cipher = blowfish.Cipher(urandom(16))
+    self.loop = asyncio.new_event_loop()
+  
+  def tearDown(self):
+    self.loop.close()
+  
+  def run_counting_ticks(self, awaitable):
+    """
+    Run `awaitable` in the loop and return its result and how many times
+    other callbacks got to run meanwhile.
+    """
+    loop = self.loop
+    ticks = [0]
+    
+    def tick():
+      ticks[0] += 1
+      handles[0] = loop.call_soon(tick)
+    
+    handles = [loop.call_soon(tick)]
+    result = loop.run_until_complete(awaitable)
+    handles[0].cancel()
+    return result, ticks[0]
+  
+  def test_aencrypt(self):
+    """
+    Test that the results are the same as the methods', and that large
+    payloads yield to the loop.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    data = urandom(50003)
+    
+    for mode, args, kwargs in (
+      ("ctr", lambda: (blowfish.ctr_counter(nonce, operator.xor),), {}),
+      ("cbc", lambda: (init_vector,), {"padding": "pkcs7"}),
+      ("ecb_cts", lambda: (), {}),
+    ):
+      with self.subTest(mode = mode):
+        encrypted_data = b"".join(
+          getattr(cipher, "encrypt_" + mode)(data, *args(), **kwargs)
+        )
+        
+        awaitable = cipher.aencrypt(
+          mode, data, *args(), time_slice = 0.001, **kwargs
+        )
+        result, ticks = self.run_counting_ticks(awaitable)
+        self.assertEqual(result, encrypted_data)
+        self.assertGreater(awaitable.yields, 0)
+        self.assertGreater(ticks, 0)
+        
+        with ThreadPoolExecutor(1) as executor:
+          awaitable = cipher.adecrypt(
+            mode, encrypted_data, *args(),
+            executor = executor, offload_size = 1024, **kwargs
+          )
+          result, ticks = self.run_counting_ticks(awaitable)
+          self.assertEqual(result, data)
+          self.assertEqual(awaitable.yields, 0)
+    
+    awaitable = cipher.aencrypt("ofb", data[:64], init_vector)
+    self.assertEqual(
+      self.loop.run_until_complete(awaitable),
+      b"".join(cipher.encrypt_ofb(data[:64], init_vector))
+    )
+    self.assertEqual(awaitable.yields, 0)
+    
+    self.assertRaises(
+      ValueError, cipher.aencrypt, "ctr", data, [0], time_slice = 0
+    )
+
+class FileInplaceTest(unittest.TestCase):
+  """
+  Test encrypting & decrypting files in place.
+  """
+  
+  window_size = mmap.ALLOCATIONGRANULARITY
+  
+  def setUp(self):
+    self.cipher = blowfish.Cipher(urandom(16))
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, "data")
+    self.data = urandom(self.window_size * 3 + 5)
+    with open(self.path, "wb") as f:
+      f.write(self.data)
+  
+  def tearDown(self):
+    self.dir.cleanup()
+  
+  def read(self):
+    with open(self.path, "rb") as f:
+      return f.read()
+  
+  def test_inplace(self):
+    """
+    Test that the file ends up the same as the methods' output.
+    """
+    cipher = self.cipher
+    nonce = int.from_bytes(urandom(8), "big")
+    init_vector = urandom(8)
+    
+    for mode, args, method_args in (
+      ("ctr", (nonce,), (blowfish.ctr_counter(nonce, operator.xor),)),
+      ("ofb", (init_vector,), (init_vector,)),
+      ("cfb", (init_vector,), (init_vector,)),
+    ):
+      with self.subTest(mode = mode):
+        self.assertEqual(
+          blowfish.encrypt_file_inplace(
+            self.path, cipher, mode, *args, window_size = self.window_size
+          ),
+          len(self.data)
+        )
+        self.assertEqual(
+          self.read(),
+          b"".join(getattr(cipher, "encrypt_" + mode)(self.data, *method_args))
+        )
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        
+        blowfish.decrypt_file_inplace(self.path, cipher, mode, *args)
+        self.assertEqual(self.read(), self.data)
+    
+    self.assertRaises(
+      ValueError,
+      blowfish.encrypt_file_inplace, self.path, cipher, "ecb"
+    )
+    self.assertRaises(
+      ValueError,
+      blowfish.encrypt_file_inplace, self.path, cipher, "cbc_cts", init_vector
+    )
+    self.assertEqual(self.read(), self.data)
+  
+  def test_resume(self):
+    """
+    Test that an interrupted run resumes with the same result, whether it
+    stopped before or after saving the journal.
+    """
+    cipher = self.cipher
+    init_vector = urandom(8)
+    expected = b"".join(cipher.encrypt_cfb(self.data, init_vector))
+    write_journal = blowfish._write_journal
+    
+    class Crash(Exception):
+      pass
+    
+    for crash_after_journal in (False, True):
+      for crash_at in range(1, 5):
+        with self.subTest(
+          crash_after_journal = crash_after_journal,
+          crash_at = crash_at
+        ):
+          with open(self.path, "wb") as f:
+            f.write(self.data)
+          calls = []
+          
+          def crashing_write_journal(path, contents):
+            calls.append(path)
+            if crash_after_journal:
+              write_journal(path, contents)
+            if len(calls) == crash_at:
+              raise Crash()
+            if not crash_after_journal:
+              write_journal(path, contents)
+          
+          blowfish._write_journal = crashing_write_journal
+          try:
+            with self.assertRaises(Crash):
+              blowfish.encrypt_file_inplace(
+                self.path, cipher, "cfb", init_vector,
+                window_size = self.window_size
+              )
+          finally:
+            blowfish._write_journal = write_journal
+          
+          blowfish.encrypt_file_inplace(
+            self.path, cipher, "cfb", init_vector,
+            window_size = self.window_size
+          )
+          self.assertEqual(self.read(), expected)
+          self.assertFalse(os.path.exists(self.path + ".journal"))
+    
+    # A journal for other arguments is not used.
+    with open(self.path, "wb") as f:
+      f.write(self.data)
+    def crash_once(path, contents):
+      write_journal(path, contents)
+      raise Crash()
+    
+    blowfish._write_journal = crash_once
+    try:
+      with self.assertRaises(Crash):
+        blowfish.encrypt_file_inplace(
+          self.path, cipher, "ctr", 1, window_size = self.window_size
+        )
+    finally:
+      blowfish._write_journal = write_journal
+    self.assertRaises(
+      ValueError,
+      blowfish.encrypt_file_inplace, self.path, cipher, "ctr", 2
+    )
+    self.assertRaises(
+      ValueError,
+      blowfish.encrypt_file_inplace, self.path, blowfish.Cipher(urandom(16)),
+      "ctr", 1
+    )
+    
+    # Nor is one for another IV, even if the last window was pending (so there
+    # is no context checkpoint to check it against).
+    os.remove(self.path + ".journal")
+    with open(self.path, "wb") as f:
+      f.write(self.data)
+    calls = []
+    def crash_last(path, contents):
+      write_journal(path, contents)
+      calls.append(path)
+      if len(calls) == 4:
+        raise Crash()
+    
+    blowfish._write_journal = crash_last
+    try:
+      with self.assertRaises(Crash):
+        blowfish.encrypt_file_inplace(
+          self.path, cipher, "cfb", init_vector, window_size = self.window_size
+        )
+    finally:
+      blowfish._write_journal = write_journal
+    self.assertRaises(
+      ValueError,
+      blowfish.encrypt_file_inplace, self.path, cipher, "cfb", urandom(8),
+      window_size = self.window_size
+    )
+    blowfish.encrypt_file_inplace(
+      self.path, cipher, "cfb", init_vector, window_size = self.window_size
+    )
+    self.assertEqual(self.read(), expected)
+
+class ConformanceTest(unittest.TestCase):
+  """
+  Test that every engine & API style agrees (see conformance.py).
+  """
+  
+  def test_check(self):
+    with ThreadPoolExecutor(2) as executor:
+      self.assertEqual(conformance.check(executor = executor), [])
+  
+  def test_throughput(self):
+    matrix, failures = conformance.throughput(4096)
+    self.assertEqual(failures, [])
+    self.assertEqual(
+      len(matrix),
+      len(conformance.ENGINES) * len(conformance.MODES) *
+      len(conformance.STYLES)
+    )
+    self.assertIn("generator", conformance.format_matrix(matrix))
+  
+  def test_mismatch(self):
+    """
+    Test that an engine that disagrees is caught.
+    """
+    S_boxes = list(blowfish.PI_S_BOXES)
+    S_boxes[0] = (S_boxes[0][1],) + S_boxes[0][1:]
+    engines = conformance.ENGINES[:1] + (("broken", {"S_boxes": S_boxes}),)
+    
+    failures = conformance.check(sizes = (16,), engines = engines)
+    self.assertTrue(failures)
+    self.assertTrue(all(failure.startswith("broken") for failure in failures))
+
+class AutotunerTest(unittest.TestCase):
+  """
+  Test the chunk size & worker count autotuner.
+  """
+  
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, "tuning.json")
+  
+  def tearDown(self):
+    blowfish.autotuner = None
+    self.dir.cleanup()
+  
+  def test_calibrate(self):
+    """
+    Test that calibration picks one of the candidates and persists it.
+    """
+    tuner = blowfish.Autotuner(
+      self.path,
+      chunk_sizes = (1024, 4096),
+      worker_counts = (0,),
+      sample_size = 16 * 1024
+    )
+    
+    for mode, direction in (("ctr", "encrypt"), ("cbc", "decrypt")):
+      with self.subTest(mode = mode, direction = direction):
+        decision = tuner.settings(mode, direction, 10 ** 6)
+        self.assertEqual(decision.source, "calibrated")
+        self.assertIn(decision.chunk_size, (1024, 4096))
+        self.assertEqual(decision.workers, 0)
+        
+        loaded = blowfish.Autotuner(self.path, calibrate_on_first_use = False)
+        self.assertEqual(loaded.settings(mode, direction, 10 ** 6), decision)
+    
+    uncalibrated = blowfish.Autotuner(calibrate_on_first_use = False)
+    self.assertEqual(
+      uncalibrated.settings("ctr", "encrypt", 10 ** 6),
+      (64 * 1024, 0, "default")
+    )
+  
+  def test_concurrent_calibration(self):
+    """
+    Test that callers asking for the same uncalibrated key at the same time
+    only calibrate it once.
+    """
+    calibrated = []
+    
+    class CountingAutotuner(blowfish.Autotuner):
+      def calibrate(self, mode, direction = "encrypt", size = None):
+        calibrated.append((mode, direction, size))
+        time.sleep(0.05)
+        return super().calibrate(mode, direction, size)
+    
+    tuner = CountingAutotuner(
+      chunk_sizes = (1024,),
+      worker_counts = (0,),
+      sample_size = 4096
+    )
+    with ThreadPoolExecutor(4) as executor:
+      decisions = list(
+        executor.map(lambda i: tuner.settings("ecb", "encrypt", 100), range(8))
+      )
+    
+    self.assertEqual(len(calibrated), 1)
+    self.assertEqual(len(set(decisions)), 1)
+    self.assertEqual(decisions[0].source, "calibrated")
+  
+  def test_fixed(self):
+    """
+    Test that a fixed configuration overrides the decisions.
+    """
+    tuner = blowfish.Autotuner(fixed = {"chunk_size": 8192, "workers": 0})
+    self.assertEqual(
+      tuner.settings("cfb", "encrypt", 100),
+      (8192, 0, "fixed")
+    )
+    self.assertEqual(tuner.decisions, {})
+  
+  def test_size_bucket(self):
+    self.assertEqual(blowfish.Autotuner.size_bucket(0), 64 * 1024)
+    self.assertEqual(blowfish.Autotuner.size_bucket(64 * 1024), 1024 * 1024)
+    self.assertIsNone(blowfish.Autotuner.size_bucket(10 ** 9))
+    self.assertIsNone(blowfish.Autotuner.size_bucket(None))
+  
+  def test_applied(self):
+    """
+    Test that the bulk & streaming functions use the module's autotuner.
+    """
+    cipher = blowfish.Cipher(urandom(16))
+    data = urandom(20000)
+    expected = b"".join(cipher.encrypt_ofb(data, bytes(8)))
+    
+    class RecordingAutotuner(blowfish.Autotuner):
+      def settings(self, mode, direction = "encrypt", size = None):
+        self.asked = (mode, direction, size)
+        return super().settings(mode, direction, size)
+    
+    tuner = blowfish.autotuner = RecordingAutotuner(
+      fixed = {"chunk_size": 1024, "workers": 0}
+    )
+    
+    out = io.BytesIO()
+    blowfish.pipeline(io.BytesIO(data), out, cipher, "ofb", bytes(8))
+    self.assertEqual(out.getvalue(), expected)
+    self.assertEqual(tuner.asked, ("ofb", "encrypt", None))
+    
+    new_cipher = blowfish.Cipher(urandom(16))
+    self.assertEqual(
+      b"".join(
+        blowfish.reencrypt(expected, cipher, "ofb", new_cipher, "ecb_cts",
+          old_args = (bytes(8),))
+      ),
+      b"".join(new_cipher.encrypt_ecb_cts(data))
+    )
+    self.assertEqual(tuner.asked, ("ofb", "decrypt", len(data)))
+
+class ImportTest(unittest.TestCase):
+  """
+  Test what importing the module costs.
+  """
+  
+  def test_lazy_imports(self):
+    """
+    Test that the standard library modules only some functions need are not
+    imported along with the module.
+    """
+    lazy = ("asyncio", "concurrent.futures", "json", "pickle", "queue")
+    output = subprocess.check_output(
+      [
+        sys.executable, "-c",
+        "import sys, blowfish; print(' '.join(sorted(sys.modules)))"
+      ],
+      cwd = os.path.dirname(os.path.abspath(blowfish.__file__))
+    )
+    imported = set(output.decode().split())
+    self.assertEqual([name for name in lazy if name in imported], [])